@@ -1,13 +1,16 @@
 from typing import Any
+from django.db import transaction
 from django.db.models.aggregates import Count
 from django.contrib import admin
-from django.db.models import Q, F, Value, Func, ExpressionWrapper, DecimalField
+from django.db.models import Q, Value, Func
 from django.db.models.query import QuerySet
 from django.http import HttpRequest
 from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.http import urlencode
 from . import models
+from .service import PartyBalanceService
+from .utils.rates import invalidate_rates_for
 
 
 class Work_Rate_Inline(admin.TabularInline):
@@ -15,15 +18,67 @@ class Work_Rate_Inline(admin.TabularInline):
     extra = 5
 
 
+class LedgerVersionAdmin(admin.ModelAdmin):
+    # admin writes skip the api views and services, so refresh the party
+    # balances and bump the owner's ledger version here, or the party list,
+    # ETags and the summary cache keep answering with old data
+    party_field = 'party'
+    owner_field = 'party__user'
+
+    def affected(self, queryset):
+        rows = list(queryset.values_list(self.party_field, self.owner_field))
+        return {party_id for party_id, _ in rows}, {owner_id for _, owner_id in rows}
+
+    def after_write(self, party_ids, owner_ids):
+        # deleted parties take their balance row with them
+        for party_id in models.Party.objects.filter(
+                pk__in=party_ids).values_list('pk', flat=True):
+            PartyBalanceService.refresh(party_id)
+        for owner_id in owner_ids:
+            models.LedgerVersion.bump(owner_id)
+
+    def save_model(self, request, obj, form, change):
+        # the change form can move a row to another party, refresh both
+        before = self.model.objects.filter(pk=obj.pk)
+        party_ids, owner_ids = self.affected(before) if change else (set(), set())
+        super().save_model(request, obj, form, change)
+        after_party_ids, after_owner_ids = self.affected(before)
+        self.after_write(party_ids | after_party_ids, owner_ids | after_owner_ids)
+
+    def delete_model(self, request, obj):
+        party_ids, owner_ids = self.affected(self.model.objects.filter(pk=obj.pk))
+        super().delete_model(request, obj)
+        self.after_write(party_ids, owner_ids)
+
+    def delete_queryset(self, request, queryset):
+        party_ids, owner_ids = self.affected(queryset)
+        super().delete_queryset(request, queryset)
+        self.after_write(party_ids, owner_ids)
+
+
 @admin.register(models.Party)
-class PartyAdmin(admin.ModelAdmin):
+class PartyAdmin(LedgerVersionAdmin):
+    party_field = 'pk'
+    owner_field = 'user'
     list_display = ['user', 'first_name', 'last_name',
                     'number', 'email', 'address', 'advance_balance']
     list_per_page = 10
-    search_fields = ['first_name__istartswith', 'last_name__istartswith']
-    list_select_related = ['user']
+    search_fields = ['search_key__contains']
+    list_select_related = ['user', 'balance']
     inlines = [Work_Rate_Inline]
 
+    def get_search_results(self, request, queryset, search_term):
+        # search_key is stored lower-cased
+        return super().get_search_results(
+            request, queryset, search_term.lower())
+
+    @admin.display(ordering='balance__advance')
+    def advance_balance(self, obj):
+        balance = getattr(obj, 'balance', None)
+        if balance is None:
+            return obj.advance_balance
+        return balance.advance
+
 
 @admin.register(models.Service_Type)
 class Service_TypeAdmin(admin.ModelAdmin):
@@ -61,7 +116,11 @@ class Work_RateAdmin(admin.ModelAdmin):
 
     @admin.action(description='set defual rate')
     def full_rate(self, request, queryset):
-        queryset.update(rate=1000)
+        # invalidate after the update commits, or a lookup in between
+        # caches the old rates under the new token
+        with transaction.atomic():
+            queryset.update(rate=1000)
+            transaction.on_commit(lambda: invalidate_rates_for(queryset))
         self.message_user(request, 'rate were sucsusfully updated')
 
 
@@ -76,11 +135,11 @@ class Record_filter(admin.SimpleListFilter):
 
     def queryset(self, request: Any, queryset: QuerySet[Any]):
         if self.value() == '<300':
-            return queryset.filter(amount__lt=300)
+            return queryset.filter(gross_amount__lt=300)
 
 
 @admin.register(models.Record)
-class RecordAdmin(admin.ModelAdmin):
+class RecordAdmin(LedgerVersionAdmin):
     autocomplete_fields = ['party']
     list_display = ['party', 'service_type', 'rate',
                     'record_date', 'pcs', 'discount', 'amount']
@@ -91,19 +150,13 @@ class RecordAdmin(admin.ModelAdmin):
     search_fields = ['party__first_name__istartswith',
                      'party__last_name__istartswith']
 
-    @admin.display(ordering='amount')
+    @admin.display(ordering='gross_amount')
     def amount(self, obj):
         return obj.amount
 
-    def get_queryset(self, request: HttpRequest) -> QuerySet:
-        return super().get_queryset(request).annotate(
-            amount=ExpressionWrapper(
-                (F('rate') * F('pcs')), output_field=DecimalField())
-        )
-
 
 @admin.register(models.Payment)
-class PaymentAdmin(admin.ModelAdmin):
+class PaymentAdmin(LedgerVersionAdmin):
     autocomplete_fields = ['party']
     list_display = ['party', 'amount', 'payment_date']
     list_editable = ['amount']
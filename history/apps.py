@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class HistoryConfig(AppConfig):
     name = 'history'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,342 @@
+"""Synthetic tenants and a query/latency harness for the history API.
+
+Used by the ``benchmark_history`` command and by the query-budget tests.
+Every measurement runs against whatever database is configured, so the
+same run can be compared between SQLite and PostgreSQL.
+"""
+import random
+import statistics
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils.timezone import localdate
+from rest_framework.test import APIClient
+
+from .models import *
+from .rows import mapper_for
+from .serializer import (
+    AdvanceLedgerSerializer, PaymentSerializer, RecordSerializer,
+)
+from .service import (
+    MonthlyRollupService, PartyBalanceService, PaymentService, RecordService,
+)
+
+SERVICE_NAMES = ['Cutting', 'Polish', 'Hallmark', 'Rhodium', 'Setting']
+
+
+class Tenant:
+    # the seeded owner, its staff user and a few ids the runners need
+
+    def __init__(self, owner, staff, parties, advance_parties):
+        self.owner = owner
+        self.staff = staff
+        self.parties = parties
+        self.advance_parties = advance_parties
+
+    @property
+    def party_ids(self):
+        return [party.pk for party in self.parties]
+
+
+def seed_tenant(parties=10, records=20, payments=5, advances=2,
+                requests=3, seed=0):
+    """
+    parties: parties owned by the tenant
+    records / payments: per party
+    advances: parties that end up fully paid with advance left over
+    requests: pending payment requests raised by the staff user
+    """
+    rng = random.Random(seed)
+    User = get_user_model()
+    tag = uuid.uuid4().hex[:10]
+
+    owner = User.objects.create_user(
+        username=f'bench-{tag}', email=f'bench-{tag}@example.com')
+    staff = User.objects.create_user(
+        username=f'bench-staff-{tag}', email=f'bench-staff-{tag}@example.com',
+        parent=owner)
+
+    services = Service_Type.objects.bulk_create([
+        Service_Type(user=owner, type_of_work=name) for name in SERVICE_NAMES
+    ])
+    party_rows = Party.objects.bulk_create([
+        Party(user=owner, assigned_to=staff, first_name=f'Party {i}',
+              last_name=f'Bench {tag}', logo=f'P{i}')
+        for i in range(parties)
+    ])
+
+    Work_Rate.objects.bulk_create([
+        Work_Rate(party=party, service_type=service,
+                  rate=Decimal(rng.randint(5, 60)))
+        for party in party_rows
+        for service in services
+    ])
+
+    today = localdate()
+    Record.objects.bulk_create([
+        Record(party=party, service_type=rng.choice(services),
+               pcs=rng.randint(1, 40), rate=Decimal(rng.randint(5, 60)),
+               discount=Decimal('0.00'), paid_amount=Decimal('0.00'),
+               record_date=today - timedelta(days=rng.randint(0, 365)))
+        for party in party_rows
+        for _ in range(records)
+    ])
+
+    # payments go through the real allocation path so the ledger is sane
+    for party in party_rows:
+        for _ in range(payments):
+            payment = Payment.objects.create(
+                party=party, amount=Decimal(rng.randint(10, 400)),
+                payment_date=today - timedelta(days=rng.randint(0, 365)))
+            PaymentService.allocate_payment(payment)
+
+    advance_parties = party_rows[:advances]
+    for party in advance_parties:
+        due = sum(
+            (r.outstanding for r in Record.objects.filter(
+                party=party, outstanding__gt=0)),
+            Decimal('0.00'))
+        payment = Payment.objects.create(
+            party=party, amount=due + Decimal(rng.randint(50, 500)))
+        PaymentService.allocate_payment(payment)
+
+    AuditLog.objects.bulk_create([
+        AuditLog(user=owner, party_id=party_id, object_id=payment_id,
+                 model_name='Payment', action='UPDATE',
+                 before={'amount': str(amount)},
+                 after={'amount': str(amount)})
+        for payment_id, party_id, amount in Payment.objects.filter(
+            party__user=owner).values_list('pk', 'party_id', 'amount')
+    ])
+
+    request_parties = party_rows[advances:] or party_rows
+    for i in range(requests):
+        party = request_parties[i % len(request_parties)]
+        open_records = list(Record.objects.filter(
+            party=party, outstanding__gt=0
+        ).exclude(payment_request__status='P')[:3])
+        if not open_records:
+            continue
+        pr = Payment_Request.objects.create(
+            created_by=staff,
+            requested_amount=sum(r.outstanding for r in open_records))
+        pr.record.set(open_records)
+
+    PartyBalanceService.rebuild(Party.objects.filter(user=owner))
+    MonthlyRollupService.rebuild(Party.objects.filter(user=owner))
+    return Tenant(owner, staff, party_rows, advance_parties)
+
+
+# the benchmark's own cache: runs start cold without flushing CACHE_URL,
+# which may be a redis or memcached shared with the deployment
+BENCHMARK_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'history-benchmark',
+    },
+}
+
+
+@contextmanager
+def cold_cache():
+    with override_settings(CACHES=BENCHMARK_CACHES):
+        cache.clear()
+        yield
+
+
+def measure(fn, repeat=1):
+    """
+    Runs fn once traced for queries and peak memory, then `repeat` more
+    times untraced for the wall time (median, in ms). Every run gets an
+    empty private cache, so the timings are cold like the query count and
+    the summary and count caches don't turn them into cache hits.
+    """
+    with cold_cache():
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                result = fn()
+            # read now: the next request_started clears the query log
+            query_count = len(queries.captured_queries)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        with cold_cache():
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1000)
+
+    return result, {
+        'queries': query_count,
+        'ms': round(statistics.median(timings), 2) if timings else None,
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def endpoint_cases(tenant, page_size=20):
+    # (name, user, url, params) for every route in history/urls.py
+    party = tenant.parties[-1]
+    record = Record.objects.filter(party__user=tenant.owner).first()
+    payment = Payment.objects.filter(party__user=tenant.owner).first()
+    paged = {'page_size': page_size}
+
+    cases = [
+        ('party-list', tenant.owner, reverse('party-list'), paged),
+        ('party-detail', tenant.owner,
+         reverse('party-detail', args=[party.pk]), {}),
+        ('work-rate-list', tenant.owner, reverse('work-rate-list'), paged),
+        ('service-type-list', tenant.owner,
+         reverse('service-type-list'), {}),
+        ('record-list', tenant.owner, reverse('record-list'), paged),
+        ('record-list-cursor', tenant.owner, reverse('record-list'),
+         {**paged, 'cursor': ''}),
+        ('payment-list', tenant.owner, reverse('payment-list'), paged),
+        ('advance-ledger-list', tenant.owner,
+         reverse('advance-ledger-list'), paged),
+        ('audit-log-list', tenant.owner, reverse('audit-log-list'), paged),
+        ('request-payment-list', tenant.owner,
+         reverse('request-payment-list'), paged),
+        ('request-payment-eligible-records', tenant.staff,
+         reverse('request-payment-eligible-records'), {}),
+    ]
+    if record:
+        cases.append(('record-detail', tenant.owner,
+                      reverse('record-detail', args=[record.pk]), {}))
+    if payment:
+        cases.append(('payment-detail', tenant.owner,
+                      reverse('payment-detail', args=[payment.pk]), {}))
+
+    for data_type in ['record', 'payment', 'advance_ledger', 'audit_log']:
+        cases.append((f'summary-{data_type}', tenant.owner, reverse('summary'),
+                      {**paged, 'type': data_type}))
+    return cases
+
+
+def run_endpoints(tenant, page_size=20, repeat=1):
+    client = APIClient()
+    results = []
+    for name, user, url, params in endpoint_cases(tenant, page_size):
+        client.force_authenticate(user=user)
+        response, stats = measure(
+            lambda: client.get(url, params, secure=True), repeat)
+        results.append({'name': name, 'kind': 'endpoint',
+                        'status': response.status_code, **stats})
+    client.force_authenticate(user=None)
+    return results
+
+
+def rolled_back(fn):
+    # service paths write; undo them so every run sees the same tenant
+    def run():
+        with transaction.atomic():
+            result = fn()
+            transaction.set_rollback(True)
+        return result
+    return run
+
+
+def service_cases(tenant):
+    owner_records = Record.objects.filter(party__user=tenant.owner)
+    open_party = next(
+        (p for p in tenant.parties if p not in tenant.advance_parties),
+        tenant.parties[0])
+    advance_party = (tenant.advance_parties or tenant.parties)[0]
+
+    def allocate_payment():
+        payment = Payment.objects.create(
+            party=open_party, amount=Decimal('500.00'))
+        PaymentService.allocate_payment(payment)
+
+    def apply_advance():
+        record = Record.objects.create(
+            party=advance_party, service_type=owner_records[0].service_type,
+            pcs=3, rate=Decimal('10.00'))
+        RecordService.apply_advance(record)
+
+    def rollback_record():
+        record = owner_records.filter(paid_amount__gt=0).order_by('pk').first()
+        if record:
+            RecordService.rollback(record)
+
+    def rollback_payment():
+        payment = Payment.objects.filter(
+            party__user=tenant.owner).order_by('pk').first()
+        if payment:
+            PaymentService.rollback_payment(payment)
+
+    def rebuild_balances():
+        PartyBalanceService.rebuild(
+            Party.objects.filter(user=tenant.owner), dry_run=True)
+
+    def rebuild_rollups():
+        MonthlyRollupService.rebuild(Party.objects.filter(user=tenant.owner))
+
+    return [
+        ('PaymentService.allocate_payment', allocate_payment),
+        ('RecordService.apply_advance', apply_advance),
+        ('RecordService.rollback', rollback_record),
+        ('PaymentService.rollback_payment', rollback_payment),
+        ('PartyBalanceService.rebuild', rebuild_balances),
+        ('MonthlyRollupService.rebuild', rebuild_rollups),
+    ]
+
+
+def serializer_cases(tenant):
+    # (endpoint, serializer, queryset) as the list views read them
+    return [
+        ('record', RecordSerializer, Record.objects.filter(
+            party__user=tenant.owner
+        ).select_related('party', 'service_type')),
+        ('payment', PaymentSerializer, Payment.objects.filter(
+            party__user=tenant.owner).select_related('party')),
+        ('advance-ledger', AdvanceLedgerSerializer,
+         AdvanceLedger.objects.filter(party__user=tenant.owner).select_related(
+             'party', 'payment__party', 'record__party',
+             'record__service_type')),
+    ]
+
+
+def run_serializers(tenant, rows=1000, repeat=1):
+    """
+    Rows/second for each hot list, through the DRF serializer on model
+    instances and through the RowMapper on .values() rows. Both variants
+    include the query, so the numbers are what a list request pays.
+    """
+    results = []
+    for name, serializer_class, queryset in serializer_cases(tenant):
+        queryset = queryset.order_by('-pk')[:rows]
+        mapper = mapper_for(serializer_class)
+        variants = [
+            ('serializer', lambda: serializer_class(queryset, many=True).data),
+            ('row-mapper', lambda: mapper.map(queryset.values(*mapper.lookups))),
+        ]
+        for variant, fn in variants:
+            data, stats = measure(fn, max(repeat, 1))
+            seconds = stats['ms'] / 1000
+            results.append({
+                'name': f'{name}-{variant}', 'kind': 'serializer',
+                'rows': len(data),
+                'rows_per_s': round(len(data) / seconds) if seconds else None,
+                **stats,
+            })
+    return results
+
+
+def run_services(tenant, repeat=1):
+    results = []
+    for name, fn in service_cases(tenant):
+        _, stats = measure(rolled_back(fn), repeat)
+        results.append({'name': name, 'kind': 'service', **stats})
+    return results
@@ -2,7 +2,41 @@ from django_filters.rest_framework import FilterSet, filters
 from .models import *
 
 
+def search_term(value):
+    # Party.search_key is lower-cased with single spaces between parts
+    return ' '.join(value.lower().split())
+
+
+class PartySearchFilterSet(FilterSet):
+    """
+    ?q= (name, logo or number) and the party__* filters match the owner's
+    parties in a subquery, and the rows are filtered on that id set
+    instead of joining Party and LIKE-scanning it per row.
+    """
+    party_field = 'party'
+
+    q = filters.CharFilter(field_name='search_key', method='filter_party')
+
+    def filter_party(self, queryset, name, value):
+        if name == 'search_key':
+            lookup = {'search_key__contains': search_term(value)}
+        else:
+            lookup = {f'{name}__icontains': value}
+
+        parties = Party.objects.filter(**lookup)
+        user = getattr(self.request, 'user', None)
+        if user is not None and user.is_authenticated:
+            # one owner's parties, through the user_id index
+            parties = parties.filter(user_id=user.parent_id or user.pk)
+
+        # a subquery, not a list: a short q can match thousands of parties
+        return queryset.filter(
+            **{f'{self.party_field}__in': parties.order_by().values('pk')})
+
+
 class PartyFilter(FilterSet):
+    q = filters.CharFilter(method='filter_q')
+
     logo = filters.CharFilter(
         field_name='logo',
         lookup_expr='icontains'
@@ -26,21 +60,24 @@ class PartyFilter(FilterSet):
             'logo'
         ]
 
+    def filter_q(self, queryset, name, value):
+        return queryset.filter(search_key__contains=search_term(value))
 
-class WorkRateFilter(FilterSet):
+
+class WorkRateFilter(PartySearchFilterSet):
     party__logo = filters.CharFilter(
-        field_name='party__logo',
-        lookup_expr='icontains'
+        field_name='logo',
+        method='filter_party'
     )
 
     party__first_name = filters.CharFilter(
-        field_name='party__first_name',
-        lookup_expr='icontains'
+        field_name='first_name',
+        method='filter_party'
     )
 
     party__last_name = filters.CharFilter(
-        field_name='party__last_name',
-        lookup_expr='icontains'
+        field_name='last_name',
+        method='filter_party'
     )
 
     class Meta:
@@ -48,21 +85,21 @@ class WorkRateFilter(FilterSet):
         fields = []
 
 
-class RecordFilter(FilterSet):
+class RecordFilter(PartySearchFilterSet):
 
     party__logo = filters.CharFilter(
-        field_name='party__logo',
-        lookup_expr='icontains'
+        field_name='logo',
+        method='filter_party'
     )
 
     party__first_name = filters.CharFilter(
-        field_name='party__first_name',
-        lookup_expr='icontains'
+        field_name='first_name',
+        method='filter_party'
     )
 
     party__last_name = filters.CharFilter(
-        field_name='party__last_name',
-        lookup_expr='icontains'
+        field_name='last_name',
+        method='filter_party'
     )
 
     service_type__type_of_work = filters.CharFilter(
@@ -83,21 +120,21 @@ class RecordFilter(FilterSet):
         ]
 
 
-class PaymentFilter(FilterSet):
+class PaymentFilter(PartySearchFilterSet):
 
     party__logo = filters.CharFilter(
-        field_name='party__logo',
-        lookup_expr='icontains'
+        field_name='logo',
+        method='filter_party'
     )
 
     party__first_name = filters.CharFilter(
-        field_name='party__first_name',
-        lookup_expr='icontains'
+        field_name='first_name',
+        method='filter_party'
     )
 
     party__last_name = filters.CharFilter(
-        field_name='party__last_name',
-        lookup_expr='icontains'
+        field_name='last_name',
+        method='filter_party'
     )
 
     date_range = filters.DateFromToRangeFilter(
@@ -111,21 +148,22 @@ class PaymentFilter(FilterSet):
         ]
 
 
-class AllocationFilter(FilterSet):
+class AllocationFilter(PartySearchFilterSet):
+    party_field = 'payment__party'
 
     payment__party__logo = filters.CharFilter(
-        field_name='payment__party__logo',
-        lookup_expr='icontains'
+        field_name='logo',
+        method='filter_party'
     )
 
     payment__party__first_name = filters.CharFilter(
-        field_name='payment__party__first_name',
-        lookup_expr='icontains'
+        field_name='first_name',
+        method='filter_party'
     )
 
     payment__party__last_name = filters.CharFilter(
-        field_name='payment__party__last_name',
-        lookup_expr='icontains'
+        field_name='last_name',
+        method='filter_party'
     )
 
     payment = filters.NumberFilter(
@@ -148,21 +186,21 @@ class AllocationFilter(FilterSet):
         ]
 
 
-class AdvanceLedgerFilter(FilterSet):
+class AdvanceLedgerFilter(PartySearchFilterSet):
 
     party__logo = filters.CharFilter(
-        field_name='party__logo',
-        lookup_expr='icontains'
+        field_name='logo',
+        method='filter_party'
     )
 
     party__first_name = filters.CharFilter(
-        field_name='party__first_name',
-        lookup_expr='icontains'
+        field_name='first_name',
+        method='filter_party'
     )
 
     party__last_name = filters.CharFilter(
-        field_name='party__last_name',
-        lookup_expr='icontains'
+        field_name='last_name',
+        method='filter_party'
     )
 
     direction = filters.CharFilter(
@@ -190,10 +228,10 @@ class AdvanceLedgerFilter(FilterSet):
     #     )
 
 
-class AuditLogFilter(FilterSet):
+class AuditLogFilter(PartySearchFilterSet):
     party__logo = filters.CharFilter(
-        field_name='party__logo',
-        lookup_expr='icontains'
+        field_name='logo',
+        method='filter_party'
     )
 
     model_name = filters.CharFilter(
@@ -207,13 +245,13 @@ class AuditLogFilter(FilterSet):
     )
 
     party__first_name = filters.CharFilter(
-        field_name='party__first_name',
-        lookup_expr='icontains'
+        field_name='first_name',
+        method='filter_party'
     )
 
     party__last_name = filters.CharFilter(
-        field_name='party__last_name',
-        lookup_expr='icontains'
+        field_name='last_name',
+        method='filter_party'
     )
 
     created_at_range = filters.DateFromToRangeFilter(
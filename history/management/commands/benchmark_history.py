@@ -0,0 +1,85 @@
+import json
+import platform
+from datetime import datetime
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from history import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Seed a synthetic tenant, drive every history endpoint and '
+            'service path, and write query counts, timings and memory to JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--parties', type=int, default=20)
+        parser.add_argument('--records', type=int, default=50,
+                            help='Records per party.')
+        parser.add_argument('--payments', type=int, default=5,
+                            help='Payments per party.')
+        parser.add_argument('--advances', type=int, default=3,
+                            help='Parties left with an advance balance.')
+        parser.add_argument('--requests', type=int, default=5,
+                            help='Pending payment requests.')
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Timed runs per case; the median is kept.')
+        parser.add_argument('--rows', type=int, default=1000,
+                            help='Rows per list in the serializer cases.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='history-benchmark.json')
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Commit the seeded tenant instead of rolling it back.'
+        )
+
+    def handle(self, *args, **options):
+        sizes = {
+            key: options[key]
+            for key in ['parties', 'records', 'payments', 'advances', 'requests']
+        }
+
+        # the api client talks to "testserver" over plain settings, and
+        # nothing the run caches may land in the deployment's cache
+        with override_settings(ALLOWED_HOSTS=['*'],
+                               CACHES=benchmark.BENCHMARK_CACHES), \
+                transaction.atomic():
+            tenant = benchmark.seed_tenant(seed=options['seed'], **sizes)
+            results = benchmark.run_endpoints(
+                tenant, options['page_size'], options['repeat'])
+            results += benchmark.run_services(tenant, options['repeat'])
+            results += benchmark.run_serializers(
+                tenant, options['rows'], options['repeat'])
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+        report = {
+            'meta': {
+                'vendor': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'started_at': datetime.now().isoformat(timespec='seconds'),
+                'page_size': options['page_size'],
+                'rows': options['rows'],
+                'repeat': options['repeat'],
+                'seed': options['seed'],
+                'sizes': sizes,
+            },
+            'results': results,
+        }
+        with open(options['output'], 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+        for row in results:
+            line = (f"{row['name']:<40} {row['queries']:>5} queries "
+                    f"{row['ms']:>9} ms {row['peak_kb']:>9} KiB")
+            if 'rows_per_s' in row:
+                line += f" {row['rows_per_s']:>9} rows/s"
+            self.stdout.write(line)
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(results)} cases on {connection.vendor}, "
+            f"written to {options['output']}"))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from history.models import Party
+from history.service import MonthlyRollupService
+
+
+class Command(BaseCommand):
+    help = 'Rebuild MonthlyRollup rows from the raw records.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--party',
+            type=int,
+            action='append',
+            dest='party_ids',
+            help='Only rebuild this party id (can be repeated).'
+        )
+
+    def handle(self, *args, **options):
+        parties = Party.objects.all()
+        if options['party_ids']:
+            parties = parties.filter(pk__in=options['party_ids'])
+
+        written = MonthlyRollupService.rebuild(parties)
+        self.stdout.write(self.style.SUCCESS(
+            f'{parties.count()} parties rebuilt, {written} rollup rows written.'))
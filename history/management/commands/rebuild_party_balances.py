@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from history.models import Party
+from history.service import PartyBalanceService
+
+
+class Command(BaseCommand):
+    help = 'Rebuild PartyBalance rows from the ledger and report any drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--party',
+            type=int,
+            action='append',
+            dest='party_ids',
+            help='Only rebuild this party id (can be repeated).'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report drift without writing anything.'
+        )
+
+    def handle(self, *args, **options):
+        parties = Party.objects.all()
+        if options['party_ids']:
+            parties = parties.filter(pk__in=options['party_ids'])
+
+        drift = PartyBalanceService.rebuild(
+            parties, dry_run=options['dry_run'])
+
+        for party_id, field, stored, actual in drift:
+            self.stdout.write(
+                f'party {party_id}: {field} stored={stored} actual={actual}')
+
+        drifted_parties = len({row[0] for row in drift})
+        verb = 'would be fixed' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{parties.count()} parties checked, {drifted_parties} {verb}.'))
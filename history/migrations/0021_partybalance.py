@@ -0,0 +1,25 @@
+# Generated by Django 6.0 on 2026-10-18 09:12
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0020_remove_payment_request_party'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PartyBalance',
+            fields=[
+                ('party', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance', serialize=False, to='history.party')),
+                ('due', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('advance', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('open_records', models.PositiveIntegerField(default=0)),
+                ('last_activity', models.DateField(blank=True, null=True)),
+            ],
+        ),
+    ]
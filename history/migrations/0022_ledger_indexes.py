@@ -0,0 +1,45 @@
+# Generated by Django 6.0 on 2026-10-18 09:40
+
+import django.db.models.expressions
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0021_partybalance'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='outstanding',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('pcs'), '*', models.F('rate')), '-', models.F('discount')), '-', models.F('paid_amount')), output_field=models.DecimalField(decimal_places=2, max_digits=20)),
+        ),
+        migrations.AddIndex(
+            model_name='advanceledger',
+            index=models.Index(condition=models.Q(('direction', 'IN'), ('remaining_amount__gt', 0)), fields=['party', 'created_at'], name='advance_open_in_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='advanceledger',
+            index=models.Index(fields=['payment', 'direction'], name='advance_payment_direction_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='allocation',
+            index=models.Index(fields=['payment', 'record'], name='allocation_payment_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='allocation',
+            index=models.Index(fields=['record', 'payment'], name='allocation_record_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment_request',
+            index=models.Index(condition=models.Q(('status', 'P')), fields=['created_by'], name='payment_request_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(condition=models.Q(('outstanding__gt', 0)), fields=['party', 'record_date', 'id'], name='record_unpaid_fifo_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-18 09:40
+
+import django.db.models.expressions
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0022_ledger_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='amount',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.expressions.CombinedExpression(models.F('rate'), '*', models.F('pcs')), output_field=models.DecimalField(decimal_places=2, max_digits=20)),
+        ),
+    ]
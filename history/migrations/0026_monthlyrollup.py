@@ -0,0 +1,81 @@
+# Generated by Django 6.0 on 2026-10-18 09:40
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import TruncMonth
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def backfill_rollups(apps, schema_editor):
+    # same grouping as MonthlyRollupService.rebuild, so existing tenants
+    # see their totals straight after deploy instead of zeros
+    Party = apps.get_model('history', 'Party')
+    Record = apps.get_model('history', 'Record')
+    MonthlyRollup = apps.get_model('history', 'MonthlyRollup')
+
+    gross = ExpressionWrapper(
+        F('rate') * F('pcs'),
+        output_field=DecimalField(max_digits=20, decimal_places=2))
+    party_ids = list(Party.objects.order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(party_ids), BACKFILL_BATCH_SIZE):
+        batch = party_ids[start:start + BACKFILL_BATCH_SIZE]
+        groups = Record.objects.filter(party_id__in=batch).order_by().annotate(
+            month=TruncMonth('record_date')
+        ).values(
+            'party', 'party__user', 'service_type', 'month'
+        ).annotate(
+            total_pcs=Sum('pcs'),
+            total_amount=Sum(gross),
+            total_discount=Sum('discount'),
+            total_paid=Sum('paid_amount'),
+            record_count=Count('pk'),
+        )
+        MonthlyRollup.objects.bulk_create([
+            MonthlyRollup(
+                owner_id=g['party__user'],
+                party_id=g['party'],
+                service_type_id=g['service_type'],
+                month=g['month'],
+                pcs=g['total_pcs'],
+                amount=g['total_amount'],
+                discount=g['total_discount'],
+                paid=g['total_paid'],
+                record_count=g['record_count'],
+            )
+            for g in groups
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0025_ledgerversion_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('pcs', models.PositiveBigIntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=20)),
+                ('discount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=20)),
+                ('paid', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=20)),
+                ('record_count', models.PositiveIntegerField(default=0)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('party', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='history.party')),
+                ('service_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='history.service_type')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', 'month'], name='rollup_owner_month_idx')],
+                'constraints': [models.UniqueConstraint(fields=('party', 'service_type', 'month'), name='unique_monthly_rollup')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 6.0 on 2026-10-18 09:40
+
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_trigram_index(apps, schema_editor):
+    # ?q= is a substring match, which only a trigram index can serve;
+    # elsewhere it reads the owner's parties through the user_id index
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS party_search_trgm_idx '
+        'ON history_party USING gin (search_key gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS party_search_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0026_monthlyrollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='party',
+            name='search_key',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.text.Lower(django.db.models.functions.text.Concat('first_name', models.Value(' '), 'last_name', models.Value(' '), 'logo', models.Value(' '), 'number')), output_field=models.TextField()),
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
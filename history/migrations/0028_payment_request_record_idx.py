@@ -0,0 +1,24 @@
+# Generated by Django 6.0 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0027_party_search_key'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='payment_request',
+            name='payment_request_pending_idx',
+        ),
+        # the pending-request lookups go record -> request through the
+        # auto-created M2M table, which Meta.indexes can't reach
+        migrations.RunSQL(
+            'CREATE INDEX payment_request_record_lookup_idx '
+            'ON history_payment_request_record (record_id, payment_request_id)',
+            'DROP INDEX payment_request_record_lookup_idx',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 09:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0028_payment_request_record_idx'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='record',
+            old_name='amount',
+            new_name='gross_amount',
+        ),
+    ]
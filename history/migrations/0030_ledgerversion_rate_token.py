@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0029_rename_record_amount_gross_amount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ledgerversion',
+            name='rate_token',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
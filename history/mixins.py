@@ -0,0 +1,151 @@
+import csv
+import hashlib
+import json
+from datetime import date
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.timezone import localdate
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.response import Response
+
+from .models import LedgerVersion
+from .pagination import params_digest
+from .rows import mapper_for
+
+
+class ConditionalGetMixin:
+    """
+    ETag for list and retrieve, answered before anything is serialized. The
+    validator is the owner's ledger version (bumped by every ledger and
+    party write, admin included) plus the user, path and query params.
+    No Last-Modified: it only has whole seconds, so a second write in the
+    same second would still get a 304.
+    """
+
+    def get_etag(self, request):
+        user = request.user
+        version = LedgerVersion.current(user.parent_id or user.pk)
+
+        raw = f'{request.path}:{user.pk}:{version}:{params_digest(request)}'
+        return f'"{hashlib.md5(raw.encode()).hexdigest()}"'
+
+    def conditional(self, request, respond):
+        etag = self.get_etag(request)
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = respond()
+            if response.status_code != status.HTTP_200_OK:
+                return response
+
+        response['ETag'] = etag
+        # keep browsers revalidating instead of reusing a stale page
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(
+            request, lambda: super(ConditionalGetMixin, self).list(
+                request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        # fetch first so a 304 never skips the object permission check
+        instance = self.get_object()
+        return self.conditional(
+            request, lambda: Response(self.get_serializer(instance).data))
+
+
+class FastListMixin:
+    """
+    list() from .values() rows run through a RowMapper compiled from
+    list_serializer, instead of one serializer instance per row. The JSON
+    is the same; retrieve and writes keep the normal serializers.
+    """
+    list_serializer = None
+
+    def list(self, request, *args, **kwargs):
+        mapper = mapper_for(self.list_serializer)
+        queryset = self.filter_queryset(self.get_queryset())
+
+        # keyset pagination reads its ordering columns off the last row
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        extra = [
+            'id' if name == 'pk' else name
+            for name in (field.lstrip('-') for field in ordering
+                         if isinstance(field, str))
+        ]
+        rows = queryset.values(*dict.fromkeys([*mapper.lookups, *extra, 'id']))
+
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(mapper.map(page))
+        return Response(mapper.map(rows))
+
+
+class Echo:
+    # csv.writer wants a file; hand each formatted line straight back
+    def write(self, value):
+        return value
+
+
+class CsvRenderer(BaseRenderer):
+    # lets "Accept: text/csv" negotiate; the export itself is streamed
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return json.dumps(data, cls=DjangoJSONEncoder).encode()
+
+
+def csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, cls=DjangoJSONEncoder)
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@'):
+        # keep spreadsheets from running user text as a formula
+        return "'" + value
+    return value
+
+
+class CsvExportMixin:
+    """
+    GET <list>/export/ streams the filtered list as CSV. Rows come from a
+    values() query read with .iterator(), so memory stays flat however many
+    rows match. Views set export_fields and export_joins (alias -> expr).
+    """
+    export_name = 'export'
+    export_fields = ()
+    export_joins = {}
+    export_chunk_size = 2000
+
+    def export_rows(self, queryset):
+        return queryset.values(
+            *self.export_fields, **self.export_joins
+        ).iterator(chunk_size=self.export_chunk_size)
+
+    @action(detail=False, methods=['get'],
+            renderer_classes=[JSONRenderer, CsvRenderer])
+    def export(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = self.export_rows(queryset)
+        columns = [*self.export_fields, *self.export_joins]
+        writer = csv.writer(Echo())
+
+        def stream():
+            yield writer.writerow(columns)
+            for row in rows:
+                yield writer.writerow([csv_cell(row[c]) for c in columns])
+
+        response = StreamingHttpResponse(stream(), content_type='text/csv')
+        response['Content-Disposition'] = (
+            f'attachment; filename="{self.export_name}-{localdate()}.csv"')
+        return response
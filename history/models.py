@@ -1,9 +1,11 @@
+import uuid
 from django.db import models
 from django.utils.timezone import now
 from decimal import Decimal
 from django.conf import settings
 from django.utils.timezone import localdate
-from django.db.models import Sum, F, DecimalField, ExpressionWrapper
+from django.db.models import Sum, F, Q, Value
+from django.db.models.functions import Concat, Lower
 from decimal import Decimal
 
 
@@ -21,6 +23,15 @@ class Party(models.Model):
                                     blank=True, null=True,
                                     on_delete=models.SET_NULL,
                                     related_name='employ')
+    # lower-cased name, logo and number in one column for ?q= search; on
+    # PostgreSQL it carries a trigram GIN index (migration 0027)
+    search_key = models.GeneratedField(
+        expression=Lower(Concat(
+            'first_name', Value(' '), 'last_name', Value(' '),
+            'logo', Value(' '), 'number')),
+        output_field=models.TextField(),
+        db_persist=True,
+    )
 
     @property
     def owner(self):
@@ -36,11 +47,7 @@ class Party(models.Model):
             return computed_due
 
         current = self.record_set.aggregate(
-            total=Sum(ExpressionWrapper(
-                (F('rate') * F('pcs')) - F('discount') - F('paid_amount'),
-                output_field=DecimalField()
-            )
-            )
+            total=Sum('outstanding')
         )['total'] or Decimal('0.00')
 
         if current < 0:
@@ -65,6 +72,72 @@ class Party(models.Model):
         ordering = ['first_name', 'last_name']
 
 
+class PartyBalance(models.Model):
+    party = models.OneToOneField(
+        Party,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='balance'
+    )
+    due = models.DecimalField(
+        max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    advance = models.DecimalField(
+        max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    open_records = models.PositiveIntegerField(default=0)
+    last_activity = models.DateField(null=True, blank=True)
+
+    def __str__(self) -> str:
+        return f'{self.party} | {self.due} | {self.advance}'
+
+
+class LedgerVersion(models.Model):
+    # bumped inside every ledger write transaction; caches key on it
+    owner = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='ledger_version'
+    )
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=now)
+    # replaced on every Work_Rate write; the rate cache keys on it. random
+    # rather than a counter so a rolled back write can't hand its number on
+    rate_token = models.CharField(max_length=32, blank=True, default='')
+
+    @classmethod
+    def current(cls, owner_id):
+        return cls.objects.filter(owner_id=owner_id).values_list(
+            'version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls, owner_id):
+        bumped = cls.objects.filter(owner_id=owner_id).update(
+            version=F('version') + 1, updated_at=now())
+        if not bumped:
+            _, created = cls.objects.get_or_create(
+                owner_id=owner_id, defaults={'version': 1})
+            if not created:
+                cls.objects.filter(owner_id=owner_id).update(
+                    version=F('version') + 1, updated_at=now())
+
+    @classmethod
+    def current_rate_token(cls, owner_id):
+        return cls.objects.filter(owner_id=owner_id).values_list(
+            'rate_token', flat=True).first() or ''
+
+    @classmethod
+    def new_rate_token(cls, owner_id):
+        token = uuid.uuid4().hex
+        if not cls.objects.filter(owner_id=owner_id).update(rate_token=token):
+            _, created = cls.objects.get_or_create(
+                owner_id=owner_id, defaults={'rate_token': token})
+            if not created:
+                cls.objects.filter(owner_id=owner_id).update(rate_token=token)
+
+    def __str__(self) -> str:
+        return f'{self.owner_id} | {self.version}'
+
+
 class Service_Type(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
@@ -107,10 +180,33 @@ class Record(models.Model):
         max_digits=10, decimal_places=2, default=Decimal("0.00"))
     paid_amount = models.DecimalField(
         max_digits=10, decimal_places=2, default=Decimal('0.00'))
+    # stored columns so filters and aggregates don't rebuild the expression
+    # per row; "unpaid" becomes the indexable predicate outstanding > 0
+    gross_amount = models.GeneratedField(
+        expression=F('rate') * F('pcs'),
+        output_field=models.DecimalField(max_digits=20, decimal_places=2),
+        db_persist=True,
+    )
+    outstanding = models.GeneratedField(
+        expression=F('pcs') * F('rate') - F('discount') - F('paid_amount'),
+        output_field=models.DecimalField(max_digits=20, decimal_places=2),
+        db_persist=True,
+    )
 
     def __str__(self):
         return f'{self.party} | {self.service_type} | {self.pcs} | {self.rate} | {self.record_date}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # the rollup signal also refreshes the month a record moved out of
+        instance.loaded_record_date = instance.__dict__.get('record_date')
+        return instance
+
+    @property
+    def amount(self):
+        return (self.rate * self.pcs)
+
     @property
     def remaining_amount(self):
         return (self.pcs*self.rate - self.discount) - self.paid_amount
@@ -119,10 +215,6 @@ class Record(models.Model):
     def owner(self):
         return self.party.user
 
-    @property
-    def amount(self):
-        return (self.rate * self.pcs)
-
     def apply_payment(self, amount):
         self.paid_amount = F("paid_amount") + amount
         self.save(update_fields=["paid_amount"])
@@ -136,6 +228,45 @@ class Record(models.Model):
         permissions = [
             ('cancel_record', 'can cancel record')
         ]
+        indexes = [
+            models.Index(
+                fields=['party', 'record_date', 'id'],
+                condition=Q(outstanding__gt=0),
+                name='record_unpaid_fifo_idx'
+            ),
+        ]
+
+
+class MonthlyRollup(models.Model):
+    # totals of the records dated in one month, per party and service type
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL,
+                              on_delete=models.CASCADE, related_name='+')
+    party = models.ForeignKey(Party, on_delete=models.CASCADE)
+    service_type = models.ForeignKey(Service_Type, on_delete=models.CASCADE)
+    month = models.DateField()  # first day of the month
+    pcs = models.PositiveBigIntegerField(default=0)
+    amount = models.DecimalField(
+        max_digits=20, decimal_places=2, default=Decimal('0.00'))
+    discount = models.DecimalField(
+        max_digits=20, decimal_places=2, default=Decimal('0.00'))
+    paid = models.DecimalField(
+        max_digits=20, decimal_places=2, default=Decimal('0.00'))
+    record_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f'{self.party_id} | {self.service_type_id} | {self.month:%Y-%m}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['party', 'service_type', 'month'],
+                name='unique_monthly_rollup'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['owner', 'month'],
+                         name='rollup_owner_month_idx'),
+        ]
 
 
 class Payment(models.Model):
@@ -162,6 +293,14 @@ class Allocation(models.Model):
     def __str__(self):
         return f'{self.record} | {self.amount} | {self.payment}'
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['payment', 'record'],
+                         name='allocation_payment_idx'),
+            models.Index(fields=['record', 'payment'],
+                         name='allocation_record_idx'),
+        ]
+
 
 class AdvanceLedger(models.Model):
     party = models.ForeignKey(
@@ -202,6 +341,15 @@ class AdvanceLedger(models.Model):
 
     class Meta:
         ordering = ['-pk']
+        indexes = [
+            models.Index(
+                fields=['party', 'created_at'],
+                condition=Q(direction='IN', remaining_amount__gt=0),
+                name='advance_open_in_idx'
+            ),
+            models.Index(fields=['payment', 'direction'],
+                         name='advance_payment_direction_idx'),
+        ]
 
 
 class AuditLog(models.Model):
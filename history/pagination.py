@@ -1,7 +1,278 @@
+import base64
+import hashlib
+import json
+from datetime import date, datetime
+from functools import partial
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import Q
+from .models import LedgerVersion
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+COUNT_EXACT = 'exact'
+COUNT_CACHED = 'cached'
+COUNT_ESTIMATE = 'estimate'
+
+COUNT_CACHE_TIMEOUT = 60 * 10
+
+# query params that only move through the list, not change what is counted
+PAGING_PARAMS = {'page', 'page_size', 'cursor', 'count'}
+
+
+def params_digest(request, skip=()):
+    params = sorted(
+        (key, value)
+        for key, values in request.query_params.lists()
+        if key not in skip
+        for value in values
+    )
+    return hashlib.md5(json.dumps(params).encode()).hexdigest()
+
+
+def ledger_cache_key(prefix, request, skip=()):
+    # keyed on the owner's ledger version, so any ledger write moves every
+    # cached entry for that owner (and their staff) out of the way at once
+    user = request.user
+    owner_id = user.parent_id or user.pk
+    version = LedgerVersion.current(owner_id)
+    return f'{prefix}:{owner_id}:{version}:{user.pk}:{params_digest(request, skip)}'
+
+
+def count_cache_key(queryset, request):
+    return ledger_cache_key(
+        f'count:{queryset.model._meta.label_lower}', request, PAGING_PARAMS)
+
+
+def planner_estimate(queryset):
+    # reltuples-style estimate straight from the planner, postgres only
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count_rows(queryset, request, mode=COUNT_EXACT):
+    # returns (count, mode actually used). estimate only applies to
+    # unfiltered lists and falls back to the cached count otherwise.
+    if mode == COUNT_ESTIMATE:
+        filtered = set(request.query_params) - PAGING_PARAMS
+        estimate = None if filtered else planner_estimate(queryset)
+        if estimate is not None:
+            return estimate, COUNT_ESTIMATE
+        mode = COUNT_CACHED
+
+    if mode == COUNT_CACHED and request.user.is_authenticated:
+        key = count_cache_key(queryset, request)
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, COUNT_CACHE_TIMEOUT)
+        return count, COUNT_CACHED
+
+    return queryset.count(), COUNT_EXACT
+
+
+class CountedPage(Page):
+
+    def __init__(self, object_list, number, paginator, more):
+        super().__init__(object_list, number, paginator)
+        self.more = more
+
+    def has_next(self):
+        return self.more
+
+
+class CountedPaginator(Paginator):
+    # takes a count worked out elsewhere. it may be an estimate, so page
+    # bounds come from the rows actually fetched, not from the count.
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count = count
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage(self.error_messages['no_results'])
+        more = len(rows) > self.per_page
+        return CountedPage(rows[:self.per_page], number, self, more)
+
+    def validate_number(self, number):
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages['invalid_page'])
+        if number < 1:
+            raise EmptyPage(self.error_messages['less_than_one'])
+        return number
 
 
 class NormalPagination(PageNumberPagination):
     page_size = 20
     max_page_size = 1000
     page_size_query_param = 'page_size'
+
+    # views pick a strategy with count_mode = COUNT_CACHED / COUNT_ESTIMATE
+    def paginate_queryset(self, queryset, request, view=None):
+        mode = getattr(view, 'count_mode', COUNT_EXACT)
+        if mode == COUNT_EXACT:
+            self.count_mode = COUNT_EXACT
+            self.django_paginator_class = Paginator
+        else:
+            count, self.count_mode = count_rows(queryset, request, mode)
+            self.django_paginator_class = partial(
+                CountedPaginator, count=count)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        response.data['count_mode'] = self.count_mode
+        return response
+
+
+# keyset helpers: a cursor is the ordering values of the last row served,
+# so the next page is a range read on the index instead of an OFFSET scan.
+
+def encode_cursor(values):
+    values = [
+        v.isoformat() if isinstance(v, (date, datetime)) else v
+        for v in values
+    ]
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def ordering_fields(model, ordering):
+    # the model field behind each ordering name, following relations
+    fields = []
+    for name in ordering:
+        opts, field = model._meta, None
+        for part in name.lstrip('-').split('__'):
+            field = opts.pk if part == 'pk' else opts.get_field(part)
+            if field.is_relation:
+                opts = field.related_model._meta
+        fields.append(field)
+    return fields
+
+
+def decode_cursor(token, fields):
+    # anything that doesn't turn back into one value per ordering field is
+    # a 400, never a 500 from the query
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(fields):
+            raise ValueError
+        if any(v is None or isinstance(v, (dict, list)) for v in values):
+            raise ValueError
+        return [field.to_python(v) for field, v in zip(fields, values)]
+    except (ValueError, TypeError, DjangoValidationError):
+        raise ValidationError({'cursor': 'Invalid cursor.'})
+
+
+def keyset_filter(ordering, values):
+    # (a, b) > (x, y) spelled out as a OR-chain so it works on every backend
+    condition = Q()
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        step = Q(**{f'{name}__{lookup}': values[i]})
+        for prev_field, prev_value in zip(ordering[:i], values[:i]):
+            step &= Q(**{prev_field.lstrip('-'): prev_value})
+        condition |= step
+    return condition
+
+
+def keyset_page(queryset, ordering, cursor, page_size):
+    # returns (rows, next_cursor). works on instances and .values() dicts.
+    if cursor:
+        values = decode_cursor(
+            cursor, ordering_fields(queryset.model, ordering))
+        queryset = queryset.filter(keyset_filter(ordering, values))
+
+    rows = list(queryset.order_by(*ordering)[:page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+
+    rows = rows[:page_size]
+    last = rows[-1]
+    names = [field.lstrip('-') for field in ordering]
+    if isinstance(last, dict):
+        values = [last['id' if name == 'pk' else name] for name in names]
+    else:
+        values = [getattr(last, name) for name in names]
+    return rows, encode_cursor(values)
+
+
+def wants_count(request):
+    return request.query_params.get('count', '').lower() not in ('0', 'false', 'no')
+
+
+class LedgerPagination(NormalPagination):
+    # page numbers by default; ?cursor= (empty for the first page) switches
+    # to keyset paging on the queryset ordering, ?count=false skips COUNT(*)
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.use_cursor = self.cursor_query_param in request.query_params
+        if not self.use_cursor:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.count = self.count_mode = None
+        if wants_count(request):
+            self.count, self.count_mode = count_rows(
+                queryset, request, getattr(view, 'count_mode', COUNT_EXACT))
+        rows, self.next_cursor = keyset_page(
+            queryset,
+            self.get_ordering(queryset),
+            request.query_params[self.cursor_query_param],
+            self.get_page_size(request),
+        )
+        return rows
+
+    def get_ordering(self, queryset):
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        if not {'pk', 'id', '-pk', '-id'} & set(ordering):
+            ordering.append('-pk')
+        return ordering
+
+    def get_next_link(self):
+        if not self.use_cursor:
+            return super().get_next_link()
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.next_cursor
+        )
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return super().get_paginated_response(data)
+
+        return Response({
+            'count': self.count,
+            'next': self.get_next_link(),
+            'next_cursor': self.next_cursor,
+            'results': data,
+            'count_mode': self.count_mode,
+        })
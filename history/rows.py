@@ -0,0 +1,89 @@
+"""
+Read path for the hot list endpoints that skips serializer instances.
+
+A RowMapper walks a serializer's readable fields once and keeps a flat list
+of slots: which .values() lookup feeds each key, and that field's own
+to_representation. Mapping a row is then a loop over the slots, with no
+model instances, bound fields or get_attribute() per cell, and the JSON
+comes out exactly as serializer.data would have it.
+"""
+from functools import lru_cache
+
+from rest_framework import serializers
+
+from .models import Record
+from .serializer import PartyMiniSerializer
+
+VALUE, NESTED, COMPUTED = range(3)
+
+# SerializerMethodFields have no column behind them; these say which
+# columns they read and how to build the value from them
+COMPUTED_FIELDS = {
+    (PartyMiniSerializer, 'full_name'): (
+        ('first_name', 'last_name'),
+        lambda first_name, last_name: f'{first_name} {last_name}',
+    ),
+}
+
+
+# Python properties that have a stored column with the same value
+STORED_COLUMNS = {
+    (Record, 'amount'): 'gross_amount',
+}
+
+
+class RowMapper:
+    __slots__ = ('lookups', 'slots')
+
+    def __init__(self, serializer_class):
+        self.lookups = []
+        self.slots = self.compile(serializer_class(), '')
+
+    def column(self, lookup):
+        if lookup not in self.lookups:
+            self.lookups.append(lookup)
+        return lookup
+
+    def compile(self, serializer, prefix):
+        slots = []
+        model = serializer.Meta.model
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            source = prefix + STORED_COLUMNS.get(
+                (model, field.source), field.source).replace('.', '__')
+
+            if isinstance(field, serializers.BaseSerializer):
+                # the FK column doubles as the "is there an object" check
+                slots.append((name, NESTED, self.column(source),
+                              self.compile(field, source + '__')))
+            elif isinstance(field, serializers.SerializerMethodField):
+                columns, build = COMPUTED_FIELDS[type(serializer), name]
+                slots.append((name, COMPUTED, [
+                    self.column(prefix + column) for column in columns
+                ], build))
+            else:
+                slots.append((name, VALUE, self.column(source),
+                              field.to_representation))
+        return slots
+
+    def build(self, slots, row):
+        data = {}
+        for name, kind, source, convert in slots:
+            if kind == VALUE:
+                value = row[source]
+                data[name] = None if value is None else convert(value)
+            elif kind == NESTED:
+                data[name] = None if row[source] is None else self.build(convert, row)
+            else:
+                data[name] = convert(*[row[column] for column in source])
+        return data
+
+    def map(self, rows):
+        slots = self.slots
+        return [self.build(slots, row) for row in rows]
+
+
+@lru_cache(maxsize=None)
+def mapper_for(serializer_class):
+    return RowMapper(serializer_class)
@@ -2,9 +2,13 @@ from rest_framework import serializers
 from django.utils.timezone import timedelta, localdate
 from .models import *
 from django.contrib.auth import get_user_model
-from django.db.models import F, ExpressionWrapper, DecimalField, Exists, OuterRef
+from django.db.models import F, Exists, OuterRef, Window
+from django.db.models.functions import RowNumber
+from collections import defaultdict
+from decimal import Decimal
 from  core.serializers import UserMiniSerializer
 from .utils.audit import calculate_changes
+from .utils.rates import lookup_rate
 
 
 class PartySerializer(serializers.ModelSerializer):
@@ -253,17 +257,15 @@ class BaseRecordSerializer(serializers.ModelSerializer):
         rate_mode = validated_data.pop("rate_mode")
 
         if rate_mode == "system":
-            work_rate = Work_Rate.objects.filter(
-                party=validated_data["party"],
-                service_type=validated_data["service_type"],
-            ).first()
+            rate = lookup_rate(
+                validated_data["party"], validated_data["service_type"])
 
-            if not work_rate:
+            if rate is None:
                 raise serializers.ValidationError({
                     "rate": "This party doesn't have a rate tied to this service."
                 })
 
-            validated_data["rate"] = work_rate.rate
+            validated_data["rate"] = rate
 
         return super().create(validated_data)
     
@@ -303,6 +305,35 @@ class RecordCreateSerializer(BaseRecordSerializer):
             raise serializers.ValidationError('Not you Party')
         return values
 
+class RecordImportRowSerializer(serializers.Serializer):
+    # one row of a bulk import; party / service / rate are resolved by the
+    # import service from maps it loads once per chunk
+    party_id = serializers.IntegerField()
+    service_type_id = serializers.IntegerField()
+    pcs = serializers.IntegerField(min_value=1)
+    rate = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=0, required=False,
+        allow_null=True)
+    discount = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=0, required=False,
+        default=Decimal('0.00'))
+    rate_mode = serializers.ChoiceField(
+        choices=['system', 'manual'], required=False, default='system')
+    record_date = serializers.DateField(required=False, default=localdate)
+
+    def to_internal_value(self, data):
+        # blank csv cells mean "not given"
+        data = {key: value for key, value in data.items() if value != ''}
+        return super().to_internal_value(data)
+
+    def validate(self, attrs):
+        if attrs['rate_mode'] == 'manual' and attrs.get('rate') is None:
+            raise serializers.ValidationError({
+                'rate': 'Rate is required when rate mode is manual.'
+            })
+        return attrs
+
+
 class RecordUpdateSerializer(BaseRecordSerializer):
 
     reason = serializers.CharField(
@@ -315,6 +346,29 @@ class RecordUpdateSerializer(BaseRecordSerializer):
         fields = ['rate', 'pcs', 'discount', 'reason']
 
 
+class RecordBulkDeleteSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=1000)
+
+
+class RecordBulkUpdateSerializer(RecordBulkDeleteSerializer):
+    # the same correction applied to every listed record
+    rate = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=0, required=False)
+    pcs = serializers.IntegerField(min_value=1, required=False)
+    discount = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=0, required=False)
+    reason = serializers.CharField(max_length=255, required=False)
+
+    def validate(self, attrs):
+        if not {'rate', 'pcs', 'discount'} & set(attrs):
+            raise serializers.ValidationError(
+                'Give at least one of rate, pcs or discount.')
+        return attrs
+
+
 class BasePaymentSerializer(serializers.ModelSerializer):
     party = PartyMiniSerializer(read_only=True)
     party_id = serializers.PrimaryKeyRelatedField(
@@ -352,6 +406,16 @@ class PaymentSerializer(BasePaymentSerializer):
         fields = ['id', 'party', 'amount', 'payment_date', 'party_id']
 
 
+class PaymentBulkEntrySerializer(BasePaymentSerializer):
+    # one entry of payment/bulk/; the party is checked against a map the
+    # service loads once for the whole batch
+    party_id = serializers.IntegerField()
+
+    class Meta:
+        model = Payment
+        fields = ['party_id', 'amount', 'payment_date']
+
+
 class PaymentUpdateSerializer(BasePaymentSerializer):
     reason = serializers.CharField(
         max_length=255,
@@ -423,6 +487,45 @@ class BasePaymentRequestSerilizer(serializers.ModelSerializer):
 
         return attrs
 
+def ranked_parties():
+    # the position under Party.Meta.ordering comes from the db, so the
+    # collation and NULL placement are the db's, not python's
+    return Party.objects.annotate(
+        ordering_rank=Window(
+            RowNumber(), order_by=[*Party._meta.ordering, 'pk']))
+
+
+def sorted_parties(parties):
+    # parties loaded through ranked_parties(), as the request list prefetches
+    return sorted(parties, key=lambda p: p.ordering_rank)
+
+
+class PaymentRequestListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        requests = list(data.all() if hasattr(data, 'all') else data)
+
+        # one grouped query for the page when records weren't prefetched
+        missing = [
+            pr for pr in requests
+            if 'record' not in getattr(pr, '_prefetched_objects_cache', {})
+        ]
+        if missing:
+            by_request = defaultdict(dict)
+            parties = Party.objects.filter(
+                record__payment_request__in=missing
+            ).annotate(
+                request_id=F('record__payment_request')
+            ).order_by(*Party._meta.ordering, 'pk')
+            # dicts keep the first-seen order, which is the db's
+            for party in parties:
+                by_request[party.request_id].setdefault(party.pk, party)
+            for pr in missing:
+                pr._parties = list(by_request[pr.pk].values())
+
+        return super().to_representation(requests)
+
+
 class PaymentRequestSerializer(BasePaymentRequestSerilizer):
     created_by = UserMiniSerializer(read_only=True)
     record = RecordSerializer(read_only=True, many=True)
@@ -430,13 +533,22 @@ class PaymentRequestSerializer(BasePaymentRequestSerilizer):
     parties = serializers.SerializerMethodField()
 
     def get_parties(self, obj):
-        # distinct parties from all records
-        parties = Party.objects.filter(
-            record__payment_request=obj
-        ).distinct()
+        parties = getattr(obj, '_parties', None)
+        if parties is None:
+            records = getattr(obj, '_prefetched_objects_cache', {}).get('record')
+            if records is not None and all(
+                    hasattr(r.party, 'ordering_rank') for r in records):
+                # records (and their ranked party) are already in memory
+                parties = sorted_parties(
+                    {r.party_id: r.party for r in records}.values())
+            else:
+                parties = Party.objects.filter(
+                    record__payment_request=obj
+                ).distinct()
         return PartyMiniSerializer(parties, many=True).data
 
     class Meta:
+        list_serializer_class = PaymentRequestListSerializer
         model = Payment_Request
         fields = ['id', 'created_by', 'record', 'parties',
                   'requested_amount', 'created_at', 'status', 'rejected_reason']
@@ -465,11 +577,7 @@ class PaymentRequestCreateSerializer(BasePaymentRequestSerilizer):
         else:
             base_qs = Record.objects.filter(party__user=user)
 
-        base_qs = base_qs.annotate(
-            not_paid=ExpressionWrapper((F('rate') * F('pcs')) -
-                                       F('discount') - F('paid_amount'),
-                                       output_field=DecimalField())
-        ).filter(not_paid__gt=0)
+        base_qs = base_qs.filter(outstanding__gt=0)
 
         owner = user.parent if user.parent else user
 
@@ -1,22 +1,345 @@
+from datetime import timedelta
+from decimal import Decimal
+from django.db import transaction
+from django.utils.timezone import localdate, now
+from collections import defaultdict
 from .models import *
 from .serializer import *
-from django.db.models import F, ExpressionWrapper, DecimalField
+from .utils.importers import chunked
+from .utils.rates import rate_map
+from django.db.models import (
+    F, DecimalField, Case, When, Value, Sum, Count, Max, Q,
+    OuterRef, Subquery,
+)
+from django.db.models.functions import TruncMonth
+
+# keeps the CASE ... WHEN list and its parameters well under the backend limits
+PAID_UPDATE_BATCH_SIZE = 400
+REBUILD_BATCH_SIZE = 500
+IMPORT_CHUNK_SIZE = 500
+
+
+def month_after(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+class AllocationCursor:
+    # the party's unpaid records, fetched once ordered by (record_date, pk)
+    # and consumed in memory. every write is buffered until flush().
+
+    def __init__(self, party, exclude=(), records=None):
+        if records is None:
+            records = Record.objects.filter(
+                party=party,
+                outstanding__gt=0
+            ).exclude(
+                pk__in=[getattr(r, 'pk', r) for r in exclude]
+            ).order_by('record_date', 'pk')
+
+        self.party = party
+        self.records = list(records)
+        self.position = 0
+        self.skip = set()
+        self.paid = defaultdict(Decimal)
+        self.months = set()  # rollup months to refresh beyond the paid ones
+        self.allocations = []
+        self.ledger_entries = []
+        self.advance_credits = defaultdict(Decimal)
+
+    def take(self, amount):
+        # hand out `amount` oldest record first.
+        # returns [(record, share), ...] and whatever could not be placed.
+        splits = []
+        remaining = amount
+
+        while remaining > 0 and self.position < len(self.records):
+            record = self.records[self.position]
+            due = record.remaining_amount
+            if due <= 0 or record.pk in self.skip:
+                self.position += 1
+                continue
+
+            share = min(due, remaining)
+            record.paid_amount += share
+            self.paid[record.pk] += share
+            splits.append((record, share))
+            remaining -= share
+
+        return splits, remaining
+
+    def allocate(self, payment, amount):
+        splits, remaining = self.take(amount)
+        self.allocations.extend(
+            Allocation(payment=payment, record=record, amount=share)
+            for record, share in splits
+        )
+        return remaining
+
+    def spend_advance(self, payment, amount):
+        splits, remaining = self.take(amount)
+        self.ledger_entries.extend(
+            AdvanceLedger(
+                party=self.party,
+                payment=payment,
+                record=record,
+                amount=share,
+                remaining_amount=0,
+                direction='OUT'
+            )
+            for record, share in splits
+        )
+        return remaining
+
+    def add_advance(self, payment, amount):
+        self.ledger_entries.append(AdvanceLedger(
+            party=self.party,
+            payment=payment,
+            record=None,
+            amount=amount,
+            remaining_amount=amount,
+            direction='IN'
+        ))
+
+    def credit_advance(self, payment_id, amount):
+        # give money back to the payment's existing IN entries
+        self.advance_credits[payment_id] += amount
+
+    def flush(self):
+        # credits first: they belong to the IN entries that already existed,
+        # not to ones this cursor is about to create for the same payment
+        for payment_id, amount in self.advance_credits.items():
+            AdvanceLedger.objects.filter(
+                payment_id=payment_id,
+                party=self.party,
+                direction='IN'
+            ).update(remaining_amount=F('remaining_amount') + amount)
+
+        Allocation.objects.bulk_create(self.allocations)
+        AdvanceLedger.objects.bulk_create(self.ledger_entries)
+        RecordService.bulk_apply_payments(self.paid)
+        months = self.months | {
+            record.record_date for record in self.records
+            if record.pk in self.paid
+        }
+        if months:
+            MonthlyRollupService.refresh(self.party.pk, months)
+
+        self.paid = defaultdict(Decimal)
+        self.months = set()
+        self.allocations = []
+        self.ledger_entries = []
+        self.advance_credits = defaultdict(Decimal)
+
+
+class LedgerReplay(AllocationCursor):
+    # replays RecordService.rollback / adjust_after_update for several
+    # records of one party in memory, one after the other, then writes the
+    # net result. money moved onto a record that is handled later in the
+    # same replay moves again, just as it would one request at a time.
+
+    def __init__(self, party, targets):
+        target_ids = [record.pk for record in targets]
+        super().__init__(party, records=Record.objects.filter(
+            Q(outstanding__gt=0) | Q(pk__in=target_ids),
+            party=party,
+        ).order_by('record_date', 'pk'))
+
+        self.by_pk = {record.pk: record for record in self.records}
+        self.paid_before = {
+            record.pk: record.paid_amount for record in self.records}
+        self.removed = set()
+        self.adjusted = set()
+
+        # per target record: its allocations and OUT entries, oldest first
+        self.held = defaultdict(list)
+        self.spent = defaultdict(list)
+        for row in Allocation.objects.filter(
+                record__in=target_ids).select_related('payment').order_by('pk'):
+            self.held[row.record_id].append(row)
+
+        self.advances = []  # the party's IN entries, in spending order
+        for row in AdvanceLedger.objects.filter(
+            Q(direction='IN') | Q(direction='OUT', record__in=target_ids),
+            party=party,
+        ).select_related('payment').order_by('created_at', 'pk'):
+            if row.direction == 'IN':
+                self.advances.append(row)
+            else:
+                self.spent[row.record_id].append(row)
+
+        self.changed = {}
+        self.dropped = {Allocation: [], AdvanceLedger: []}
+
+    def allocate(self, payment, amount):
+        start = len(self.allocations)
+        remaining = super().allocate(payment, amount)
+        for row in self.allocations[start:]:
+            self.held[row.record.pk].append(row)
+        return remaining
+
+    def spend_advance(self, payment, amount):
+        start = len(self.ledger_entries)
+        remaining = super().spend_advance(payment, amount)
+        for row in self.ledger_entries[start:]:
+            self.spent[row.record.pk].append(row)
+        return remaining
+
+    def add_advance(self, payment, amount):
+        super().add_advance(payment, amount)
+        self.advances.append(self.ledger_entries[-1])
+
+    def credit_advance(self, payment_id, amount):
+        for row in self.advances:
+            if row.payment_id == payment_id:
+                row.remaining_amount += amount
+                self.touch(row)
+
+    def touch(self, row):
+        if row.pk:
+            self.changed[type(row), row.pk] = row
+
+    def drop(self, row):
+        if row.pk:
+            self.changed.pop((type(row), row.pk), None)
+            self.dropped[type(row)].append(row.pk)
+        elif isinstance(row, Allocation):
+            self.allocations.remove(row)
+        else:
+            self.ledger_entries.remove(row)
+
+    def begin(self, record):
+        # every request built a fresh cursor without the record in hand
+        self.position = 0
+        self.skip = self.removed | {record.pk}
+
+    def rollback(self, record):
+        # RecordService.rollback, then the record is deleted
+        self.begin(record)
+        record.paid_amount = Decimal('0.00')
+
+        for row in reversed(self.spent.pop(record.pk, [])):
+            remaining = self.spend_advance(row.payment, row.amount)
+            if remaining > 0:
+                self.credit_advance(row.payment_id, remaining)
+            self.drop(row)
+
+        for row in self.held.pop(record.pk, []):
+            RecordService._reallocate_to_unpaid_or_advance(
+                cursor=self, payment=row.payment, amount=row.amount)
+            self.drop(row)
+
+        self.removed.add(record.pk)
+
+    def adjust(self, record, pcs, rate, discount):
+        # RecordService.adjust_after_update, then the new values are saved
+        self.begin(record)
+        new_amount = rate * pcs - discount
+
+        if new_amount >= record.paid_amount:
+            self.use_advances(record, new_amount - record.paid_amount)
+        else:
+            surplus = record.paid_amount - new_amount
+
+            for row in reversed(list(self.spent[record.pk])):
+                if surplus <= 0:
+                    break
+                refund = min(surplus, row.amount)
+                self.credit_advance(row.payment_id, refund)
+                self.shrink(self.spent[record.pk], row, refund)
+                surplus -= refund
+
+            for row in reversed(list(self.held[record.pk])):
+                if surplus <= 0:
+                    break
+                refund = min(surplus, row.amount)
+                RecordService._reallocate_to_unpaid_or_advance(
+                    cursor=self, payment=row.payment, amount=refund)
+                self.shrink(self.held[record.pk], row, refund)
+                surplus -= refund
+
+            record.paid_amount = min(record.paid_amount, new_amount)
+
+        record.pcs, record.rate, record.discount = pcs, rate, discount
+        self.adjusted.add(record.pk)
+
+    def shrink(self, rows, row, amount):
+        if amount == row.amount:
+            rows.remove(row)
+            self.drop(row)
+        else:
+            row.amount -= amount
+            self.touch(row)
+
+    def use_advances(self, record, needed):
+        # RecordService._apply_advances_to_record
+        for entry in self.advances:
+            if needed <= 0:
+                break
+            if entry.remaining_amount <= 0:
+                continue
+
+            used = min(needed, entry.remaining_amount)
+            row = AdvanceLedger(
+                party=self.party,
+                payment=entry.payment,
+                record=record,
+                amount=used,
+                remaining_amount=0,
+                direction='OUT'
+            )
+            self.ledger_entries.append(row)
+            self.spent[record.pk].append(row)
+
+            entry.remaining_amount -= used
+            self.touch(entry)
+            record.paid_amount += used
+            needed -= used
+
+    def touched_months(self):
+        return {
+            record.record_date for record in self.records
+            if record.pk in self.removed or record.pk in self.adjusted
+            or record.paid_amount != self.paid_before[record.pk]
+        }
+
+    def flush(self):
+        for model, pks in self.dropped.items():
+            model.objects.filter(pk__in=pks).delete()
+        changed = list(self.changed.values())
+        Allocation.objects.bulk_update(
+            [row for row in changed if isinstance(row, Allocation)],
+            ['amount'])
+        AdvanceLedger.objects.bulk_update(
+            [row for row in changed if isinstance(row, AdvanceLedger)],
+            ['amount', 'remaining_amount'])
+        Allocation.objects.bulk_create(self.allocations)
+        AdvanceLedger.objects.bulk_create(self.ledger_entries)
+
+        RecordService.bulk_apply_payments({
+            pk: record.paid_amount - self.paid_before[pk]
+            for pk, record in self.by_pk.items() if pk not in self.removed
+        })
+        Record.objects.bulk_update(
+            [self.by_pk[pk] for pk in self.adjusted if pk not in self.removed],
+            ['pcs', 'rate', 'discount'])
 
 
 class RecordService:
 
     @staticmethod
-    def _next_unpaid_record(party, exclude_record):
-        return Record.objects.filter(
-            party=party
-        ).exclude(
-            pk=exclude_record.pk
-        ).filter(
-            paid_amount__lt=ExpressionWrapper(
-                F('pcs') * F('rate') - F('discount'),
-                output_field=DecimalField()
+    def bulk_apply_payments(deltas):
+        # deltas: {record_id: amount}; negative amounts reverse a payment.
+        # one UPDATE per batch instead of one apply_payment() per record.
+        deltas = [(pk, amount) for pk, amount in deltas.items() if amount]
+
+        for start in range(0, len(deltas), PAID_UPDATE_BATCH_SIZE):
+            batch = deltas[start:start + PAID_UPDATE_BATCH_SIZE]
+            Record.objects.filter(pk__in=[pk for pk, _ in batch]).update(
+                paid_amount=F('paid_amount') + Case(
+                    *[When(pk=pk, then=Value(amount)) for pk, amount in batch],
+                    output_field=DecimalField(max_digits=10, decimal_places=2)
+                )
             )
-        ).order_by('record_date', 'pk').first()
 
     @staticmethod
     def _apply_advances_to_record(record, amount_needed):
@@ -50,96 +373,81 @@ class RecordService:
             record.apply_payment(used)
             remaining -= used
 
-    @staticmethod
-    def _reallocate_to_unpaid_or_advance(party, exclude_record, payment, amount):
-        remaining = amount
-
-        while remaining > 0:
-            unpaid = RecordService._next_unpaid_record(party, exclude_record)
-            if not unpaid:
-                break
-
-            amount_to_alocate = min(unpaid.remaining_amount, remaining)
-            if amount_to_alocate <= 0:
-                break
+        if remaining != amount_needed:
+            MonthlyRollupService.refresh(record.party_id, [record.record_date])
 
-            Allocation.objects.create(
-                payment=payment,
-                record=unpaid,
-                amount=amount_to_alocate
-            )
-            unpaid.apply_payment(amount_to_alocate)
-            remaining -= amount_to_alocate
+    @staticmethod
+    def _reallocate_to_unpaid_or_advance(cursor, payment, amount):
+        remaining = cursor.allocate(payment, amount)
 
         if remaining > 0:
-            AdvanceLedger.objects.create(
-                party=party,
-                payment=payment,
-                record=None,
-                amount=remaining,
-                remaining_amount=remaining,
-                direction='IN'
-            )
+            cursor.add_advance(payment, remaining)
 
     @staticmethod
     def apply_advance(record):
         RecordService._apply_advances_to_record(
             record, record.remaining_amount)
 
+    @staticmethod
+    def apply_advance_to_records(party, records):
+        # one FIFO pass of the party's open advance over new records,
+        # instead of apply_advance() once per record
+        entries = list(AdvanceLedger.objects.filter(
+            party=party,
+            direction='IN',
+            remaining_amount__gt=0
+        ).select_related('payment').order_by('created_at'))
+        if not entries:
+            return
+
+        cursor = AllocationCursor(party, records=sorted(
+            records, key=lambda r: (r.record_date, r.pk)))
+
+        changed = []
+        for entry in entries:
+            left = cursor.spend_advance(entry.payment, entry.remaining_amount)
+            if left != entry.remaining_amount:
+                entry.remaining_amount = left
+                changed.append(entry)
+            if left > 0:
+                break
+
+        cursor.flush()
+        AdvanceLedger.objects.bulk_update(changed, ['remaining_amount'])
+
     @staticmethod
     def rollback(record):
         party = record.party
+        cursor = AllocationCursor(party, exclude=[record])
 
         if record.paid_amount > 0:
             record.reverse_payment(record.paid_amount)
             record.refresh_from_db(fields=["paid_amount"])
+            cursor.months.add(record.record_date)
 
         advanceledger_qs = list(AdvanceLedger.objects.filter(
-            record=record, direction='OUT'))
+            record=record, direction='OUT').select_related('payment'))
 
         for ledger in advanceledger_qs:
-            remaining = ledger.amount
-
-            while remaining > 0:
-                unpaid = RecordService._next_unpaid_record(party, record)
-                if not unpaid:
-                    break
-
-                amount_to_alocate = min(unpaid.remaining_amount, remaining)
-                if amount_to_alocate <= 0:
-                    break
-
-                AdvanceLedger.objects.create(
-                    party=party,
-                    payment=ledger.payment,
-                    record=unpaid,
-                    amount=amount_to_alocate,
-                    remaining_amount=0,
-                    direction='OUT'
-                )
-                unpaid.apply_payment(amount_to_alocate)
-                remaining -= amount_to_alocate
+            remaining = cursor.spend_advance(ledger.payment, ledger.amount)
 
             if remaining > 0:
-                AdvanceLedger.objects.filter(
-                    payment=ledger.payment,
-                    party=party,
-                    direction='IN'
-                ).update(
-                    remaining_amount=F('remaining_amount') + remaining
-                )
+                cursor.credit_advance(ledger.payment_id, remaining)
 
-            ledger.delete()
-
-        allocation_qs = list(Allocation.objects.filter(record=record))
+        allocation_qs = list(Allocation.objects.filter(
+            record=record).select_related('payment').order_by('pk'))
         for row in allocation_qs:
             RecordService._reallocate_to_unpaid_or_advance(
-                party=party,
-                exclude_record=record,
+                cursor=cursor,
                 payment=row.payment,
                 amount=row.amount
             )
-            row.delete()
+
+        AdvanceLedger.objects.filter(
+            pk__in=[ledger.pk for ledger in advanceledger_qs]).delete()
+        Allocation.objects.filter(
+            pk__in=[row.pk for row in allocation_qs]).delete()
+        cursor.flush()
 
     @staticmethod
     def adjust_after_update(record, new_data):
@@ -189,6 +497,7 @@ class RecordService:
         if surplus > 0:
             allocations = Allocation.objects.filter(
                 record=record).order_by('-id')
+            cursor = AllocationCursor(record.party, exclude=[record])
 
             for alloc in allocations:
                 if surplus <= 0:
@@ -196,8 +505,7 @@ class RecordService:
 
                 refund_alloc = min(surplus, alloc.amount)
                 RecordService._reallocate_to_unpaid_or_advance(
-                    party=record.party,
-                    exclude_record=record,
+                    cursor=cursor,
                     payment=alloc.payment,
                     amount=refund_alloc
                 )
@@ -210,171 +518,600 @@ class RecordService:
 
                 surplus -= refund_alloc
 
+            cursor.flush()
+
         record.refresh_from_db(fields=["paid_amount"])
         delta = record.paid_amount - new_amount
         if delta > 0:
             record.reverse_payment(delta)
+            MonthlyRollupService.refresh(record.party_id, [record.record_date])
 
     @staticmethod
-    def cleanup_pending_requests_for_deleted_record(record):
-        pending_requests = Payment_Request.objects.filter(
-            status='P',
-            record=record
-        ).distinct()
+    def bulk_delete(records):
+        # same end state as rollback() + delete() per record, in this order,
+        # with one replay and one round of writes per party
+        by_party = defaultdict(list)
+        for record in records:
+            by_party[record.party].append(record)
+
+        months = {}
+        for party, group in by_party.items():
+            replay = LedgerReplay(party, group)
+            for record in group:
+                replay.rollback(replay.by_pk[record.pk])
+            replay.flush()
+            months[party] = replay.touched_months()
+
+        record_ids = [record.pk for record in records]
+        links = Payment_Request.record.through.objects.filter(
+            record__in=record_ids,
+            payment_request__status='P'
+        )
+        request_ids = list(links.values_list('payment_request_id', flat=True))
+        links.delete()
+        PaymentRequestService.recompute_pending(
+            Payment_Request.objects.filter(pk__in=request_ids))
 
-        for pr in pending_requests:
-            pr.record.remove(record)
+        Record.objects.filter(pk__in=record_ids).delete()
+        for party, touched in months.items():
+            MonthlyRollupService.refresh(party.pk, touched)
+        return list(by_party)
 
-            if not pr.record.exists():
-                pr.delete()
-            else:
-                pr.requested_amount = sum(
-                    r.remaining_amount for r in pr.record.all())
-                pr.save(update_fields=['requested_amount'])
+    @staticmethod
+    def bulk_update(records, changes):
+        # same end state as adjust_after_update() + save per record, in
+        # this order. changes: pcs / rate / discount applied to every record.
+        by_party = defaultdict(list)
+        for record in records:
+            by_party[record.party].append(record)
+
+        for party, group in by_party.items():
+            replay = LedgerReplay(party, group)
+            for record in group:
+                record = replay.by_pk[record.pk]
+                replay.adjust(
+                    record,
+                    pcs=changes.get('pcs', record.pcs),
+                    rate=changes.get('rate', record.rate),
+                    discount=changes.get('discount', record.discount),
+                )
+            replay.flush()
+            MonthlyRollupService.refresh(party.pk, replay.touched_months())
+
+        PaymentRequestService.recompute_pending(Payment_Request.objects.filter(
+            record__in=[record.pk for record in records]))
+        return list(by_party)
+
+    @staticmethod
+    def cleanup_pending_requests_for_deleted_record(record):
+        links = Payment_Request.record.through.objects.filter(
+            record=record,
+            payment_request__status='P'
+        )
+        request_ids = list(links.values_list('payment_request_id', flat=True))
+        links.delete()
+
+        PaymentRequestService.recompute_pending(
+            Payment_Request.objects.filter(pk__in=request_ids))
 
     @staticmethod
     def sync_pending_request_amounts(record):
-        pending_requests = Payment_Request.objects.filter(
-            status='P',
-            record=record
-        ).distinct()
-
-        for pr in pending_requests:
-            pr.requested_amount = sum(
-                r.remaining_amount for r in pr.record.all()
-            )
-            pr.save(update_fields=['requested_amount'])
+        PaymentRequestService.recompute_pending(
+            Payment_Request.objects.filter(record=record))
 
 
 class PaymentService:
 
     @staticmethod
     def allocate_payment(payment):
-        remaining_payment = payment.amount
+        PaymentService._write_allocations(
+            payment, AllocationCursor(payment.party))
 
-        unpaid_records = Record.objects.filter(
-            party=payment.party,
-            paid_amount__lt=ExpressionWrapper(
-                F('pcs') * F('rate') - F('discount'),
-                output_field=DecimalField()
-            )
-        ).order_by('record_date')
+    @staticmethod
+    def allocate_payment_to_records(payment, records):
+        records = [r for r in records if r.party_id == payment.party_id]
+        PaymentService._write_allocations(
+            payment, AllocationCursor(payment.party, records=records))
 
-        for record in unpaid_records:
-            if remaining_payment <= 0:
-                break
+    @staticmethod
+    def _write_allocations(payment, cursor):
+        # the FIFO split is computed in memory, then written with one
+        # bulk_create and one batched paid_amount UPDATE.
+        remaining_payment = cursor.allocate(payment, payment.amount)
 
-            allocated = min(record.remaining_amount, remaining_payment)
+        if remaining_payment > 0:
+            cursor.add_advance(payment, remaining_payment)
 
-            Allocation.objects.create(
-                payment=payment,
-                amount=allocated,
-                record=record
-            )
+        cursor.flush()
 
-            record.apply_payment(allocated)
+    @staticmethod
+    def rollback_payment(payment):
+        # what the payment put on each record (allocations plus advance
+        # spent from it), summed per record and taken back with one
+        # batched UPDATE, then one DELETE per table
+        allocations = Allocation.objects.filter(payment=payment)
+        ledger = AdvanceLedger.objects.filter(payment=payment)
+
+        deltas = defaultdict(Decimal)
+        months = set()
+        for rows in (
+            allocations.values('record_id', 'record__record_date'),
+            ledger.filter(direction='OUT', record__isnull=False).values(
+                'record_id', 'record__record_date'),
+        ):
+            for row in rows.order_by().annotate(total=Sum('amount')):
+                deltas[row['record_id']] -= row['total']
+                months.add(row['record__record_date'])
+
+        RecordService.bulk_apply_payments(deltas)
+        allocations.delete()
+        ledger.delete()
+        MonthlyRollupService.refresh(payment.party_id, months)
 
-            remaining_payment -= allocated
+    @staticmethod
+    def bulk_create(user, entries):
+        """
+        entries: list of {party_id, amount, payment_date} dicts. valid ones
+        are created with one allocation pass and one request sync per
+        party; every entry gets a result, in the order given.
+        """
+        results, valid = [], []
+        for index, raw in enumerate(entries):
+            serializer = PaymentBulkEntrySerializer(data=raw)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                results.append({'index': index, 'errors': serializer.errors})
+
+        parties = Party.objects.filter(
+            user=user, pk__in={row['party_id'] for _, row in valid}
+        ).in_bulk()
+
+        payments = []
+        for index, row in valid:
+            party = parties.get(row['party_id'])
+            if party is None:
+                results.append({'index': index,
+                                'errors': {'party_id': ['Not you Party']}})
+                continue
+            payments.append((index, Payment(
+                party=party,
+                amount=row['amount'],
+                payment_date=row.get('payment_date', localdate()),
+            )))
+
+        with transaction.atomic():
+            Payment.objects.bulk_create([payment for _, payment in payments])
+
+            by_party = defaultdict(list)
+            for _, payment in payments:
+                by_party[payment.party].append(payment)
+
+            # each payment continues FIFO where the previous one stopped,
+            # as if they had been created one request at a time
+            for party, group in by_party.items():
+                cursor = AllocationCursor(party)
+                for payment in group:
+                    remaining = cursor.allocate(payment, payment.amount)
+                    if remaining > 0:
+                        cursor.add_advance(payment, remaining)
+                cursor.flush()
+                PaymentService.sync_pending_request_amounts_for_party(party)
+                LedgerService.after_write(party)
+
+        results += [
+            {'index': index, **PaymentSerializer(payment).data}
+            for index, payment in payments
+        ]
+        results.sort(key=lambda result: result['index'])
+        return {
+            'created': len(payments),
+            'failed': len(results) - len(payments),
+            'results': results,
+        }
 
-        if remaining_payment > 0:
-            AdvanceLedger.objects.create(
-                party=payment.party,
-                payment=payment,
-                amount=remaining_payment,
-                remaining_amount=remaining_payment,
-                direction='IN'
-            )
+    @staticmethod
+    def sync_pending_request_amounts_for_party(party):
+        PaymentRequestService.recompute_pending(
+            Payment_Request.objects.filter(record__party=party))
+    
+    @staticmethod
+    def create_payment(serializer):
+        payment = serializer.save()
+        PaymentService.allocate_payment(payment)
+        PaymentService.sync_pending_request_amounts_for_party(payment.party)
+        return payment
 
     @staticmethod
-    def allocate_payment_to_records(payment, records):
-        remaining_payment = payment.amount
+    def update_payment(serializer):
+        payment = serializer.save()
+        changed = PaymentService.reallocate(payment)
+        if changed:
+            PaymentRequestService.recompute_pending(
+                Payment_Request.objects.filter(record__in=changed))
+        return payment
 
+    @staticmethod
+    def reallocate(payment):
+        # the state rollback_payment() + allocate_payment() would leave,
+        # worked out in memory and written as a diff against the payment's
+        # current rows. returns the ids of records whose paid_amount moved.
+        allocations = list(
+            Allocation.objects.filter(payment=payment).order_by('pk'))
+        ledger = list(AdvanceLedger.objects.filter(
+            payment=payment).order_by('created_at', 'pk'))
+
+        # what the payment has on each record right now
+        taken = defaultdict(Decimal)
+        for row in allocations:
+            taken[row.record_id] += row.amount
+        for row in ledger:
+            if row.direction == 'OUT' and row.record_id:
+                taken[row.record_id] += row.amount
+
+        records = list(Record.objects.filter(
+            Q(outstanding__gt=0) | Q(pk__in=list(taken)),
+            party_id=payment.party_id,
+        ).order_by('record_date', 'pk'))
         for record in records:
-            if remaining_payment <= 0:
-                break
+            record.paid_amount -= taken.get(record.pk, 0)
+
+        cursor = AllocationCursor(payment.party, records=records)
+        splits, leftover = cursor.take(payment.amount)
+        target = {record.pk: share for record, share in splits}
+
+        deltas = {
+            pk: target.get(pk, 0) - taken.get(pk, 0)
+            for pk in {*taken, *target}
+        }
+        deltas = {pk: delta for pk, delta in deltas.items() if delta}
+
+        # one allocation per record survives, resized if needed
+        kept, changed, dropped = {}, [], []
+        for row in allocations:
+            if row.record_id in target and row.record_id not in kept:
+                kept[row.record_id] = row
+                if row.amount != target[row.record_id]:
+                    row.amount = target[row.record_id]
+                    changed.append(row)
+            else:
+                dropped.append(row.pk)
+        Allocation.objects.filter(pk__in=dropped).delete()
+        Allocation.objects.bulk_update(changed, ['amount'])
+        Allocation.objects.bulk_create([
+            Allocation(payment=payment, record_id=pk, amount=share)
+            for pk, share in target.items() if pk not in kept
+        ])
+
+        # a full rebuild leaves no OUT rows and at most one IN row
+        advance = next((row for row in ledger if row.direction == 'IN'), None)
+        if leftover <= 0:
+            advance = None
+        AdvanceLedger.objects.filter(
+            pk__in=[row.pk for row in ledger if row is not advance]).delete()
+        if advance is None and leftover > 0:
+            cursor.add_advance(payment, leftover)
+            AdvanceLedger.objects.bulk_create(cursor.ledger_entries)
+        elif advance:
+            # a rebuild re-creates the IN row, which moves it to the back
+            # of the party's FIFO; re-stamp it so it is spent in that order
+            advance.amount = advance.remaining_amount = leftover
+            advance.created_at = now()
+            advance.save(update_fields=['amount', 'remaining_amount', 'created_at'])
+
+        RecordService.bulk_apply_payments(deltas)
+        MonthlyRollupService.refresh(payment.party_id, {
+            record.record_date for record in records if record.pk in deltas
+        })
+        return list(deltas)
+
+
+class RecordImportService:
 
-            if record.party_id != payment.party_id:
-                continue
+    @staticmethod
+    def import_rows(user, rows, chunk_size=IMPORT_CHUNK_SIZE):
+        """
+        rows: iterable of (line, dict), read lazily. valid rows are created
+        chunk by chunk, invalid ones come back in the report.
+        """
+        errors = []
+        new_records = defaultdict(list)
+
+        with transaction.atomic():
+            # the rate token is read once per import, not once per chunk
+            rates = rate_map(user.pk)
+            for chunk in chunked(rows, chunk_size):
+                records = RecordImportService._build_chunk(
+                    user, chunk, rates, errors)
+                Record.objects.bulk_create(records)
+                for record in records:
+                    new_records[record.party_id].append(record)
+
+            for party_id, records in new_records.items():
+                party = records[0].party
+                MonthlyRollupService.refresh(
+                    party_id, {record.record_date for record in records})
+                RecordService.apply_advance_to_records(party, records)
+                LedgerService.after_write(party)
+
+        return {
+            'created': sum(len(records) for records in new_records.values()),
+            'failed': len(errors),
+            'errors': errors,
+        }
 
-            if record.remaining_amount <= 0:
+    @staticmethod
+    def _build_chunk(user, chunk, rates, errors):
+        valid = []
+        for line, raw in chunk:
+            if raw is None:
+                errors.append({'line': line, 'errors': {
+                    'non_field_errors': ['Row is not a JSON object.']}})
+                continue
+            serializer = RecordImportRowSerializer(data=raw)
+            if serializer.is_valid():
+                valid.append((line, serializer.validated_data))
+            else:
+                errors.append({'line': line, 'errors': serializer.errors})
+
+        # one lookup map each for the whole chunk
+        parties = Party.objects.filter(
+            user=user, pk__in={row['party_id'] for _, row in valid}
+        ).in_bulk()
+        services = Service_Type.objects.filter(
+            user=user, pk__in={row['service_type_id'] for _, row in valid}
+        ).in_bulk()
+
+        records = []
+        for line, row in valid:
+            row_errors = {}
+            party = parties.get(row['party_id'])
+            service = services.get(row['service_type_id'])
+            if party is None:
+                row_errors['party_id'] = [
+                    f'Invalid pk "{row["party_id"]}" - object does not exist.']
+            if service is None:
+                row_errors['service_type_id'] = [
+                    f'Invalid pk "{row["service_type_id"]}" - object does not exist.']
+
+            rate = row.get('rate')
+            if not row_errors and row['rate_mode'] == 'system':
+                rate = rates.get((party.pk, service.pk))
+                if rate is None:
+                    row_errors['rate'] = [
+                        "This party doesn't have a rate tied to this service."]
+
+            if not row_errors and row['discount'] > rate * row['pcs']:
+                row_errors['discount'] = [
+                    f"Discount cannot exceed {rate * row['pcs']}"]
+
+            if row_errors:
+                errors.append({'line': line, 'errors': row_errors})
                 continue
 
-            allocated = min(record.remaining_amount, remaining_payment)
+            records.append(Record(
+                party=party,
+                service_type=service,
+                pcs=row['pcs'],
+                rate=rate,
+                discount=row['discount'],
+                record_date=row['record_date'],
+                paid_amount=Decimal('0.00'),
+            ))
+        return records
 
-            Allocation.objects.create(
-                payment=payment,
-                amount=allocated,
-                record=record
-            )
 
-            record.apply_payment(allocated)
-            remaining_payment -= allocated
+class PaymentRequestService:
 
-        if remaining_payment > 0:
-            AdvanceLedger.objects.create(
-                party=payment.party,
-                payment=payment,
-                amount=remaining_payment,
-                remaining_amount=remaining_payment,
-                direction='IN'
-            )
+    @staticmethod
+    def recompute_pending(requests):
+        # re-totals every pending request in `requests` from its records'
+        # outstanding in one UPDATE, after dropping the ones left empty
+        pending = Payment_Request.objects.filter(
+            pk__in=requests.filter(status='P').values('pk'))
+
+        pending.filter(record__isnull=True).delete()
+
+        totals = Payment_Request.record.through.objects.filter(
+            payment_request=OuterRef('pk')
+        ).order_by().values('payment_request').annotate(
+            total=Sum('record__outstanding')
+        ).values('total')
+
+        pending.update(requested_amount=Subquery(totals))
+
+
+class PartyBalanceService:
+
+    BALANCE_FIELDS = ['due', 'advance', 'open_records', 'last_activity']
 
     @staticmethod
-    def rollback_payment(payment):
-        # 1) Undo allocations
-        allocation_qs = list(
-            Allocation.objects.select_related('record').filter(payment=payment)
+    def compute(party_ids):
+        # a handful of grouped aggregates, whatever the number of parties
+        balances = {
+            party_id: {
+                'due': Decimal('0.00'),
+                'advance': Decimal('0.00'),
+                'open_records': 0,
+                'last_activity': None,
+            }
+            for party_id in party_ids
+        }
+        if not balances:
+            return balances
+
+        record_rows = Record.objects.filter(
+            party_id__in=balances
+        ).order_by().values('party_id').annotate(
+            total=Sum('outstanding'),
+            open_records=Count('pk', filter=Q(outstanding__gt=0)),
+            last_record=Max('record_date'),
         )
+        for row in record_rows:
+            balance = balances[row['party_id']]
+            balance['due'] = max(row['total'] or Decimal('0.00'), Decimal('0.00'))
+            balance['open_records'] = row['open_records']
+            balance['last_activity'] = row['last_record']
+
+        advance_rows = AdvanceLedger.objects.filter(
+            party_id__in=balances,
+            direction='IN'
+        ).order_by().values('party_id').annotate(total=Sum('remaining_amount'))
+        for row in advance_rows:
+            balances[row['party_id']]['advance'] = row['total'] or Decimal('0.00')
+
+        payment_rows = Payment.objects.filter(
+            party_id__in=balances
+        ).order_by().values('party_id').annotate(last_payment=Max('payment_date'))
+        for row in payment_rows:
+            balance = balances[row['party_id']]
+            if balance['last_activity'] is None or row['last_payment'] > balance['last_activity']:
+                balance['last_activity'] = row['last_payment']
+
+        for balance in balances.values():
+            balance['due'] = balance['due'].quantize(Decimal('0.01'))
+            balance['advance'] = balance['advance'].quantize(Decimal('0.01'))
+
+        return balances
 
-        for allocation in allocation_qs:
-            record = allocation.record
-            record.reverse_payment(allocation.amount)
-            allocation.delete()
+    @staticmethod
+    def refresh(party):
+        # call inside the transaction that changed the party's ledger
+        party_id = getattr(party, 'pk', party)
+        values = PartyBalanceService.compute([party_id])[party_id]
+        PartyBalance.objects.update_or_create(party_id=party_id, defaults=values)
 
-        # 2) Undo any OUT advances created from this payment
-        out_qs = list(
-            AdvanceLedger.objects.select_related('record').filter(
-                payment=payment,
-                direction="OUT"
-            )
-        )
-        for out_entry in out_qs:
-            if out_entry.record:
-                out_entry.record.reverse_payment(out_entry.amount)
-            out_entry.delete()
-
-        # 3) Delete remaining IN advances for this payment
-        in_qs = list(
-            AdvanceLedger.objects.filter(payment=payment, direction="IN")
-        )
-        for ledger in in_qs:
-            ledger.delete()
-    
     @staticmethod
-    def sync_pending_request_amounts_for_party(party):
-        pending_requests = Payment_Request.objects.filter(
-            status='P',
-            record__party=party  # 👈 was party=party
-        ).distinct()
-
-        for pr in pending_requests:
-            pr.requested_amount = sum(
-                r.remaining_amount for r in pr.record.all()
+    def rebuild(parties=None, dry_run=False):
+        # recompute every balance from the ledger and return the rows that
+        # had drifted as [(party_id, field, stored, actual), ...]
+        if parties is None:
+            parties = Party.objects.all()
+
+        party_ids = list(parties.order_by('pk').values_list('pk', flat=True))
+        drift = []
+
+        for start in range(0, len(party_ids), REBUILD_BATCH_SIZE):
+            drift.extend(PartyBalanceService._rebuild_batch(
+                party_ids[start:start + REBUILD_BATCH_SIZE], dry_run))
+
+        return drift
+
+    @staticmethod
+    def _rebuild_batch(party_ids, dry_run):
+        actual = PartyBalanceService.compute(party_ids)
+        stored = {
+            balance.party_id: balance
+            for balance in PartyBalance.objects.filter(party_id__in=party_ids)
+        }
+
+        drift = []
+        to_create = []
+        to_update = []
+
+        for party_id, values in actual.items():
+            balance = stored.get(party_id)
+            is_new = balance is None
+            if is_new:
+                # a missing row reads as an empty balance
+                balance = PartyBalance(party_id=party_id)
+                to_create.append(balance)
+
+            changed = False
+            for field, value in values.items():
+                if getattr(balance, field) != value:
+                    drift.append((party_id, field, getattr(balance, field), value))
+                    setattr(balance, field, value)
+                    changed = True
+
+            if changed and not is_new:
+                to_update.append(balance)
+
+        if not dry_run:
+            with transaction.atomic():
+                PartyBalance.objects.bulk_create(to_create)
+                PartyBalance.objects.bulk_update(
+                    to_update, PartyBalanceService.BALANCE_FIELDS)
+
+        return drift
+
+
+class MonthlyRollupService:
+
+    @staticmethod
+    def compute(records):
+        # one unsaved MonthlyRollup per (party, service type, month).
+        # single record saves are picked up by the signals in signals.py;
+        # queryset updates and bulk_create call refresh() themselves.
+        groups = records.order_by().annotate(
+            month=TruncMonth('record_date')
+        ).values(
+            'party', 'party__user', 'service_type', 'month'
+        ).annotate(
+            total_pcs=Sum('pcs'),
+            total_amount=Sum('gross_amount'),
+            total_discount=Sum('discount'),
+            total_paid=Sum('paid_amount'),
+            record_count=Count('pk'),
+        )
+        return [
+            MonthlyRollup(
+                owner_id=g['party__user'],
+                party_id=g['party'],
+                service_type_id=g['service_type'],
+                month=g['month'],
+                pcs=g['total_pcs'],
+                amount=g['total_amount'],
+                discount=g['total_discount'],
+                paid=g['total_paid'],
+                record_count=g['record_count'],
             )
-            pr.save(update_fields=['requested_amount'])
-    
+            for g in groups
+        ]
+
     @staticmethod
-    def create_payment(serializer):
-        payment = serializer.save()
-        PaymentService.allocate_payment(payment)
-        PaymentService.sync_pending_request_amounts_for_party(payment.party)
-        return payment
+    def refresh(party_id, months=None):
+        # recompute only the months a write touched (every month if None)
+        records = Record.objects.filter(party_id=party_id)
+        rollups = MonthlyRollup.objects.filter(party_id=party_id)
+
+        if months is not None:
+            months = {day.replace(day=1) for day in months}
+            if not months:
+                return
+            span = Q()
+            for month in months:
+                span |= Q(record_date__gte=month,
+                          record_date__lt=month_after(month))
+            records = records.filter(span)
+            rollups = rollups.filter(month__in=months)
+
+        rows = MonthlyRollupService.compute(records)
+        rollups.delete()
+        MonthlyRollup.objects.bulk_create(rows)
 
     @staticmethod
-    def update_payment(serializer):
-        payment = serializer.instance
-        PaymentService.rollback_payment(payment)
-        payment = serializer.save()
-        PaymentService.allocate_payment(payment)
-        PaymentService.sync_pending_request_amounts_for_party(payment.party)
-        return payment
+    def rebuild(parties=None):
+        if parties is None:
+            parties = Party.objects.all()
+        party_ids = list(parties.order_by('pk').values_list('pk', flat=True))
+
+        written = 0
+        for start in range(0, len(party_ids), REBUILD_BATCH_SIZE):
+            batch = party_ids[start:start + REBUILD_BATCH_SIZE]
+            rows = MonthlyRollupService.compute(
+                Record.objects.filter(party_id__in=batch))
+            with transaction.atomic():
+                MonthlyRollup.objects.filter(party_id__in=batch).delete()
+                MonthlyRollup.objects.bulk_create(rows)
+            written += len(rows)
+        return written
+
+
+class LedgerService:
+
+    @staticmethod
+    def after_write(party):
+        # everything derived from the ledger that has to follow a write
+        PartyBalanceService.refresh(party)
+        LedgerVersion.bump(party.user_id)
@@ -1,9 +1,39 @@
-from django.db.models.signals import post_delete
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.db import transaction
-from .models import Record, AuditLog, Payment
+from .models import Record, AuditLog, Party, Payment, Work_Rate
 from .serializer import PaymentSerializer, RecordSerializer
+from .service import MonthlyRollupService
+from .utils.rates import invalidate_rates
 
 
+@receiver(post_save, sender=Record)
+@receiver(post_delete, sender=Record)
+def refresh_monthly_rollup(sender, instance, origin=None, update_fields=None,
+                           **kwargs):
+    if isinstance(origin, QuerySet):
+        return  # queryset deletes refresh their months in one go
+    if update_fields == {'paid_amount'}:
+        return  # apply_payment / reverse_payment; the services refresh once
 
+    months = {instance.record_date}
+    loaded = getattr(instance, 'loaded_record_date', None)
+    if loaded is not None:
+        months.add(loaded)
+    MonthlyRollupService.refresh(instance.party_id, months)
+    instance.loaded_record_date = instance.record_date
 
+
+@receiver(post_save, sender=Work_Rate)
+@receiver(post_delete, sender=Work_Rate)
+def bust_rate_cache(sender, instance, **kwargs):
+    # viewset, admin form, admin inline and list_editable all save here.
+    # only the owner id is needed, so don't load the party for it
+    if Work_Rate.party.is_cached(instance):
+        owner_id = instance.party.user_id
+    else:
+        owner_id = Party.objects.filter(pk=instance.party_id).values_list(
+            'user_id', flat=True).first()
+    if owner_id is not None:
+        invalidate_rates(owner_id)
@@ -1,6 +1,15 @@
 from rest_framework.test import APIClient
 import pytest
 from django.urls import reverse
+from django.core.cache import cache
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # counts are cached per user id, and ids get reused between tests
+    cache.clear()
+    yield
+    cache.clear()
 
 
 @pytest.fixture
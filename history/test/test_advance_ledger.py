@@ -1,8 +1,13 @@
 import pytest
 from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from history.models import *
+from history.serializer import AdvanceLedgerSerializer
+from history.views import AdvanceLedgerViewSet
 from model_bakery import baker
 from rest_framework import status
+from rest_framework.test import APIRequestFactory
 from django.urls import reverse
 
 
@@ -38,3 +43,56 @@ class TestAuthCheck:
             assert response.data["results"] == []
         else:
             assert response.data == []
+
+
+# a 1000-row page takes four today; one spare, and anything per row blows
+# straight through it
+LEDGER_PAGE_QUERIES = 5
+
+
+@pytest.mark.django_db
+class TestQueryBudget:
+
+    @pytest.fixture
+    def ledger(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        parties = baker.make(Party, user=user, _quantity=5)
+        payments = [baker.make(Payment, party=party) for party in parties]
+        records = [baker.make(Record, party=party, pcs=1, rate=10)
+                   for party in parties]
+        AdvanceLedger.objects.bulk_create([
+            AdvanceLedger(
+                party=parties[i % 5], amount=10, remaining_amount=0,
+                direction='OUT' if i % 2 else 'IN',
+                payment=payments[i % 5] if i % 3 else None,
+                record=records[i % 5] if i % 2 else None)
+            for i in range(1000)
+        ])
+        return user
+
+    @pytest.mark.parametrize('params', [{}, {'cursor': ''}])
+    def test_a_page_of_1000_rows_has_a_fixed_query_count(
+            self, api_client, ledger, params):
+        api_client.force_authenticate(user=ledger)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = api_client.get(
+                reverse('advance-ledger-list'), {'page_size': 1000, **params})
+        count = len(queries.captured_queries)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data['results']) == 1000
+        assert count <= LEDGER_PAGE_QUERIES
+
+    def test_serializing_the_viewset_queryset_is_one_query(self, ledger):
+        request = APIRequestFactory().get(reverse('advance-ledger-list'))
+        request.user = ledger
+        view = AdvanceLedgerViewSet(request=request)
+
+        with CaptureQueriesContext(connection) as queries:
+            data = AdvanceLedgerSerializer(
+                view.get_queryset()[:1000], many=True).data
+        count = len(queries.captured_queries)
+
+        assert len(data) == 1000
+        assert count == 1
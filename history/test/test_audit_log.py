@@ -1,5 +1,7 @@
 import pytest
 from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from history.models import *
 from model_bakery import baker
 from rest_framework import status
@@ -43,3 +45,27 @@ class TestAuthCheck:
             assert response.data["results"] == []
         else:
             assert response.data == []
+
+
+@pytest.mark.django_db
+class TestQueryBudget:
+
+    @pytest.mark.parametrize('params', [{}, {'cursor': ''}])
+    def test_a_page_of_1000_rows_has_a_fixed_query_count(self, api_client, params):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        AuditLog.objects.bulk_create([
+            AuditLog(user=user, party=party, object_id=i, model_name='Payment',
+                     action='UPDATE', before={'amount': '1'}, after={'amount': '2'})
+            for i in range(1000)
+        ])
+        api_client.force_authenticate(user=user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = api_client.get(
+                reverse('audit-log-list'), {'page_size': 1000, **params})
+        count = len(queries.captured_queries)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data['results']) == 1000
+        assert count <= 3
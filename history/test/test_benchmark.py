@@ -0,0 +1,81 @@
+import pytest
+from django.core.cache import cache
+from history import benchmark
+from history.models import *
+
+FLAT_ENDPOINTS = [
+    'party-list',
+    'work-rate-list',
+    'record-list',
+    'record-list-cursor',
+    'payment-list',
+    'advance-ledger-list',
+    'audit-log-list',
+    'request-payment-list',
+    'summary-record',
+    'summary-payment',
+    'summary-advance_ledger',
+    'summary-audit_log',
+]
+
+
+@pytest.fixture
+def tenant(db):
+    return benchmark.seed_tenant(
+        parties=4, records=6, payments=2, advances=1, requests=6)
+
+
+def query_counts(tenant, page_size):
+    # measure() runs every case against its own empty cache
+    return {
+        row['name']: row['queries']
+        for row in benchmark.run_endpoints(tenant, page_size)
+    }
+
+
+@pytest.mark.django_db
+class TestQueryBudget:
+
+    def test_list_queries_do_not_grow_with_page_size(self, tenant):
+        small = query_counts(tenant, 2)
+        large = query_counts(tenant, 6)
+
+        grown = {
+            name: (small[name], large[name])
+            for name in FLAT_ENDPOINTS
+            if large[name] != small[name]
+        }
+        assert grown == {}
+
+    def test_every_endpoint_answers(self, tenant):
+        for row in benchmark.run_endpoints(tenant):
+            assert row['status'] == 200, row['name']
+
+    def test_service_paths_leave_the_tenant_untouched(self, tenant):
+        before = Payment.objects.count(), Record.objects.count()
+
+        results = benchmark.run_services(tenant)
+
+        assert {row['name'] for row in results} >= {
+            'PaymentService.allocate_payment', 'RecordService.rollback'}
+        assert (Payment.objects.count(), Record.objects.count()) == before
+
+    def test_every_timed_run_starts_with_a_cold_cache(self, db):
+        seen = []
+
+        def probe():
+            seen.append(cache.get('benchmark-probe'))
+            cache.set('benchmark-probe', 1)
+
+        benchmark.measure(probe, repeat=3)
+
+        assert seen == [None] * 4
+
+    def test_the_configured_cache_is_left_alone(self, db):
+        # CACHE_URL may be a redis or memcached shared with the deployment
+        cache.set('deployment-key', 'kept')
+
+        benchmark.measure(lambda: cache.set('benchmark-probe', 1), repeat=2)
+
+        assert cache.get('deployment-key') == 'kept'
+        assert cache.get('benchmark-probe') is None
@@ -0,0 +1,107 @@
+import csv
+import io
+import pytest
+from decimal import Decimal
+from datetime import date
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from history.models import *
+from model_bakery import baker
+from rest_framework import status
+
+
+def read_csv(response):
+    assert response.streaming
+    body = b''.join(response.streaming_content).decode()
+    return list(csv.DictReader(io.StringIO(body)))
+
+
+@pytest.mark.django_db
+class TestExport:
+
+    def make_records(self, user, count, **kwargs):
+        party = baker.make(Party, user=user, first_name='Asha', last_name='K')
+        service, _ = Service_Type.objects.get_or_create(
+            user=user, type_of_work='Polish')
+        return [
+            baker.make(Record, party=party, service_type=service, pcs=2,
+                       rate=Decimal('10.00'), discount=Decimal('0.00'),
+                       paid_amount=Decimal('5.00'), **kwargs)
+            for _ in range(count)
+        ]
+
+    def test_record_export_honours_filters_and_carries_joins(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        kept = self.make_records(user, 2, record_date=date(2026, 2, 1))
+        self.make_records(user, 1, record_date=date(2025, 2, 1))
+        api_client.force_authenticate(user=user)
+
+        response = api_client.get(reverse('record-export'), {
+            'date_range_after': '2026-01-01', 'date_range_before': '2026-12-31'})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response['Content-Type'] == 'text/csv'
+        assert 'attachment; filename="records-' in response['Content-Disposition']
+        rows = read_csv(response)
+        assert sorted(int(row['id']) for row in rows) == sorted(r.id for r in kept)
+        assert rows[0]['first_name'] == 'Asha'
+        assert rows[0]['type_of_work'] == 'Polish'
+        assert Decimal(rows[0]['amount']) == Decimal('20.00')
+        assert Decimal(rows[0]['remaining_amount']) == Decimal('15.00')
+        assert rows[0]['record_date'] == '2026-02-01'
+
+    def test_export_query_count_does_not_grow_with_rows(self, api_client):
+        def export_queries(count):
+            user = baker.make(settings.AUTH_USER_MODEL)
+            self.make_records(user, count)
+            api_client.force_authenticate(user=user)
+            with CaptureQueriesContext(connection) as queries:
+                rows = read_csv(api_client.get(reverse('record-export')))
+            assert len(rows) == count
+            return len(queries.captured_queries)
+
+        assert export_queries(2) == export_queries(30)
+
+    def test_audit_log_export_writes_json_and_escapes_formulas(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user, first_name='=HYPERLINK("x")')
+        baker.make(AuditLog, user=user, party=party, model_name='Payment',
+                   action='UPDATE', before={'amount': '10.00'}, after=None)
+        api_client.force_authenticate(user=user)
+
+        rows = read_csv(api_client.get(reverse('audit-log-export')))
+
+        assert rows[0]['before'] == '{"amount": "10.00"}'
+        assert rows[0]['after'] == ''
+        assert rows[0]['first_name'] == '\'=HYPERLINK("x")'
+
+    def test_payment_and_ledger_exports_are_scoped_to_owner(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        other = baker.make(settings.AUTH_USER_MODEL)
+        mine = baker.make(Payment, party=baker.make(Party, user=user),
+                          amount=Decimal('25.00'))
+        baker.make(Payment, party=baker.make(Party, user=other),
+                   amount=Decimal('30.00'))
+        baker.make(AdvanceLedger, party=mine.party, payment=mine,
+                   amount=Decimal('25.00'), remaining_amount=Decimal('25.00'),
+                   direction='IN')
+        api_client.force_authenticate(user=user)
+
+        payments = read_csv(api_client.get(reverse('payment-export')))
+        ledger = read_csv(api_client.get(reverse('advance-ledger-export'),
+                                         HTTP_ACCEPT='text/csv'))
+
+        assert [int(row['id']) for row in payments] == [mine.id]
+        assert [int(row['payment_id']) for row in ledger] == [mine.id]
+        assert ledger[0]['payment_date'] == mine.payment_date.isoformat()
+
+    def test_sub_user_cannot_export(self, api_client):
+        owner = baker.make(settings.AUTH_USER_MODEL)
+        child = baker.make(settings.AUTH_USER_MODEL, parent=owner)
+        api_client.force_authenticate(user=child)
+
+        response = api_client.get(reverse('audit-log-export'))
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
@@ -0,0 +1,104 @@
+import pytest
+from decimal import Decimal
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from history.models import *
+from history.service import AllocationCursor, RecordService
+from model_bakery import baker
+
+
+def explain(sql, params=None):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # tiny test tables would otherwise always be seq-scanned
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute(f'EXPLAIN {sql}', params)
+        else:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return ' '.join(str(col) for row in cursor.fetchall() for col in row)
+
+
+def captured_select(queries, table):
+    return next(
+        q['sql'] for q in queries.captured_queries
+        if q['sql'].startswith('SELECT') and f'FROM "{table}"' in q['sql']
+    )
+
+
+@pytest.mark.django_db
+class TestLedgerIndexes:
+
+    def test_unpaid_record_lookup_uses_fifo_index(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        baker.make(Record, party=party, service_type=service,
+                   rate=Decimal('10.00'), pcs=2, discount=Decimal('0.00'),
+                   paid_amount=Decimal('0.00'))
+
+        with CaptureQueriesContext(connection) as queries:
+            AllocationCursor(party)
+
+        plan = explain(captured_select(queries, 'history_record'))
+
+        assert 'record_unpaid_fifo_idx' in plan
+
+    def test_open_advance_lookup_uses_partial_index(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        record = baker.make(Record, party=party, service_type=service,
+                            rate=Decimal('10.00'), pcs=2,
+                            discount=Decimal('0.00'),
+                            paid_amount=Decimal('0.00'))
+        AdvanceLedger.objects.create(
+            party=party, amount=5, remaining_amount=5, direction='IN')
+
+        with CaptureQueriesContext(connection) as queries:
+            RecordService.apply_advance(record)
+
+        plan = explain(captured_select(queries, 'history_advanceledger'))
+
+        assert 'advance_open_in_idx' in plan
+
+    def test_party_search_is_an_index_lookup(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        baker.make(Party, user=user, first_name='Ramesh', _quantity=3)
+        api_client.force_authenticate(user=user)
+
+        with CaptureQueriesContext(connection) as queries:
+            api_client.get(reverse('record-list'), {'q': 'ram'})
+
+        plan = explain(next(
+            q['sql'] for q in queries.captured_queries
+            if 'search_key' in q['sql']))
+
+        if connection.vendor == 'postgresql':
+            assert 'party_search_trgm_idx' in plan
+        else:
+            assert 'SEARCH history_party USING' in plan
+            assert 'SCAN history_party' not in plan
+
+    def test_pending_request_lookup_by_record_uses_through_index(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        record = baker.make(Record, party=party, rate=Decimal('10.00'), pcs=2,
+                            discount=Decimal('0.00'),
+                            paid_amount=Decimal('0.00'))
+        request = baker.make(Payment_Request, created_by=user,
+                             requested_amount=Decimal('20.00'))
+        request.record.add(record)
+
+        with CaptureQueriesContext(connection) as queries:
+            RecordService.cleanup_pending_requests_for_deleted_record(record)
+
+        plan = explain(captured_select(
+            queries, 'history_payment_request_record'))
+
+        assert 'payment_request_record_lookup_idx' in plan
+
+        pending = Payment_Request.objects.filter(record=record, status='P')
+        assert 'payment_request_record_lookup_idx' in explain(
+            *pending.query.sql_with_params())
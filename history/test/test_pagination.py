@@ -0,0 +1,84 @@
+import pytest
+from decimal import Decimal
+from django.conf import settings
+from django.urls import reverse
+from history.models import *
+from history.pagination import CountedPaginator
+from model_bakery import baker
+from rest_framework import status
+
+
+@pytest.mark.django_db
+class TestCachedCount:
+
+    def test_payment_list_count_is_cached_until_a_ledger_write(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        baker.make(Payment, party=party, amount=Decimal('10.00'), _quantity=2)
+
+        api_client.force_authenticate(user=user)
+        response = api_client.get(reverse('payment-list'))
+        assert response.data['count'] == 2
+        assert response.data['count_mode'] == 'cached'
+
+        # written behind the api's back, so the cached count stays
+        baker.make(Payment, party=party, amount=Decimal('10.00'))
+        response = api_client.get(reverse('payment-list'))
+        assert response.data['count'] == 2
+
+        response = api_client.post(reverse('payment-list'), {
+            'party_id': party.id, 'amount': 50})
+        assert response.status_code == status.HTTP_201_CREATED
+
+        response = api_client.get(reverse('payment-list'))
+        assert response.data['count'] == 4
+        assert len(response.data['results']) == 4
+
+    def test_cached_count_is_per_filter(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user, first_name='Ramesh')
+        other = baker.make(Party, user=user, first_name='Suresh')
+        baker.make(Payment, party=party, amount=Decimal('10.00'), _quantity=2)
+        baker.make(Payment, party=other, amount=Decimal('10.00'))
+
+        api_client.force_authenticate(user=user)
+        all_payments = api_client.get(reverse('payment-list'))
+        one_party = api_client.get(reverse('payment-list'), {'party__first_name': 'ram'})
+
+        assert all_payments.data['count'] == 3
+        assert one_party.data['count'] == 2
+
+    def test_estimate_falls_back_to_cached_off_postgres(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        baker.make(AuditLog, user=user, party=party, _quantity=3)
+
+        api_client.force_authenticate(user=user)
+        response = api_client.get(reverse('audit-log-list'))
+
+        assert response.data['count'] == 3
+        assert response.data['count_mode'] in ('estimate', 'cached')
+
+    def test_party_list_keeps_exact_count(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        baker.make(Party, user=user, _quantity=2)
+
+        api_client.force_authenticate(user=user)
+        response = api_client.get(reverse('party-list'))
+
+        assert response.data['count'] == 2
+        assert response.data['count_mode'] == 'exact'
+
+
+class TestCountedPaginator:
+
+    def test_pages_follow_rows_not_a_wrong_count(self):
+        rows = list(range(7))
+
+        low = CountedPaginator(rows, 3, count=2)
+        assert list(low.page(3)) == [6]
+        assert low.page(2).has_next()
+        assert not low.page(3).has_next()
+
+        high = CountedPaginator(rows, 3, count=100)
+        assert not high.page(3).has_next()
@@ -1,9 +1,18 @@
 import pytest
+from datetime import date
 from decimal import Decimal
 from django.conf import settings
+from io import StringIO
+from django.contrib.admin.sites import AdminSite
+from django.core.management import call_command
 from django.db import connection
 from django.test.utils import CaptureQueriesContext
-from history.models import AdvanceLedger, Party, Record, Service_Type, Payment
+from history.models import (
+    AdvanceLedger, AuditLog, LedgerVersion, Party, PartyBalance, Record,
+    Service_Type, Payment,
+)
+from history.admin import PaymentAdmin, RecordAdmin
+from history.service import PartyBalanceService
 from model_bakery import baker
 from rest_framework import status
 from django.urls import reverse
@@ -193,3 +202,273 @@ class TestCreateAndDelete:
         response = api_client.delete(reverse('party-detail', args=[party.id]))
 
         assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestPartyBalance:
+
+    def test_ledger_writes_keep_party_balance_in_sync(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        baker.make(Record, party=party, service_type=service,
+                   rate=Decimal('10.00'), pcs=5, discount=Decimal('0.00'),
+                   paid_amount=Decimal('0.00'))
+
+        api_client.force_authenticate(user=user)
+        response = api_client.post(
+            reverse('payment-list'), {'party_id': party.id, 'amount': 80})
+
+        balance = PartyBalance.objects.get(party=party)
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert balance.due == Decimal('0.00')
+        assert balance.advance == Decimal('30.00')
+        assert balance.open_records == 0
+        assert balance.last_activity is not None
+
+    def test_party_list_reads_party_balance(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        PartyBalance.objects.create(
+            party=party, due=Decimal('12.00'), advance=Decimal('3.00'))
+
+        api_client.force_authenticate(user=user)
+        response = api_client.get(reverse('party-list'))
+
+        assert Decimal(response.data['results'][0]['due']) == Decimal('12.00')
+        assert Decimal(
+            response.data['results'][0]['advance_balance']) == Decimal('3.00')
+
+    def test_admin_list_editable_save_refreshes_the_balance(
+            self, admin_client, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        record = baker.make(Record, party=party, service_type=service,
+                            rate=Decimal('10.00'), pcs=2, discount=Decimal('0.00'),
+                            paid_amount=Decimal('0.00'), record_date=date(2026, 1, 5))
+        PartyBalanceService.refresh(party)
+
+        response = admin_client.post(reverse('admin:history_record_changelist'), {
+            'form-TOTAL_FORMS': 1,
+            'form-INITIAL_FORMS': 1,
+            'form-0-id': record.pk,
+            'form-0-rate': '10.00',
+            'form-0-pcs': 5,
+            'form-0-discount': '0.00',
+            'form-0-record_date': '2026-01-05',
+            '_save': 'Save',
+        })
+        api_client.force_authenticate(user=user)
+        listed = api_client.get(reverse('party-list')).data['results'][0]
+
+        assert response.status_code == status.HTTP_302_FOUND
+        assert PartyBalance.objects.get(party=party).due == Decimal('50.00')
+        assert Decimal(listed['due']) == Decimal('50.00')
+
+    def test_admin_deletes_refresh_the_balance(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        record = baker.make(Record, party=party, rate=Decimal('10.00'), pcs=2,
+                            discount=Decimal('0.00'), paid_amount=Decimal('0.00'))
+        PartyBalanceService.refresh(party)
+
+        RecordAdmin(Record, AdminSite()).delete_queryset(
+            None, Record.objects.filter(pk=record.pk))
+
+        assert PartyBalance.objects.get(party=party).due == Decimal('0.00')
+
+    def test_rebuild_command_reports_and_fixes_drift(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        baker.make(Record, party=party, service_type=service,
+                   rate=Decimal('10.00'), pcs=2, discount=Decimal('0.00'),
+                   paid_amount=Decimal('5.00'))
+        PartyBalance.objects.create(party=party, due=Decimal('1.00'))
+
+        out = StringIO()
+        call_command('rebuild_party_balances', stdout=out)
+        balance = PartyBalance.objects.get(party=party)
+
+        assert f'party {party.id}: due stored=1.00 actual=15.00' in out.getvalue()
+        assert balance.due == Decimal('15.00')
+        assert balance.open_records == 1
+
+
+@pytest.mark.django_db
+class TestConditionalGet:
+
+    def test_unchanged_list_gets_304_without_serializing(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        baker.make(Party, user=user, _quantity=3)
+        api_client.force_authenticate(user=user)
+
+        first = api_client.get(reverse('party-list'))
+        assert first['ETag']
+        assert 'no-cache' in first['Cache-Control']
+
+        with CaptureQueriesContext(connection) as queries:
+            second = api_client.get(
+                reverse('party-list'), HTTP_IF_NONE_MATCH=first['ETag'])
+
+        assert second.status_code == status.HTTP_304_NOT_MODIFIED
+        # only the write marker lookup
+        assert len(queries.captured_queries) == 1
+
+    def test_etag_depends_on_query_params(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        api_client.force_authenticate(user=user)
+
+        first = api_client.get(reverse('party-list'))
+        second = api_client.get(reverse('party-list'), {'page_size': 5},
+                                HTTP_IF_NONE_MATCH=first['ETag'])
+
+        assert second.status_code == status.HTTP_200_OK
+
+    def test_party_update_invalidates(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user, first_name='Old')
+        api_client.force_authenticate(user=user)
+        first = api_client.get(reverse('party-detail', args=[party.id]))
+
+        api_client.patch(reverse('party-detail', args=[party.id]),
+                         {'first_name': 'New'}, format='json')
+        second = api_client.get(reverse('party-detail', args=[party.id]),
+                                HTTP_IF_NONE_MATCH=first['ETag'])
+
+        assert second.status_code == status.HTTP_200_OK
+        assert second.data['first_name'] == 'New'
+        assert LedgerVersion.current(user.pk) == 1
+
+    def test_if_modified_since_alone_never_gets_304(self, api_client):
+        # Last-Modified has one-second resolution, so it isn't offered
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        api_client.force_authenticate(user=user)
+        api_client.patch(reverse('party-detail', args=[party.id]),
+                         {'first_name': 'New'}, format='json')
+
+        first = api_client.get(reverse('payment-list'))
+        second = api_client.get(
+            reverse('payment-list'),
+            HTTP_IF_MODIFIED_SINCE='Sun, 01 Jan 2090 00:00:00 GMT')
+
+        assert 'Last-Modified' not in first
+        assert second.status_code == status.HTTP_200_OK
+
+    def test_admin_edits_invalidate(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        record = baker.make(Record, party=party, pcs=1, rate=Decimal('10.00'))
+        payment = baker.make(Payment, party=party, amount=Decimal('10.00'))
+        api_client.force_authenticate(user=user)
+        records_etag = api_client.get(reverse('record-list'))['ETag']
+        payments_etag = api_client.get(reverse('payment-list'))['ETag']
+
+        # what a list_editable save and a bulk delete run
+        record.pcs = 2
+        RecordAdmin(Record, AdminSite()).save_model(None, record, None, True)
+        PaymentAdmin(Payment, AdminSite()).delete_queryset(
+            None, Payment.objects.filter(pk=payment.pk))
+
+        for url_name, etag in [('record-list', records_etag),
+                               ('payment-list', payments_etag)]:
+            response = api_client.get(reverse(url_name), HTTP_IF_NONE_MATCH=etag)
+            assert response.status_code == status.HTTP_200_OK
+
+    def test_foreign_object_is_still_404_with_an_etag(self, api_client):
+        owner = baker.make(settings.AUTH_USER_MODEL)
+        other = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=owner)
+
+        api_client.force_authenticate(user=owner)
+        etag = api_client.get(reverse('party-detail', args=[party.id]))['ETag']
+
+        api_client.force_authenticate(user=other)
+        response = api_client.get(reverse('party-detail', args=[party.id]),
+                                  HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestPartySearch:
+
+    @pytest.fixture
+    def parties(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        ramesh = baker.make(Party, user=user, first_name='Ramesh',
+                            last_name='Soni', logo='RS', number='9876500001')
+        suresh = baker.make(Party, user=user, first_name='Suresh',
+                            last_name=None, logo='SJ', number=None)
+        return user, ramesh, suresh
+
+    def search(self, api_client, user, url_name, q):
+        api_client.force_authenticate(user=user)
+        response = api_client.get(reverse(url_name), {'q': q})
+        assert response.status_code == status.HTTP_200_OK
+        return response.data['results']
+
+    @pytest.mark.parametrize('q', ['ramesh', 'SONI', 'rs', '98765', 'h so'])
+    def test_q_matches_name_logo_and_number(self, api_client, parties, q):
+        user, ramesh, _ = parties
+
+        results = self.search(api_client, user, 'party-list', q)
+
+        assert [row['id'] for row in results] == [ramesh.pk]
+
+    def test_search_key_skips_missing_parts(self, parties):
+        _, _, suresh = parties
+        suresh.refresh_from_db()
+        assert suresh.search_key == 'suresh  sj '
+
+    def test_search_key_follows_edits(self, api_client, parties):
+        user, ramesh, _ = parties
+        ramesh.first_name = 'Mahesh'
+        ramesh.save()
+
+        assert self.search(api_client, user, 'party-list', 'ramesh') == []
+        assert len(self.search(api_client, user, 'party-list', 'mahesh')) == 1
+
+    def test_ledger_lists_filter_on_the_matched_party_ids(self, api_client, parties):
+        user, ramesh, suresh = parties
+        mine = baker.make(Record, party=ramesh, pcs=1, rate=10)
+        baker.make(Record, party=suresh, pcs=1, rate=10)
+        api_client.force_authenticate(user=user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = api_client.get(reverse('record-list'), {'q': 'soni'})
+        sql = [q['sql'] for q in queries.captured_queries]
+
+        assert [row['id'] for row in response.data['results']] == [mine.pk]
+        # the match runs as a subquery on history_party, not per record row
+        lookups = [s for s in sql if 'search_key' in s]
+        assert lookups
+        for s in lookups:
+            assert s.startswith('SELECT')
+            assert s.index('IN (SELECT') < s.index('search_key')
+        assert not any(s for s in sql if 'FROM "history_party"' in s
+                       and 'history_record' not in s and 'search_key' in s)
+
+    @pytest.mark.parametrize('url_name', [
+        'payment-list', 'advance-ledger-list', 'audit-log-list'])
+    def test_every_ledger_list_takes_q(self, api_client, parties, url_name):
+        user, ramesh, suresh = parties
+        for party in (ramesh, suresh):
+            payment = baker.make(Payment, party=party, amount=Decimal('10.00'))
+            baker.make(AdvanceLedger, party=party, payment=payment,
+                       amount=Decimal('10.00'), direction='IN')
+            baker.make(AuditLog, user=user, party=party)
+
+        results = self.search(api_client, user, url_name, 'RS')
+
+        assert len(results) == 1
+
+    def test_other_owners_parties_never_match(self, api_client, parties):
+        user, ramesh, _ = parties
+        other = baker.make(Party, first_name='Ramesh')
+        baker.make(Record, party=other, pcs=1, rate=10)
+
+        assert self.search(api_client, user, 'record-list', 'ramesh') == []
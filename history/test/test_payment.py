@@ -1,10 +1,15 @@
 import pytest
+import random
+from decimal import Decimal
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
 from history.models import *
 from model_bakery import baker
 from rest_framework import status
 from django.urls import reverse
-from history.service import PaymentService
+from history.service import PaymentService, RecordService
 from django.utils.timezone import localdate, timedelta
 
 
@@ -314,3 +319,319 @@ class TestUinqueConditionsRecord:
         assert "payment_date" in response_future_date.data
 
 
+
+
+@pytest.mark.django_db
+class TestBulkAllocation:
+
+    def make_records(self, party, service, count):
+        return [
+            baker.make(Record, party=party, service_type=service,
+                       paid_amount=Decimal('0.00'), discount=Decimal('0.00'),
+                       rate=Decimal('10.00'), pcs=1,
+                       record_date=localdate() - timedelta(days=count - i))
+            for i in range(count)
+        ]
+
+    def test_allocation_splits_payment_oldest_record_first(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        today = localdate()
+
+        newest = baker.make(Record, party=party, service_type=service,
+                            paid_amount=Decimal('0.00'), discount=Decimal('0.00'),
+                            rate=Decimal('10.00'), pcs=3, record_date=today)
+        oldest = baker.make(Record, party=party, service_type=service,
+                            paid_amount=Decimal('5.00'), discount=Decimal('5.00'),
+                            rate=Decimal('10.00'), pcs=2,
+                            record_date=today - timedelta(days=2))
+        paid = baker.make(Record, party=party, service_type=service,
+                          paid_amount=Decimal('10.00'), discount=Decimal('0.00'),
+                          rate=Decimal('10.00'), pcs=1,
+                          record_date=today - timedelta(days=3))
+
+        payment = baker.make(Payment, party=party, amount=Decimal('50.00'))
+        PaymentService.allocate_payment(payment)
+
+        for record in (newest, oldest, paid):
+            record.refresh_from_db()
+
+        allocations = {
+            a.record_id: a.amount for a in Allocation.objects.filter(payment=payment)
+        }
+
+        assert allocations == {oldest.id: Decimal('10.00'),
+                               newest.id: Decimal('30.00')}
+        assert oldest.paid_amount == Decimal('15.00')
+        assert newest.paid_amount == Decimal('30.00')
+        assert paid.paid_amount == Decimal('10.00')
+        assert AdvanceLedger.objects.get(payment=payment).remaining_amount == 10
+
+    def test_allocation_query_count_stays_flat(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        service = baker.make(Service_Type, user=user)
+        counts = []
+
+        for size in (5, 60):
+            party = baker.make(Party, user=user)
+            self.make_records(party, service, size)
+            payment = baker.make(Payment, party=party,
+                                 amount=Decimal(size * 10 + 5))
+
+            with CaptureQueriesContext(connection) as queries:
+                PaymentService.allocate_payment(payment)
+
+            counts.append(len(queries))
+            assert Allocation.objects.filter(payment=payment).count() == size
+            assert not Record.objects.filter(
+                party=party, paid_amount__lt=Decimal('10.00')).exists()
+
+        assert counts[0] == counts[1]
+
+    def test_rollback_takes_back_allocations_and_spent_advance(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        first, second = self.make_records(party, service, 2)
+
+        payment = baker.make(Payment, party=party, amount=Decimal('15.00'))
+        PaymentService.allocate_payment(payment)
+        later = baker.make(Record, party=party, service_type=service,
+                           paid_amount=Decimal('0.00'), discount=Decimal('0.00'),
+                           rate=Decimal('10.00'), pcs=1)
+        advance = baker.make(Payment, party=party, amount=Decimal('20.00'))
+        PaymentService.allocate_payment(advance)
+        RecordService.apply_advance(later)
+
+        PaymentService.rollback_payment(advance)
+        PaymentService.rollback_payment(payment)
+
+        for record in (first, second, later):
+            record.refresh_from_db()
+            assert record.paid_amount == Decimal('0.00')
+        assert not Allocation.objects.filter(record__party=party).exists()
+        assert not AdvanceLedger.objects.filter(party=party).exists()
+        assert not MonthlyRollup.objects.filter(
+            party=party, paid__gt=0).exists()
+
+    def test_rollback_query_count_stays_flat(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        service = baker.make(Service_Type, user=user)
+        counts = []
+
+        for size in (5, 60):
+            party = baker.make(Party, user=user)
+            self.make_records(party, service, size)
+            payment = baker.make(Payment, party=party,
+                                 amount=Decimal(size * 10 + 5))
+            PaymentService.allocate_payment(payment)
+
+            with CaptureQueriesContext(connection) as queries:
+                PaymentService.rollback_payment(payment)
+
+            counts.append(len(queries))
+            assert not Record.objects.filter(
+                party=party, paid_amount__gt=0).exists()
+            assert not AdvanceLedger.objects.filter(payment=payment).exists()
+
+        assert counts[0] == counts[1]
+
+
+@pytest.mark.django_db
+class TestIncrementalPaymentUpdate:
+
+    def build_party(self, rng):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        today = localdate()
+
+        def add_record():
+            return baker.make(
+                Record, party=party, service_type=service,
+                pcs=rng.randint(1, 5), rate=Decimal(rng.randint(10, 50)),
+                discount=Decimal('0.00'), paid_amount=Decimal('0.00'),
+                record_date=today - timedelta(days=rng.randint(0, 60)))
+
+        for _ in range(rng.randint(2, 10)):
+            add_record()
+
+        payments = []
+        for _ in range(rng.randint(1, 4)):
+            payment = baker.make(Payment, party=party,
+                                 amount=Decimal(rng.randint(10, 400)))
+            PaymentService.allocate_payment(payment)
+            payments.append(payment)
+            # later records eat into the advance (OUT rows)
+            for _ in range(rng.randint(0, 2)):
+                RecordService.apply_advance(add_record())
+        return party, payments
+
+    def snapshot(self, party):
+        return {
+            'paid': dict(Record.objects.filter(party=party).values_list(
+                'pk', 'paid_amount')),
+            'allocations': sorted(Allocation.objects.filter(
+                record__party=party
+            ).values('payment_id', 'record_id').annotate(
+                total=Sum('amount')
+            ).values_list('payment_id', 'record_id', 'total')),
+            'ledger': sorted(AdvanceLedger.objects.filter(
+                party=party
+            ).values_list('payment_id', 'record_id', 'direction',
+                          'amount', 'remaining_amount'), key=repr),
+            'rollups': sorted(MonthlyRollup.objects.filter(
+                party=party).values_list('month', 'paid')),
+            # the order later records spend the advances in
+            'advance_fifo': list(AdvanceLedger.objects.filter(
+                party=party, direction='IN'
+            ).order_by('created_at', 'pk').values_list(
+                'payment_id', 'remaining_amount')),
+        }
+
+    @pytest.mark.parametrize('seed', range(40))
+    def test_reallocate_matches_rollback_and_allocate(self, seed):
+        rng = random.Random(seed)
+        party, payments = self.build_party(rng)
+        payment = rng.choice(payments)
+        new_amount = max(Decimal('1.00'), payment.amount + Decimal(
+            rng.choice([-1, 1]) * rng.randint(1, 300)))
+
+        with transaction.atomic():
+            PaymentService.rollback_payment(payment)
+            payment.amount = new_amount
+            payment.save()
+            PaymentService.allocate_payment(payment)
+            expected = self.snapshot(party)
+            transaction.set_rollback(True)
+
+        payment.refresh_from_db()
+        payment.amount = new_amount
+        payment.save()
+        PaymentService.reallocate(payment)
+
+        assert self.snapshot(party) == expected
+
+    def test_small_change_only_touches_the_edge(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        records = TestBulkAllocation().make_records(party, service, 30)
+        payment = baker.make(Payment, party=party, amount=Decimal('295.00'))
+        PaymentService.allocate_payment(payment)
+        untouched = list(Allocation.objects.filter(
+            payment=payment).order_by('pk').values_list('pk', 'amount')[:28])
+
+        payment.amount = Decimal('300.00')
+        payment.save()
+        changed = PaymentService.reallocate(payment)
+
+        assert changed == [records[29].pk]
+        assert list(Allocation.objects.filter(
+            payment=payment).order_by('pk').values_list(
+                'pk', 'amount')[:28]) == untouched
+        assert not AdvanceLedger.objects.filter(payment=payment).exists()
+
+
+@pytest.mark.django_db
+class TestBulkPayments:
+
+    def make_party(self, user, service, records=4):
+        party = baker.make(Party, user=user)
+        TestBulkAllocation().make_records(party, service, records)
+        return party
+
+    def ledger(self, parties):
+        return {
+            'paid': sorted(Record.objects.filter(
+                party__in=parties).values_list('pk', 'paid_amount')),
+            'allocations': sorted(Allocation.objects.filter(
+                record__party__in=parties).values_list(
+                    'payment__party_id', 'payment__amount', 'record_id',
+                    'amount')),
+            'advances': sorted(AdvanceLedger.objects.filter(
+                party__in=parties).values_list(
+                    'party_id', 'payment__amount', 'direction', 'amount',
+                    'remaining_amount')),
+        }
+
+    def test_bulk_matches_one_payment_at_a_time(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        service = baker.make(Service_Type, user=user)
+        parties = [self.make_party(user, service) for _ in range(3)]
+        entries = [
+            {'party_id': party.pk, 'amount': str(amount)}
+            for party in parties for amount in (15, 17, 25)
+        ]
+
+        with transaction.atomic():
+            for entry in entries:
+                payment = Payment.objects.create(
+                    party_id=entry['party_id'], amount=Decimal(entry['amount']))
+                PaymentService.allocate_payment(payment)
+            expected = self.ledger(parties)
+            transaction.set_rollback(True)
+
+        api_client.force_authenticate(user=user)
+        response = api_client.post(reverse('payment-bulk'),
+                                   {'payments': entries}, format='json')
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.data['created'] == 9
+        assert self.ledger(parties) == expected
+
+    def test_bad_entries_are_reported_per_entry(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        service = baker.make(Service_Type, user=user)
+        party = self.make_party(user, service)
+        foreign = baker.make(Party)
+
+        api_client.force_authenticate(user=user)
+        response = api_client.post(reverse('payment-bulk'), {'payments': [
+            {'party_id': foreign.pk, 'amount': '10.00'},
+            {'party_id': party.pk, 'amount': '10.00'},
+            {'party_id': party.pk, 'amount': '10.00',
+             'payment_date': str(localdate() - timedelta(days=9))},
+            {'party_id': party.pk},
+        ]}, format='json')
+        results = response.data['results']
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert (response.data['created'], response.data['failed']) == (1, 3)
+        assert [r['index'] for r in results] == [0, 1, 2, 3]
+        assert 'party_id' in results[0]['errors']
+        assert results[1]['id'] == Payment.objects.get(party=party).pk
+        assert 'payment_date' in results[2]['errors']
+        assert 'amount' in results[3]['errors']
+
+    def test_sub_user_cannot_post_bulk_payments(self, api_client):
+        owner = baker.make(settings.AUTH_USER_MODEL)
+        staff = baker.make(settings.AUTH_USER_MODEL, parent=owner)
+
+        api_client.force_authenticate(user=staff)
+        response = api_client.post(reverse('payment-bulk'), {'payments': [
+            {'party_id': 1, 'amount': '10.00'}]}, format='json')
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+    def test_query_count_depends_on_parties_not_entries(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        service = baker.make(Service_Type, user=user)
+        api_client.force_authenticate(user=user)
+        LedgerVersion.bump(user.pk)
+        counts = []
+
+        for per_party in (1, 10):
+            parties = [self.make_party(user, service, 12) for _ in range(2)]
+            entries = [
+                {'party_id': party.pk, 'amount': '7.00'}
+                for party in parties for _ in range(per_party)
+            ]
+            with CaptureQueriesContext(connection) as queries:
+                response = api_client.post(reverse('payment-bulk'),
+                                           {'payments': entries}, format='json')
+            counts.append(len(queries.captured_queries))
+            assert response.data['created'] == len(entries)
+
+        assert counts[0] == counts[1]
@@ -6,8 +6,11 @@ from rest_framework import status
 from model_bakery import baker
 from datetime import timedelta
 from django.utils.timezone import localdate
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from history.service import *
+from history.serializer import PaymentRequestSerializer
 from history.models import Allocation, Party, Service_Type, Record, Payment_Request, Payment
 
 
@@ -370,3 +373,168 @@ class TestPendingRequestRecalculationFromPaymentChanges:
         pr.refresh_from_db()
         assert pr.requested_amount == Decimal("100.00")
         assert pr.status == "P"
+
+
+@pytest.mark.django_db
+class TestPendingRequestRecompute:
+
+    def make_requests(self, child, party, service, count):
+        requests = []
+        for _ in range(count):
+            records = baker.make(
+                Record, party=party, service_type=service,
+                rate=Decimal("10.00"), pcs=2, discount=Decimal("0.00"),
+                paid_amount=Decimal("0.00"), _quantity=2,
+            )
+            pr = baker.make(Payment_Request, created_by=child,
+                            requested_amount=Decimal("40.00"), status="P")
+            pr.record.set(records)
+            requests.append(pr)
+        return requests
+
+    def sync_queries(self, count):
+        main = baker.make(settings.AUTH_USER_MODEL)
+        child = baker.make(settings.AUTH_USER_MODEL, parent=main)
+        party = baker.make(Party, user=main, assigned_to=child)
+        service = baker.make(Service_Type, user=main)
+        self.make_requests(child, party, service, count)
+
+        with CaptureQueriesContext(connection) as queries:
+            PaymentService.sync_pending_request_amounts_for_party(party)
+        return len(queries.captured_queries)
+
+    def test_party_sync_is_one_batch_regardless_of_request_count(self):
+        assert self.sync_queries(2) == self.sync_queries(25)
+
+    def test_recompute_totals_outstanding_and_skips_processed_requests(self):
+        main = baker.make(settings.AUTH_USER_MODEL)
+        child = baker.make(settings.AUTH_USER_MODEL, parent=main)
+        party = baker.make(Party, user=main, assigned_to=child)
+        service = baker.make(Service_Type, user=main)
+        pending, approved = self.make_requests(child, party, service, 2)
+        Payment_Request.objects.filter(pk=approved.pk).update(status="A")
+
+        payment = baker.make(Payment, party=party, amount=Decimal("25.00"))
+        PaymentService.allocate_payment(payment)
+        PaymentService.sync_pending_request_amounts_for_party(party)
+
+        pending.refresh_from_db()
+        approved.refresh_from_db()
+        assert pending.requested_amount == Decimal("15.00")
+        assert approved.requested_amount == Decimal("40.00")
+
+    def test_deleting_last_record_drops_only_the_empty_request(self):
+        main = baker.make(settings.AUTH_USER_MODEL)
+        child = baker.make(settings.AUTH_USER_MODEL, parent=main)
+        party = baker.make(Party, user=main, assigned_to=child)
+        service = baker.make(Service_Type, user=main)
+        keep, drop = self.make_requests(child, party, service, 2)
+        shared = keep.record.first()
+        drop.record.set([shared])
+
+        RecordService.cleanup_pending_requests_for_deleted_record(shared)
+
+        assert not Payment_Request.objects.filter(pk=drop.pk).exists()
+        keep.refresh_from_db()
+        assert keep.record.count() == 1
+        assert keep.requested_amount == Decimal("20.00")
+
+
+@pytest.mark.django_db
+class TestPaymentRequestListQueries:
+
+    def list_queries(self, api_client, count):
+        main = baker.make(settings.AUTH_USER_MODEL)
+        child = baker.make(settings.AUTH_USER_MODEL, parent=main)
+        parties = baker.make(Party, user=main, assigned_to=child, _quantity=3)
+        service = baker.make(Service_Type, user=main)
+        for i in range(count):
+            records = [
+                baker.make(Record, party=party, service_type=service,
+                           rate=Decimal("10.00"), pcs=1,
+                           discount=Decimal("0.00"),
+                           paid_amount=Decimal("0.00"))
+                for party in parties[:1 + i % 3]
+            ]
+            pr = baker.make(Payment_Request, created_by=child,
+                            requested_amount=Decimal("10.00"), status="P")
+            pr.record.set(records)
+
+        api_client.force_authenticate(user=main)
+        with CaptureQueriesContext(connection) as queries:
+            response = api_client.get(
+                reverse("request-payment-list"), {"page_size": count})
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data["results"]) == count
+        return len(queries.captured_queries), response.data["results"]
+
+    def test_listing_100_requests_costs_constant_queries(self, api_client):
+        small, _ = self.list_queries(api_client, 3)
+        large, results = self.list_queries(api_client, 100)
+
+        assert large == small
+        assert {len(item["parties"]) for item in results} == {1, 2, 3}
+
+    def test_parties_are_deduped_without_prefetch(self):
+        main = baker.make(settings.AUTH_USER_MODEL)
+        child = baker.make(settings.AUTH_USER_MODEL, parent=main)
+        party = baker.make(Party, user=main, first_name="B")
+        other = baker.make(Party, user=main, first_name="A")
+        service = baker.make(Service_Type, user=main)
+        records = [
+            baker.make(Record, party=p, service_type=service,
+                       rate=Decimal("10.00"), pcs=1, discount=Decimal("0.00"),
+                       paid_amount=Decimal("0.00"))
+            for p in [party, party, other]
+        ]
+        requests = baker.make(Payment_Request, created_by=child,
+                              requested_amount=Decimal("30.00"), _quantity=2)
+        for pr in requests:
+            pr.record.set(records)
+
+        with CaptureQueriesContext(connection) as queries:
+            parties_per_request = [
+                [p["id"] for p in item["parties"]]
+                for item in PaymentRequestSerializer(
+                    Payment_Request.objects.filter(created_by=child), many=True
+                ).data
+            ]
+        # the nested records still load their own party; only count the
+        # request -> parties derivation
+        party_queries = [q for q in queries.captured_queries
+                         if 'FROM "history_party"' in q["sql"]
+                         and "payment_request" in q["sql"]]
+
+        assert parties_per_request == [[other.id, party.id]] * 2
+        assert len(party_queries) == 1
+
+    def test_parties_come_back_in_the_db_ordering(self, api_client):
+        # the db's collation decides, not python's codepoint sort
+        main = baker.make(settings.AUTH_USER_MODEL)
+        child = baker.make(settings.AUTH_USER_MODEL, parent=main)
+        service = baker.make(Service_Type, user=main)
+        parties = [
+            baker.make(Party, user=main, assigned_to=child,
+                       first_name=first, last_name=last)
+            for first, last in [("adam", None), ("Zed", "b"), ("Zed", None),
+                                ("Zed", "a"), ("éva", None)]
+        ]
+        pr = baker.make(Payment_Request, created_by=child,
+                        requested_amount=Decimal("10.00"), status="P")
+        pr.record.set([
+            baker.make(Record, party=party, service_type=service,
+                       rate=Decimal("10.00"), pcs=1, discount=Decimal("0.00"),
+                       paid_amount=Decimal("0.00"))
+            for party in reversed(parties)
+        ])
+        expected = list(Party.objects.filter(
+            pk__in=[p.pk for p in parties]
+        ).order_by(*Party._meta.ordering, "pk").values_list("pk", flat=True))
+
+        api_client.force_authenticate(user=main)
+        listed = api_client.get(reverse("request-payment-list")).data["results"]
+        unprefetched = PaymentRequestSerializer(
+            Payment_Request.objects.filter(pk=pr.pk), many=True).data
+
+        assert [p["id"] for p in listed[0]["parties"]] == expected
+        assert [p["id"] for p in unprefetched[0]["parties"]] == expected
@@ -1,10 +1,19 @@
+import base64
+import json
 import pytest
+import random
+from decimal import Decimal
 from django.conf import settings
 from history.models import *
 from model_bakery import baker
 from rest_framework import status
 from django.urls import reverse
-from history.service import PaymentService
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils.timezone import localdate, timedelta
+from history.service import MonthlyRollupService, PaymentService, RecordService
 
 
 @pytest.mark.django_db
@@ -333,3 +342,503 @@ class TestUinqueConditionsRecord:
         assert log.action == "DELETE"
         assert log.model_name == 'Record'
         assert log.object_id == record_id
+
+
+@pytest.mark.django_db
+class TestRecordRollback:
+
+    def make_party_with_paid_record(self, size):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        today = localdate()
+
+        old = baker.make(Record, party=party, service_type=service,
+                         rate=Decimal('10.00'), pcs=size, discount=Decimal('0.00'),
+                         paid_amount=Decimal('0.00'),
+                         record_date=today - timedelta(days=size + 1))
+        newer = [
+            baker.make(Record, party=party, service_type=service,
+                       rate=Decimal('10.00'), pcs=1, discount=Decimal('0.00'),
+                       paid_amount=Decimal('0.00'),
+                       record_date=today - timedelta(days=size - i))
+            for i in range(size)
+        ]
+        payment = baker.make(Payment, party=party, amount=Decimal(size * 10))
+        PaymentService.allocate_payment(payment)
+        return old, newer, payment
+
+    def test_rollback_moves_allocations_to_next_unpaid_records(self):
+        old, newer, payment = self.make_party_with_paid_record(3)
+
+        RecordService.rollback(old)
+        old.delete()
+
+        for record in newer:
+            record.refresh_from_db()
+
+        assert [r.paid_amount for r in newer] == [Decimal('10.00')] * 3
+        assert Allocation.objects.filter(payment=payment).count() == 3
+        assert not AdvanceLedger.objects.exists()
+
+    def test_rollback_query_count_does_not_grow_with_targets(self):
+        counts = []
+
+        for size in (3, 40):
+            old, newer, payment = self.make_party_with_paid_record(size)
+            old.refresh_from_db()
+
+            with CaptureQueriesContext(connection) as queries:
+                RecordService.rollback(old)
+
+            counts.append(len(queries))
+            assert Allocation.objects.filter(
+                payment=payment).exclude(record=old).count() == size
+
+        assert counts[0] == counts[1]
+
+    def make_record_paid_by_rows(self, rows):
+        # paid half by allocations, half by advance-OUT rows of one payment
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        record = baker.make(Record, party=party, rate=Decimal('10.00'),
+                            pcs=2 * rows, discount=Decimal('0.00'),
+                            paid_amount=Decimal(20 * rows))
+        payment = baker.make(Payment, party=party, amount=Decimal(20 * rows))
+        AdvanceLedger.objects.create(
+            party=party, payment=payment, amount=Decimal(10 * rows),
+            remaining_amount=0, direction='IN')
+        for _ in range(rows):
+            baker.make(Allocation, payment=payment, record=record,
+                       amount=Decimal('10.00'))
+            AdvanceLedger.objects.create(
+                party=party, payment=payment, record=record,
+                amount=Decimal('10.00'), remaining_amount=0, direction='OUT')
+        return Record.objects.get(pk=record.pk), payment
+
+    def test_rollback_query_count_does_not_grow_with_paying_rows(self):
+        counts = []
+
+        for rows in (1, 6):
+            record, payment = self.make_record_paid_by_rows(rows)
+
+            with CaptureQueriesContext(connection) as queries:
+                RecordService.rollback(record)
+
+            payment_loads = [q for q in queries.captured_queries
+                             if 'FROM "history_payment" WHERE' in q['sql']]
+            assert payment_loads == []
+            counts.append(len(queries))
+            assert AdvanceLedger.objects.filter(
+                payment=payment, direction='IN'
+            ).aggregate(total=Sum('remaining_amount'))['total'] == 20 * rows
+
+        assert counts[0] == counts[1]
+
+    def test_rollback_credits_only_the_advance_that_already_existed(self):
+        # R was paid 10 straight from the payment and 10 from its advance;
+        # rolling back credits the old IN entry and opens a new one, both
+        # for the same payment
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        record = baker.make(Record, party=party, rate=Decimal('10.00'), pcs=2,
+                            discount=Decimal('0.00'),
+                            paid_amount=Decimal('20.00'))
+        payment = baker.make(Payment, party=party, amount=Decimal('30.00'))
+        baker.make(Allocation, payment=payment, record=record,
+                   amount=Decimal('10.00'))
+        AdvanceLedger.objects.create(
+            party=party, payment=payment, amount=Decimal('20.00'),
+            remaining_amount=Decimal('10.00'), direction='IN')
+        AdvanceLedger.objects.create(
+            party=party, payment=payment, record=record,
+            amount=Decimal('10.00'), remaining_amount=0, direction='OUT')
+
+        RecordService.rollback(record)
+
+        remaining = AdvanceLedger.objects.filter(
+            payment=payment, direction='IN'
+        ).values_list('remaining_amount', flat=True)
+        assert sorted(remaining) == [Decimal('10.00'), Decimal('20.00')]
+
+
+@pytest.mark.django_db
+class TestRecordGeneratedColumns:
+
+    def test_amount_and_outstanding_are_stored_and_filterable(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        record = baker.make(Record, party=party, service_type=service,
+                            rate=Decimal('12.50'), pcs=4,
+                            discount=Decimal('5.00'),
+                            paid_amount=Decimal('20.00'))
+
+        record.apply_payment(Decimal('5.00'))
+        record.refresh_from_db()
+
+        assert record.amount == record.gross_amount == Decimal('50.00')
+        assert record.outstanding == Decimal('20.00')
+        assert record.outstanding == record.remaining_amount
+        assert Record.objects.filter(
+            outstanding__gt=0, gross_amount=50).get() == record
+
+    def test_amount_property_does_not_wait_for_the_database(self):
+        record = Record(rate=Decimal('12.50'), pcs=4)
+        assert record.amount == Decimal('50.00')
+
+        party = baker.make(Party)
+        record = baker.make(Record, party=party, rate=Decimal('10.00'), pcs=2)
+        record.pcs = 3
+        record.save()
+
+        assert record.amount == Decimal('30.00')
+        assert record.remaining_amount == Decimal('30.00') - record.discount
+
+
+@pytest.mark.django_db
+class TestRecordKeysetPagination:
+
+    def test_cursor_walks_every_record_once_in_list_order(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        for i in range(7):
+            baker.make(Record, party=party, service_type=service,
+                       pcs=1, rate=Decimal('10.00'), discount=Decimal('0.00'),
+                       paid_amount=Decimal('0.00'),
+                       record_date=localdate() - timedelta(days=i // 2))
+
+        api_client.force_authenticate(user=user)
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            response = api_client.get(reverse('record-list'), {
+                'cursor': cursor, 'page_size': 3})
+            assert response.status_code == status.HTTP_200_OK
+            assert response.data['count'] == 7
+            seen.extend(item['id'] for item in response.data['results'])
+            cursor = response.data['next_cursor']
+
+        expected = list(Record.objects.filter(party=party)
+                        .order_by('-record_date', '-pk')
+                        .values_list('pk', flat=True))
+        assert seen == expected
+
+    @pytest.mark.parametrize('values', [
+        [{'a': 1}, {'b': 2}], [[1], [2]], ['x', 'y'], [None, None],
+        ['2026-01-01'], 'not a list',
+    ])
+    def test_malformed_cursor_is_a_400(self, api_client, values):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        api_client.force_authenticate(user=user)
+        token = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+        response = api_client.get(reverse('record-list'), {'cursor': token})
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.data == {'cursor': 'Invalid cursor.'}
+
+    def test_cursor_page_can_skip_count(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        baker.make(Record, party=party, pcs=1, rate=Decimal('10.00'),
+                   discount=Decimal('0.00'), paid_amount=Decimal('0.00'),
+                   _quantity=3)
+
+        api_client.force_authenticate(user=user)
+        response = api_client.get(reverse('record-list'), {
+            'cursor': '', 'count': 'false'})
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['count'] is None
+        assert response.data['next_cursor'] is None
+        assert len(response.data['results']) == 3
+
+    def test_page_numbers_still_work_without_cursor(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        baker.make(Record, party=party, pcs=1, rate=Decimal('10.00'),
+                   discount=Decimal('0.00'), paid_amount=Decimal('0.00'),
+                   _quantity=3)
+
+        api_client.force_authenticate(user=user)
+        response = api_client.get(reverse('record-list'), {'page_size': 2})
+
+        assert response.data['count'] == 3
+        assert 'next_cursor' not in response.data
+
+
+@pytest.mark.django_db
+class TestRecordBulkImport:
+
+    def upload(self, api_client, name, content, **extra):
+        return api_client.post(
+            reverse('record-bulk-import'),
+            {'file': SimpleUploadedFile(name, content.encode()), **extra},
+            format='multipart',
+        )
+
+    def setup_tenant(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        baker.make(Work_Rate, party=party, service_type=service,
+                   rate=Decimal('12.00'))
+        return user, party, service
+
+    def test_csv_import_creates_valid_rows_and_reports_the_rest(self, api_client):
+        user, party, service = self.setup_tenant()
+        other_service = baker.make(Service_Type, user=user)
+        foreign_party = baker.make(Party)
+        api_client.force_authenticate(user=user)
+
+        content = (
+            'party_id,service_type_id,pcs,rate,discount,rate_mode,record_date\n'
+            f'{party.id},{service.id},5,,,system,2026-01-02\n'
+            f'{party.id},{service.id},2,30.00,5,manual,\n'
+            f'{party.id},{service.id},0,,,system,\n'
+            f'{foreign_party.id},{service.id},1,,,system,\n'
+            f'{party.id},{other_service.id},1,,,system,\n'
+            f'{party.id},{service.id},1,10.00,50,manual,\n'
+        )
+        response = self.upload(api_client, 'records.csv', content)
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.data['created'] == 2
+        assert response.data['failed'] == 4
+        assert {e['line']: sorted(e['errors']) for e in response.data['errors']} == {
+            4: ['pcs'], 5: ['party_id'], 6: ['rate'], 7: ['discount'],
+        }
+
+        system, manual = Record.objects.filter(party=party).order_by('pk')
+        assert system.rate == Decimal('12.00')
+        assert system.record_date.isoformat() == '2026-01-02'
+        assert manual.rate == Decimal('30.00')
+        assert manual.record_date == localdate()
+
+    def test_ndjson_import_spends_advance_in_one_fifo_pass(self, api_client):
+        user, party, service = self.setup_tenant()
+        api_client.force_authenticate(user=user)
+        payment = baker.make(Payment, party=party, amount=Decimal('150.00'))
+        PaymentService.allocate_payment(payment)
+
+        content = '\n'.join([
+            f'{{"party_id": {party.id}, "service_type_id": {service.id}, "pcs": 1, '
+            f'"rate": "100.00", "rate_mode": "manual", "record_date": "2026-01-0{day}"}}'
+            for day in (3, 1)
+        ] + ['not json', ''])
+        response = self.upload(api_client, 'records.ndjson', content)
+
+        assert response.data['created'] == 2
+        assert response.data['errors'][0]['line'] == 3
+
+        older, newer = Record.objects.filter(party=party).order_by('record_date')
+        assert older.paid_amount == Decimal('100.00')
+        assert newer.paid_amount == Decimal('50.00')
+        assert AdvanceLedger.objects.get(direction='IN').remaining_amount == 0
+        assert AdvanceLedger.objects.filter(direction='OUT').count() == 2
+        assert PartyBalance.objects.get(party=party).due == Decimal('50.00')
+
+    def import_queries(self, api_client, rows):
+        user, party, service = self.setup_tenant()
+        api_client.force_authenticate(user=user)
+        content = 'party_id,service_type_id,pcs\n' + ''.join(
+            f'{party.id},{service.id},1\n' for _ in range(rows))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.upload(api_client, 'records.csv', content)
+        assert response.data['created'] == rows
+        return len(queries.captured_queries)
+
+    def test_query_count_does_not_grow_with_rows(self, api_client):
+        # 100 rows still fit in one sqlite INSERT batch
+        assert self.import_queries(api_client, 5) == self.import_queries(api_client, 100)
+
+    def test_rejects_unknown_format_and_sub_users(self, api_client):
+        user, party, service = self.setup_tenant()
+        api_client.force_authenticate(user=user)
+        assert self.upload(api_client, 'records.xls', 'x').status_code == status.HTTP_400_BAD_REQUEST
+
+        child = baker.make(settings.AUTH_USER_MODEL, parent=user)
+        api_client.force_authenticate(user=child)
+        response = self.upload(api_client, 'records.csv', 'party_id\n')
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.django_db
+class TestRecordBulkWrites:
+
+    def build_party(self, rng):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        today = localdate()
+
+        def add_record():
+            return baker.make(
+                Record, party=party, service_type=service,
+                pcs=rng.randint(1, 5), rate=Decimal(rng.randint(10, 50)),
+                discount=Decimal('0.00'), paid_amount=Decimal('0.00'),
+                record_date=today - timedelta(days=rng.randint(0, 60)))
+
+        for _ in range(rng.randint(3, 10)):
+            add_record()
+        for _ in range(rng.randint(1, 4)):
+            payment = baker.make(Payment, party=party,
+                                 amount=Decimal(rng.randint(10, 400)))
+            PaymentService.allocate_payment(payment)
+            for _ in range(rng.randint(0, 2)):
+                RecordService.apply_advance(add_record())
+
+        records = list(Record.objects.filter(party=party))
+        picked = rng.sample(records, rng.randint(1, len(records)))
+        return user, party, [record.pk for record in picked]
+
+    def snapshot(self, party):
+        return {
+            'records': sorted(Record.objects.filter(party=party).values_list(
+                'pk', 'pcs', 'rate', 'discount', 'paid_amount')),
+            'allocations': sorted(Allocation.objects.filter(
+                record__party=party).values_list(
+                    'payment_id', 'record_id', 'amount')),
+            'ledger': sorted(AdvanceLedger.objects.filter(
+                party=party).values_list(
+                    'payment_id', 'record_id', 'direction', 'amount',
+                    'remaining_amount'), key=repr),
+            'rollups': sorted(MonthlyRollup.objects.filter(
+                party=party).values_list('month', 'pcs', 'amount', 'paid')),
+        }
+
+    @pytest.mark.parametrize('seed', range(20))
+    def test_bulk_delete_matches_one_by_one(self, seed):
+        rng = random.Random(seed)
+        user, party, ids = self.build_party(rng)
+
+        with transaction.atomic():
+            for pk in ids:
+                record = Record.objects.get(pk=pk)
+                RecordService.rollback(record)
+                RecordService.cleanup_pending_requests_for_deleted_record(record)
+                record.delete()
+            expected = self.snapshot(party)
+            transaction.set_rollback(True)
+
+        RecordService.bulk_delete(
+            [Record.objects.select_related('party').get(pk=pk) for pk in ids])
+
+        assert self.snapshot(party) == expected
+
+    @pytest.mark.parametrize('seed', range(20))
+    def test_bulk_update_matches_one_by_one(self, seed):
+        rng = random.Random(seed)
+        user, party, ids = self.build_party(rng)
+        changes = rng.choice([
+            {'pcs': rng.randint(1, 6)},
+            {'rate': Decimal(rng.randint(1, 60))},
+            {'pcs': 1, 'discount': Decimal('5.00')},
+        ])
+
+        with transaction.atomic():
+            for pk in ids:
+                record = Record.objects.get(pk=pk)
+                RecordService.adjust_after_update(record, changes)
+                Record.objects.filter(pk=pk).update(**changes)
+            MonthlyRollupService.refresh(party.pk)
+            expected = self.snapshot(party)
+            transaction.set_rollback(True)
+
+        RecordService.bulk_update(
+            [Record.objects.select_related('party').get(pk=pk) for pk in ids],
+            changes)
+
+        assert self.snapshot(party) == expected
+
+    def test_bulk_delete_endpoint_writes_audit_rows(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        records = [
+            baker.make(Record, party=party, service_type=service, pcs=1,
+                       rate=Decimal('10.00'), discount=Decimal('0.00'),
+                       paid_amount=Decimal('0.00'),
+                       record_date=localdate() - timedelta(days=i))
+            for i in range(4)
+        ]
+        PaymentService.allocate_payment(
+            baker.make(Payment, party=party, amount=Decimal('25.00')))
+
+        api_client.force_authenticate(user=user)
+        response = api_client.post(reverse('record-bulk-delete'), {
+            'ids': [records[3].pk, records[2].pk]}, format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data == {'deleted': 2}
+        assert set(Record.objects.filter(party=party).values_list(
+            'paid_amount', flat=True)) == {Decimal('10.00')}
+        assert AdvanceLedger.objects.get(
+            party=party, direction='IN').remaining_amount == Decimal('5.00')
+        logs = AuditLog.objects.filter(action='DELETE', model_name='Record')
+        assert sorted(logs.values_list('object_id', flat=True)) == sorted(
+            [records[3].pk, records[2].pk])
+        assert all(log.before['pcs'] == 1 for log in logs)
+
+    def test_bulk_update_endpoint(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        other = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        records = [
+            baker.make(Record, party=party, service_type=service, pcs=2,
+                       rate=Decimal('10.00'), discount=Decimal('0.00'),
+                       paid_amount=Decimal('0.00'))
+            for _ in range(3)
+        ]
+        foreign = baker.make(Record, party=baker.make(Party, user=other),
+                             service_type=service, pcs=1, rate=Decimal('1.00'),
+                             discount=Decimal('0.00'),
+                             paid_amount=Decimal('0.00'))
+        url = reverse('record-bulk-update')
+        ids = [record.pk for record in records]
+
+        api_client.force_authenticate(user=user)
+        missing = api_client.post(
+            url, {'ids': ids + [foreign.pk], 'rate': '5.00'}, format='json')
+        too_big = api_client.post(
+            url, {'ids': ids, 'discount': '50.00'}, format='json')
+        response = api_client.post(
+            url, {'ids': ids, 'rate': '5.00', 'reason': 'typo'}, format='json')
+
+        assert missing.status_code == status.HTTP_400_BAD_REQUEST
+        assert too_big.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.status_code == status.HTTP_200_OK
+        assert [row['amount'] for row in response.data] == ['10.00'] * 3
+        assert AuditLog.objects.filter(
+            action='UPDATE', reason='typo').count() == 3
+
+    def test_bulk_delete_query_count_stays_flat(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        service = baker.make(Service_Type, user=user)
+        api_client.force_authenticate(user=user)
+        LedgerVersion.bump(user.pk)  # its first write costs extra queries
+        counts = []
+
+        for size in (3, 30):
+            party = baker.make(Party, user=user)
+            records = [
+                baker.make(Record, party=party, service_type=service, pcs=1,
+                           rate=Decimal('10.00'), discount=Decimal('0.00'),
+                           paid_amount=Decimal('0.00'),
+                           record_date=localdate() - timedelta(days=i))
+                for i in range(size * 2)
+            ]
+            PaymentService.allocate_payment(baker.make(
+                Payment, party=party, amount=Decimal(size * 10)))
+
+            with CaptureQueriesContext(connection) as queries:
+                response = api_client.post(reverse('record-bulk-delete'), {
+                    'ids': [r.pk for r in records[size:]]}, format='json')
+            counts.append(len(queries.captured_queries))
+            assert response.status_code == status.HTTP_200_OK
+
+        assert counts[0] == counts[1]
@@ -0,0 +1,84 @@
+import json
+import pytest
+from decimal import Decimal
+from django.urls import reverse
+from history import benchmark
+from history.models import *
+from history.rows import mapper_for
+from history.serializer import (
+    AdvanceLedgerSerializer, PaymentSerializer, RecordSerializer,
+)
+from rest_framework.renderers import JSONRenderer
+
+LISTS = [
+    ('record-list', Record, RecordSerializer),
+    ('payment-list', Payment, PaymentSerializer),
+    ('advance-ledger-list', AdvanceLedger, AdvanceLedgerSerializer),
+]
+
+
+@pytest.fixture
+def tenant(db):
+    return benchmark.seed_tenant(
+        parties=3, records=5, payments=2, advances=1, requests=0)
+
+
+def as_json(data):
+    return json.loads(JSONRenderer().render(data))
+
+
+def serialized(model, serializer_class, ids):
+    instances = model.objects.in_bulk(ids)
+    return as_json(serializer_class(
+        [instances[pk] for pk in ids], many=True).data)
+
+
+@pytest.mark.django_db
+class TestFastList:
+
+    @pytest.mark.parametrize('url_name, model, serializer_class', LISTS)
+    def test_list_matches_the_serializer(self, api_client, tenant,
+                                         url_name, model, serializer_class):
+        api_client.force_authenticate(user=tenant.owner)
+        response = api_client.get(reverse(url_name), {'page_size': 50})
+
+        rows = response.json()['results']
+        assert rows
+        assert rows == serialized(
+            model, serializer_class, [row['id'] for row in rows])
+
+    def test_cursor_pages_match_the_serializer(self, api_client, tenant):
+        api_client.force_authenticate(user=tenant.owner)
+        first = api_client.get(
+            reverse('record-list'), {'page_size': 4, 'cursor': ''}).json()
+        second = api_client.get(first['next']).json()
+
+        for page in (first, second):
+            ids = [row['id'] for row in page['results']]
+            assert page['results'] == serialized(Record, RecordSerializer, ids)
+        assert not {row['id'] for row in first['results']} & {
+            row['id'] for row in second['results']}
+
+    def test_advance_entries_without_record_or_payment(self, tenant):
+        entry = AdvanceLedger.objects.filter(
+            party__user=tenant.owner, record__isnull=True).first()
+        AdvanceLedger.objects.filter(pk=entry.pk).update(payment=None)
+        entry.refresh_from_db()
+
+        mapper = mapper_for(AdvanceLedgerSerializer)
+        row = AdvanceLedger.objects.filter(pk=entry.pk).values(*mapper.lookups)
+
+        data = as_json(mapper.map(row))[0]
+        assert data['payment'] is None and data['record'] is None
+        assert data == as_json(AdvanceLedgerSerializer(entry).data)
+
+    def test_benchmark_runs_both_variants(self, tenant):
+        results = benchmark.run_serializers(tenant, rows=10)
+
+        by_name = {row['name']: row for row in results}
+        for name in ('record', 'payment', 'advance-ledger'):
+            fast = by_name[f'{name}-row-mapper']
+            slow = by_name[f'{name}-serializer']
+            assert fast['rows'] == slow['rows'] > 0
+            assert fast['queries'] == 1
+            assert fast['rows_per_s'] > 0
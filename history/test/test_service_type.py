@@ -1,6 +1,11 @@
 import pytest
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from history.models import Service_Type
+from django.utils.timezone import localdate
+from history.models import Party, Record, Service_Type
+from model_bakery import baker
 from rest_framework import status
 from django.urls import reverse
 
@@ -58,3 +63,20 @@ class TestGetingDetails:
         assert response.data == []
 
 
+
+    def test_used_counts_this_months_records(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        idle = baker.make(Service_Type, user=user)
+        today = localdate()
+        for day in (today, today.replace(day=1), today - timedelta(days=40)):
+            baker.make(Record, party=party, service_type=service, pcs=1,
+                       rate=Decimal('10.00'), discount=Decimal('0.00'),
+                       paid_amount=Decimal('0.00'), record_date=day)
+
+        api_client.force_authenticate(user=user)
+        response = api_client.get(reverse('service-type-list'))
+        used = {row['id']: row['used'] for row in response.data}
+
+        assert used == {service.id: 2, idle.id: 0}
@@ -8,6 +8,10 @@ from django.urls import reverse
 from datetime import date, timedelta
 from django.utils.timezone import localdate
 from decimal import Decimal
+from io import StringIO
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 
 @pytest.mark.django_db
@@ -143,6 +147,98 @@ class TestRecordSummary:
         assert audit_log_update.after is not None
         assert audit_log_update.after['pcs'] == 9
 
+    def test_record_summary_totals_and_breakdown(self, api_client, get_summary):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        cutting = baker.make(Service_Type, user=user, type_of_work="Cutting")
+        polish = baker.make(Service_Type, user=user, type_of_work="Polish")
+
+        for pcs in (2, 3):
+            baker.make(Record, party=party, service_type=cutting, pcs=pcs,
+                       rate=Decimal('10.00'), discount=Decimal('0.00'),
+                       paid_amount=Decimal('5.00'), record_date=date(2026, 1, 5))
+        baker.make(Record, party=party, service_type=polish, pcs=1,
+                   rate=Decimal('40.00'), discount=Decimal('0.00'),
+                   paid_amount=Decimal('0.00'), record_date=date(2026, 1, 6))
+
+        api_client.force_authenticate(user=user)
+        response = get_summary({
+            'type': 'record',
+            'date_from': '2026-01-01',
+            'date_to': '2026-01-31',
+        })
+
+        summary = response.data['summary']
+        breakdown = {
+            item['service_type__type_of_work']: item
+            for item in summary['service_type_summary']
+        }
+
+        assert summary['total_record'] == 3
+        assert Decimal(summary['total_amount']) == Decimal('90.00')
+        assert Decimal(summary['unpaid_amount']) == Decimal('80.00')
+        assert summary['total_pcs'] == 6
+        assert response.data['pagination']['total'] == 3
+        assert Decimal(breakdown['Cutting']['total_amount']) == Decimal('50.00')
+        assert Decimal(breakdown['Cutting']['unpaid_amount']) == Decimal('40.00')
+        assert breakdown['Cutting']['total_pcs'] == 5
+        assert breakdown['Polish']['total_pcs'] == 1
+
+    def test_record_summary_cursor_walks_every_record_once(self, api_client, get_summary):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        records = [
+            baker.make(Record, party=party, service_type=service, pcs=1,
+                       rate=Decimal('10.00'), discount=Decimal('0.00'),
+                       paid_amount=Decimal('0.00'),
+                       record_date=date(2026, 1, 1 + i // 2))
+            for i in range(7)
+        ]
+
+        api_client.force_authenticate(user=user)
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            response = get_summary({
+                'type': 'record',
+                'date_from': '2026-01-01',
+                'date_to': '2026-01-31',
+                'page_size': 3,
+                'cursor': cursor,
+            })
+            seen.extend(item['id'] for item in response.data['result'])
+            cursor = response.data['pagination']['next_cursor']
+
+        assert seen == [r.id for r in records]
+
+    def test_record_summary_rejects_bad_cursor(self, api_client, get_summary):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        api_client.force_authenticate(user=user)
+
+        response = get_summary({'type': 'record', 'cursor': 'not-a-cursor'})
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_audit_log_summary_cursor_walks_newest_first(self, api_client, get_summary):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        logs = baker.make(AuditLog, user=user, party=party, _quantity=5)
+
+        api_client.force_authenticate(user=user)
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            response = get_summary({
+                'type': 'audit_log', 'page_size': 2,
+                'cursor': cursor, 'count': 'false'})
+            assert response.data['pagination']['total'] is None
+            seen.extend(item['id'] for item in response.data['results'])
+            cursor = response.data['pagination']['next_cursor']
+
+        expected = sorted(logs, key=lambda log: (log.created_at, log.id), reverse=True)
+        assert seen == [log.id for log in expected]
+
 
 @pytest.mark.django_db
 class TestPaymentSummary:
@@ -334,6 +430,40 @@ class TestPaymentSummary:
         assert breakdown['CARD']['total_pcs'] == 11
         assert Decimal(breakdown['CARD']['total_amount']) == Decimal('1165.20')
 
+    def test_payment_summary_query_count_does_not_depend_on_allocations(self, api_client, get_summary):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        service = baker.make(Service_Type, user=user, type_of_work="CARD")
+        api_client.force_authenticate(user=user)
+        counts = []
+
+        for size in (2, 30):
+            party = baker.make(Party, user=user)
+            for _ in range(size):
+                baker.make(Record, party=party, service_type=service, pcs=1,
+                           rate=Decimal("10.00"), discount=Decimal("0.00"),
+                           paid_amount=Decimal("0.00"),
+                           record_date=date(2026, 5, 1))
+            payment = baker.make(Payment, party=party,
+                                 amount=Decimal(size * 10 + 5),
+                                 payment_date=date(2026, 5, 2))
+            PaymentService.allocate_payment(payment)
+
+            with CaptureQueriesContext(connection) as queries:
+                response = get_summary({
+                    'type': 'payment',
+                    'party': 'single',
+                    'party_id': party.id,
+                    'date_from': '2026-05-01',
+                    'date_to': '2026-05-31',
+                })
+
+            counts.append(len(queries))
+            item = response.data['summary']['service_type_summary'][0]
+            assert item['total_pcs'] == size
+            assert Decimal(item['total_amount']) == Decimal(size * 10 + 5)
+
+        assert counts[0] == counts[1]
+
     def test_payment_works_with_audit_log(self, api_client, get_summary):
         today = localdate()
         date_from = (today - timedelta(days=1)).isoformat()
@@ -443,3 +573,232 @@ class TestAdvanceLedgerSummary:
         assert response_out.status_code == status.HTTP_200_OK
         assert advance_in == {payment.id}
         assert advance_out == {record.id}
+
+
+@pytest.mark.django_db
+class TestSummaryCache:
+
+    def setup_tenant(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        baker.make(Record, party=party, service_type=service, pcs=2,
+                   rate=Decimal('10.00'), discount=Decimal('0.00'),
+                   paid_amount=Decimal('0.00'), record_date=date(2026, 1, 5))
+        api_client.force_authenticate(user=user)
+        return user, party
+
+    params = {'type': 'record', 'date_from': '2026-01-01', 'date_to': '2026-01-31'}
+
+    def test_repeat_request_is_served_from_cache(self, api_client, get_summary):
+        self.setup_tenant(api_client)
+        first = get_summary(self.params)
+
+        with CaptureQueriesContext(connection) as queries:
+            second = get_summary(self.params)
+
+        assert second.status_code == status.HTTP_200_OK
+        assert second.data == first.data
+        assert second['ETag'] == first['ETag']
+        # only the ledger version lookup
+        assert len(queries.captured_queries) == 1
+
+    def test_matching_etag_gets_304(self, api_client, get_summary):
+        self.setup_tenant(api_client)
+        etag = get_summary(self.params)['ETag']
+
+        response = api_client.get(
+            reverse('summary'), self.params, HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    def test_ledger_write_moves_the_version(self, api_client, get_summary):
+        user, party = self.setup_tenant(api_client)
+        before = get_summary(self.params)
+
+        response = api_client.post(reverse('payment-list'), {
+            'party_id': party.id, 'amount': 5})
+        assert response.status_code == status.HTTP_201_CREATED
+
+        after = api_client.get(
+            reverse('summary'), self.params, HTTP_IF_NONE_MATCH=before['ETag'])
+        assert after.status_code == status.HTTP_200_OK
+        assert after['ETag'] != before['ETag']
+        assert Decimal(after.data['summary']['unpaid_amount']) == Decimal('15.00')
+        assert LedgerVersion.current(user.pk) == 1
+
+    def test_cache_is_per_user(self, api_client, get_summary):
+        self.setup_tenant(api_client)
+        first = get_summary(self.params)
+
+        other = baker.make(settings.AUTH_USER_MODEL)
+        api_client.force_authenticate(user=other)
+        second = get_summary(self.params)
+
+        assert second['ETag'] != first['ETag']
+        assert second.data['summary']['total_record'] == 0
+
+
+@pytest.mark.django_db
+class TestMonthlyRollup:
+
+    def make_record(self, party, service, day, pcs=1, paid='0.00'):
+        return baker.make(Record, party=party, service_type=service, pcs=pcs,
+                          rate=Decimal('10.00'), discount=Decimal('1.00'),
+                          paid_amount=Decimal(paid), record_date=day)
+
+    def raw_totals(self, records):
+        records = list(records)
+        return {
+            'total_record': len(records),
+            'total_amount': sum((r.amount for r in records), Decimal('0')),
+            'unpaid_amount': sum((r.outstanding for r in records), Decimal('0')),
+            'total_pcs': sum(r.pcs for r in records),
+        }
+
+    def test_record_and_payment_writes_keep_the_rollup_in_sync(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        jan = self.make_record(party, service, date(2026, 1, 5), pcs=3)
+        self.make_record(party, service, date(2026, 2, 9), pcs=2)
+
+        payment = Payment.objects.create(party=party, amount=Decimal('35.00'))
+        PaymentService.allocate_payment(payment)
+
+        rollup = MonthlyRollup.objects.get(party=party, month=date(2026, 1, 1))
+        assert (rollup.record_count, rollup.pcs) == (1, 3)
+        assert rollup.paid == Decimal('29.00')
+        assert MonthlyRollup.objects.get(
+            party=party, month=date(2026, 2, 1)).paid == Decimal('6.00')
+
+        PaymentService.rollback_payment(payment)
+        jan.delete()
+
+        assert not MonthlyRollup.objects.filter(
+            party=party, month=date(2026, 1, 1)).exists()
+        assert MonthlyRollup.objects.get(
+            party=party, month=date(2026, 2, 1)).paid == Decimal('0.00')
+
+    def test_record_update_through_the_api_refreshes_its_month(self, api_client):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        record = self.make_record(party, service, date(2026, 1, 5))
+
+        api_client.force_authenticate(user=user)
+        response = api_client.patch(
+            reverse('record-detail', args=[record.pk]),
+            {'pcs': 7}, format='json')
+        rollup = MonthlyRollup.objects.get(party=party)
+
+        assert response.status_code == status.HTTP_200_OK
+        assert (rollup.pcs, rollup.amount) == (7, Decimal('70.00'))
+
+    def test_moving_a_record_to_another_month_refreshes_both(self):
+        # what RecordAdmin's list_editable record_date does
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        record = self.make_record(party, service, date(2026, 1, 5), pcs=3)
+
+        record = Record.objects.get(pk=record.pk)
+        record.record_date = date(2026, 2, 9)
+        record.save()
+
+        assert list(MonthlyRollup.objects.filter(party=party).values_list(
+            'month', 'pcs')) == [(date(2026, 2, 1), 3)]
+
+    def test_advance_spent_on_a_record_refreshes_its_month_once(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        for _ in range(3):
+            payment = Payment.objects.create(party=party, amount=Decimal('5.00'))
+            PaymentService.allocate_payment(payment)
+        record = self.make_record(party, service, date(2026, 1, 5), pcs=2)
+
+        with CaptureQueriesContext(connection) as queries:
+            RecordService.apply_advance(record)
+        refreshes = [q for q in queries.captured_queries
+                     if q['sql'].startswith('DELETE FROM "history_monthlyrollup"')]
+
+        assert len(refreshes) == 1
+        assert MonthlyRollup.objects.get(party=party).paid == Decimal('15.00')
+
+    def test_multi_month_summary_matches_raw_records(self, api_client, get_summary):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        other = baker.make(Party, user=user)
+        cutting = baker.make(Service_Type, user=user, type_of_work='Cutting')
+        polish = baker.make(Service_Type, user=user, type_of_work='Polish')
+
+        days = [date(2025, 11, 30), date(2025, 12, 14), date(2026, 1, 1),
+                date(2026, 2, 27), date(2026, 3, 10), date(2026, 3, 31),
+                date(2026, 4, 2)]
+        for i, day in enumerate(days):
+            self.make_record(party if i % 2 else other,
+                             cutting if i % 3 else polish, day,
+                             pcs=i + 1, paid='2.00' if i % 2 else '0.00')
+
+        api_client.force_authenticate(user=user)
+        params = {'type': 'record', 'date_from': '2025-12-14',
+                  'date_to': '2026-03-30', 'page_size': 50}
+        with CaptureQueriesContext(connection) as queries:
+            response = get_summary(params)
+        sql = ' '.join(q['sql'] for q in queries.captured_queries)
+
+        expected = self.raw_totals(Record.objects.filter(
+            party__user=user, record_date__gte=date(2025, 12, 14),
+            record_date__lte=date(2026, 3, 30)))
+        summary = response.data['summary']
+
+        assert 'history_monthlyrollup' in sql
+        assert {key: summary[key] for key in expected} == expected
+        assert len(response.data['result']) == expected['total_record']
+        assert [s['service_type__type_of_work']
+                for s in summary['service_type_summary']] == ['Cutting', 'Polish']
+
+        whole = get_summary({'type': 'record', 'party': 'single',
+                             'party_id': party.pk}).data['summary']
+        expected = self.raw_totals(Record.objects.filter(party=party))
+        assert {key: whole[key] for key in expected} == expected
+
+    def test_rebuild_command_fixes_drift(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        self.make_record(party, service, date(2026, 1, 5), pcs=4)
+        MonthlyRollup.objects.filter(party=party).update(pcs=99)
+        Record.objects.filter(party=party).update(record_date=date(2026, 2, 1))
+
+        out = StringIO()
+        call_command('rebuild_monthly_rollups', '--party', party.pk, stdout=out)
+
+        rollup = MonthlyRollup.objects.get(party=party)
+        assert (rollup.month, rollup.pcs) == (date(2026, 2, 1), 4)
+        assert '1 rollup rows written' in out.getvalue()
+
+    def test_migration_backfills_existing_records(self):
+        # tenants that predate MonthlyRollup must not see zero totals
+        from importlib import import_module
+        from django.apps import apps
+        migration = import_module('history.migrations.0026_monthlyrollup')
+
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        self.make_record(party, service, date(2026, 1, 5), pcs=3, paid='4.00')
+        self.make_record(party, service, date(2026, 1, 20), pcs=2)
+        self.make_record(party, service, date(2026, 2, 9), pcs=1)
+        expected = sorted(
+            MonthlyRollup.objects.filter(party=party).values_list(
+                'month', 'pcs', 'amount', 'discount', 'paid', 'record_count'))
+        MonthlyRollup.objects.all().delete()
+
+        migration.backfill_rollups(apps, None)
+
+        assert sorted(MonthlyRollup.objects.filter(party=party).values_list(
+            'month', 'pcs', 'amount', 'discount', 'paid', 'record_count')
+        ) == expected
+        assert len(expected) == 2
@@ -1,6 +1,13 @@
 import pytest
+from decimal import Decimal
 from django.conf import settings
-from history.models import Party, Record, Service_Type, Work_Rate
+from django.contrib.admin.sites import AdminSite
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from history.admin import Work_RateAdmin
+from history.models import LedgerVersion, Party, Record, Service_Type, Work_Rate
+from history.service import RecordImportService
+from history.utils.rates import rate_cache_key, rate_map
 from model_bakery import baker
 from rest_framework import status
 from django.urls import reverse
@@ -279,3 +286,125 @@ class TestUinqueConditionsWork_rate:
                                         })
         
         assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestRateCache:
+
+    def create_record(self, api_client, party, service):
+        return api_client.post(reverse('record-list'), {
+            'party_id': party.id,
+            'service_type_id': service.id,
+            'pcs': 2,
+            'discount': '0.00',
+            'rate_mode': 'system',
+        }, format='json')
+
+    def cached_rate(self, party, service):
+        return rate_map(party.user_id).get((party.pk, service.pk))
+
+    def current_key(self, user):
+        return rate_cache_key(
+            user.pk, LedgerVersion.current_rate_token(user.pk))
+
+    def test_single_create_is_one_indexed_rate_query(self, api_client):
+        # no token read and no whole-map load on a cold cache
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        work_rate = Work_Rate.objects.create(
+            party=party, service_type=service, rate=Decimal('10.00'))
+        api_client.force_authenticate(user=user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.create_record(api_client, party, service)
+        rate_queries = [q['sql'] for q in queries.captured_queries
+                        if 'history_work_rate' in q['sql']
+                        or 'rate_token' in q['sql']]
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert len(rate_queries) == 1
+        assert '"history_work_rate"."service_type_id" =' in rate_queries[0]
+        assert Decimal(response.data['rate']) == Decimal('10.00')
+
+        api_client.patch(reverse('work-rate-detail', args=[work_rate.id]),
+                         {'rate': 25})
+        response = self.create_record(api_client, party, service)
+        assert Decimal(response.data['rate']) == Decimal('25.00')
+
+        work_rate.delete()
+        response = self.create_record(api_client, party, service)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_admin_full_rate_action_busts_the_cache(
+            self, django_capture_on_commit_callbacks):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        Work_Rate.objects.create(
+            party=party, service_type=service, rate=Decimal('10.00'))
+        assert self.cached_rate(party, service) == Decimal('10.00')
+
+        admin = Work_RateAdmin(Work_Rate, AdminSite())
+        admin.message_user = lambda *args, **kwargs: None
+        with django_capture_on_commit_callbacks(execute=True) as callbacks:
+            admin.full_rate(None, Work_Rate.objects.filter(party=party))
+            # the token only moves once the new rates are committed
+            key_before_commit = self.current_key(user)
+
+        assert len(callbacks) == 1
+        assert self.current_key(user) != key_before_commit
+        assert self.cached_rate(party, service) == Decimal('1000.00')
+
+    def test_writes_move_the_key_instead_of_deleting_it(self):
+        # other workers' caches can't be deleted from here; the key they
+        # read comes from the database, so it moves for them too
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        work_rate = Work_Rate.objects.create(
+            party=party, service_type=service, rate=Decimal('10.00'))
+        self.cached_rate(party, service)
+        old_key = self.current_key(user)
+
+        work_rate.rate = Decimal('25.00')
+        work_rate.save()
+
+        assert self.current_key(user) != old_key
+        assert self.cached_rate(party, service) == Decimal('25.00')
+
+    def test_rolled_back_rates_are_never_served(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        work_rate = Work_Rate.objects.create(
+            party=party, service_type=service, rate=Decimal('10.00'))
+
+        with transaction.atomic():
+            work_rate.rate = Decimal('99.00')
+            work_rate.save()
+            assert self.cached_rate(party, service) == Decimal('99.00')
+            transaction.set_rollback(True)
+
+        assert self.cached_rate(party, service) == Decimal('10.00')
+        work_rate.refresh_from_db()
+        work_rate.rate = Decimal('25.00')
+        work_rate.save()
+        assert self.cached_rate(party, service) == Decimal('25.00')
+
+    def test_import_reads_the_rate_token_once(self):
+        user = baker.make(settings.AUTH_USER_MODEL)
+        party = baker.make(Party, user=user)
+        service = baker.make(Service_Type, user=user)
+        Work_Rate.objects.create(
+            party=party, service_type=service, rate=Decimal('10.00'))
+        rows = [(line, {'party_id': party.pk, 'service_type_id': service.pk,
+                        'pcs': 1}) for line in range(1, 6)]
+
+        with CaptureQueriesContext(connection) as queries:
+            report = RecordImportService.import_rows(user, rows, chunk_size=2)
+        token_reads = [q for q in queries.captured_queries
+                       if 'rate_token' in q['sql']]
+
+        assert report['created'] == 5
+        assert len(token_reads) == 1
@@ -0,0 +1,49 @@
+# utils/importers.py
+import codecs
+import csv
+import json
+
+
+def iter_csv_rows(stream):
+    # yields (line, row) without reading the whole upload into memory
+    reader = csv.DictReader(codecs.iterdecode(stream, 'utf-8-sig'))
+    for row in reader:
+        if not any((value or '').strip() for value in row.values()):
+            continue
+        yield reader.line_num, {
+            key.strip(): (value.strip() if isinstance(value, str) else value)
+            for key, value in row.items() if key
+        }
+
+
+def iter_ndjson_rows(stream):
+    for line, raw in enumerate(codecs.iterdecode(stream, 'utf-8-sig'), start=1):
+        raw = raw.strip()
+        if not raw:
+            continue
+        try:
+            row = json.loads(raw)
+        except ValueError:
+            yield line, None
+            continue
+        yield line, row if isinstance(row, dict) else None
+
+
+def iter_upload_rows(upload, fmt=None):
+    fmt = (fmt or upload.name.rsplit('.', 1)[-1]).lower()
+    if fmt == 'csv':
+        return iter_csv_rows(upload)
+    if fmt in ('ndjson', 'jsonl', 'json'):
+        return iter_ndjson_rows(upload)
+    raise ValueError(f'Unsupported format "{fmt}", use csv or ndjson.')
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,48 @@
+# utils/rates.py
+from django.core.cache import cache
+
+from history.models import LedgerVersion, Work_Rate
+
+RATE_CACHE_TIMEOUT = 60 * 60
+
+
+def rate_cache_key(owner_id, token):
+    # keyed on a token held in the database, so a Work_Rate write retires
+    # the cached map in every worker, whatever the cache backend
+    return f'work_rates:{owner_id}:{token}'
+
+
+def rate_map(owner_id, token=None):
+    # (party_id, service_type_id) -> rate for every party of the owner, for
+    # batch paths: resolve the token once per batch and pass it in
+    if token is None:
+        token = LedgerVersion.current_rate_token(owner_id)
+    key = rate_cache_key(owner_id, token)
+    rates = cache.get(key)
+    if rates is None:
+        rates = {
+            (party_id, service_type_id): rate
+            for party_id, service_type_id, rate in Work_Rate.objects.filter(
+                party__user_id=owner_id
+            ).values_list('party_id', 'service_type_id', 'rate')
+        }
+        cache.set(key, rates, RATE_CACHE_TIMEOUT)
+    return rates
+
+
+def lookup_rate(party, service_type):
+    # a single create costs one indexed query either way, and this one
+    # neither reads the token nor loads the whole map on a cold cache
+    return Work_Rate.objects.filter(
+        party=party, service_type=service_type
+    ).values_list('rate', flat=True).first()
+
+
+def invalidate_rates(*owner_ids):
+    for owner_id in set(owner_ids):
+        LedgerVersion.new_rate_token(owner_id)
+
+
+def invalidate_rates_for(work_rates):
+    # for queryset.update()/delete(), which skip the model signals
+    invalidate_rates(*work_rates.values_list('party__user_id', flat=True))
@@ -2,26 +2,31 @@
 # from django.db.models.functions import Concat
 # from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
 
+import hashlib
 import json
 from decimal import Decimal
+from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.db.models import (
-    Q, F, Value, Func, ExpressionWrapper, DecimalField, aggregates, Sum,
-    OuterRef, Subquery, Case, When,
+    Q, F, Value, Func, DecimalField, aggregates, Sum,
+    OuterRef, Subquery, Case, When, Prefetch,
 )
 from django.db.models.functions import Coalesce
-from django.db import transaction
+from django.db import transaction, connection
 from django_filters.rest_framework import DjangoFilterBackend
 from django.shortcuts import render, get_object_or_404
 from django.db.models.aggregates import Count
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.generics import GenericAPIView
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date
 from django.utils.timezone import now
 from datetime import timedelta
 from collections import defaultdict
@@ -32,12 +37,14 @@ from .serializer import *
 from .permissions import *
 from .filters import *
 from .pagination import *
+from .mixins import ConditionalGetMixin, CsvExportMixin, FastListMixin
+from .utils.importers import iter_upload_rows
 from .service import *
 
 # starting writing code from this point !!!
 
 
-class PartyViewSet(ModelViewSet):
+class PartyViewSet(ConditionalGetMixin, ModelViewSet):
     serializer_class = PartySerializer
     permission_classes = [IsAuthenticated, IsOwner, IsAdminOrReadOnly]
     filter_backends = [DjangoFilterBackend]
@@ -56,14 +63,10 @@ class PartyViewSet(ModelViewSet):
         money_field = DecimalField(max_digits=12, decimal_places=2)
         zero = Value(Decimal('0.00'), output_field=money_field)
 
-        due_expression = ExpressionWrapper(
-            (F('rate') * F('pcs')) - F('discount') - F('paid_amount'),
-            output_field=money_field,
-        )
         due_subquery = Record.objects.filter(
             party=OuterRef('pk')
         ).order_by().values('party').annotate(
-            total=Sum(due_expression)
+            total=Sum('outstanding')
         ).values('total')[:1]
 
         advance_subquery = AdvanceLedger.objects.filter(
@@ -73,13 +76,17 @@ class PartyViewSet(ModelViewSet):
             total=Sum('remaining_amount')
         ).values('total')[:1]
 
+        # PartyBalance is the source of truth; the subqueries only run for
+        # parties that have no balance row yet.
         return queryset.annotate(
             computed_due_raw=Coalesce(
+                F('balance__due'),
                 Subquery(due_subquery, output_field=money_field),
                 zero,
                 output_field=money_field,
             ),
             computed_advance_balance=Coalesce(
+                F('balance__advance'),
                 Subquery(advance_subquery, output_field=money_field),
                 zero,
                 output_field=money_field,
@@ -96,6 +103,16 @@ class PartyViewSet(ModelViewSet):
         if getattr(self.request.user, 'parent_id', None):
             raise PermissionDenied("Only main account can create party.")
         serializer.save(user=self.request.user)
+        LedgerVersion.bump(self.request.user.pk)
+
+    def perform_update(self, serializer):
+        party = serializer.save()
+        LedgerVersion.bump(party.user_id)
+
+    def perform_destroy(self, instance):
+        owner_id = instance.user_id
+        instance.delete()
+        LedgerVersion.bump(owner_id)
 
     def destroy(self, request, *args, **kwargs):
         party = self.get_object()
@@ -132,25 +149,34 @@ class Service_TypeViewSet(ReadOnlyModelViewSet):
         if self.request.user.parent:
             raise PermissionDenied('Unauthorized access.')
 
-        today = now().date()
-        month_start = today.replace(day=1)
+        month_start = now().date().replace(day=1)
+        used = MonthlyRollup.objects.filter(
+            service_type=OuterRef('pk'), month=month_start
+        ).order_by().values('service_type').annotate(
+            n=Sum('record_count')).values('n')
 
         return Service_Type.objects.filter(user=self.request.user).annotate(
-            used=Count('record',
-                       filter=Q(
-                           record__record_date__gte=month_start,
-                           record__record_date__lte=today
-                       ),
-                       distinct=True
-                       )
+            used=Coalesce(Subquery(used), 0)
         )
 
 
-class RecordViewSet(ModelViewSet):
+class RecordViewSet(ConditionalGetMixin, FastListMixin, CsvExportMixin, ModelViewSet):
     filter_backends = [DjangoFilterBackend]
     permission_classes = [IsAuthenticated, IsOwner]
     filterset_class = RecordFilter
-    pagination_class = NormalPagination
+    pagination_class = LedgerPagination
+    count_mode = COUNT_ESTIMATE
+    list_serializer = RecordSerializer
+    export_name = 'records'
+    export_fields = ('id', 'record_date', 'pcs', 'rate', 'discount',
+                     'paid_amount')
+    export_joins = {
+        'amount': F('gross_amount'),
+        'remaining_amount': F('outstanding'),
+        'first_name': F('party__first_name'),
+        'last_name': F('party__last_name'),
+        'type_of_work': F('service_type__type_of_work'),
+    }
 
     def get_serializer_class(self, *args, **kwargs):
 
@@ -181,8 +207,122 @@ class RecordViewSet(ModelViewSet):
         with transaction.atomic():
             record = serializer.save()
             RecordService.apply_advance(record)
+            LedgerService.after_write(record.party)
             return Response(RecordSerializer(record).data, status=status.HTTP_201_CREATED)
 
+    @action(detail=False, methods=['post'], url_path='bulk-import',
+            parser_classes=[MultiPartParser, FormParser])
+    def bulk_import(self, request):
+        if request.user.parent:
+            raise PermissionDenied('Only main account can import records.')
+
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'file': ['No file was submitted.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            rows = iter_upload_rows(upload, request.data.get('format'))
+        except ValueError as e:
+            return Response({'format': [str(e)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        report = RecordImportService.import_rows(request.user, rows)
+        code = status.HTTP_201_CREATED if report['created'] else status.HTTP_400_BAD_REQUEST
+        return Response(report, status=code)
+
+    def bulk_records(self, ids):
+        # the caller's records in the order given, and any ids not found
+        ids = list(dict.fromkeys(ids))
+        found = self.get_queryset().in_bulk(ids)
+        missing = [
+            f'Invalid pk "{pk}" - object does not exist.'
+            for pk in ids if pk not in found
+        ]
+        return [found[pk] for pk in ids if pk in found], missing
+
+    def snapshots(self, records):
+        # one serializer + JSON round trip for every audit row
+        return json.loads(json.dumps(
+            RecordSerializer(records, many=True).data, cls=DjangoJSONEncoder))
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        serializer = RecordBulkDeleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        records, missing = self.bulk_records(serializer.validated_data['ids'])
+        if missing:
+            return Response({'ids': missing}, status=status.HTTP_400_BAD_REQUEST)
+
+        before_states = self.snapshots(records)
+
+        with transaction.atomic():
+            parties = RecordService.bulk_delete(records)
+            AuditLog.objects.bulk_create([
+                AuditLog(
+                    user=request.user,
+                    model_name='Record',
+                    object_id=record.pk,
+                    action='DELETE',
+                    before=before_state,
+                    after=None,
+                    party=record.party
+                )
+                for record, before_state in zip(records, before_states)
+            ])
+            for party in parties:
+                LedgerService.after_write(party)
+
+        return Response({'deleted': len(records)}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'], url_path='bulk-update')
+    def bulk_update(self, request):
+        serializer = RecordBulkUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        records, missing = self.bulk_records(data['ids'])
+        if missing:
+            return Response({'ids': missing}, status=status.HTTP_400_BAD_REQUEST)
+
+        changes = {
+            key: data[key] for key in ['rate', 'pcs', 'discount'] if key in data
+        }
+        errors = {}
+        for record in records:
+            max_discount = (changes.get('rate', record.rate)
+                            * changes.get('pcs', record.pcs))
+            if changes.get('discount', record.discount) > max_discount:
+                errors[record.pk] = {
+                    'discount': [f'Discount cannot exceed {max_discount}']}
+        if errors:
+            return Response({'records': errors},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        before_states = self.snapshots(records)
+
+        with transaction.atomic():
+            parties = RecordService.bulk_update(records, changes)
+            updated = self.get_queryset().in_bulk([r.pk for r in records])
+            updated = [updated[record.pk] for record in records]
+            after_states = self.snapshots(updated)
+            AuditLog.objects.bulk_create([
+                AuditLog(
+                    user=request.user,
+                    model_name='Record',
+                    object_id=record.pk,
+                    action='UPDATE',
+                    before=before_state,
+                    after=after_state,
+                    reason=data.get('reason'),
+                    party=record.party
+                )
+                for record, before_state, after_state
+                in zip(updated, before_states, after_states)
+            ])
+            for party in parties:
+                LedgerService.after_write(party)
+
+        return Response(after_states, status=status.HTTP_200_OK)
+
     def destroy(self, request, *args, **kwargs):
         record = self.get_object()
         record_id = record.id
@@ -209,6 +349,7 @@ class RecordViewSet(ModelViewSet):
 
             )
             record.delete()
+            LedgerService.after_write(record.party)
 
             return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -229,6 +370,7 @@ class RecordViewSet(ModelViewSet):
                 record, serializer.validated_data)
             record = serializer.save()
             RecordService.sync_pending_request_amounts(record)
+            LedgerService.after_write(record.party)
             after_state = json.loads(
                 json.dumps(RecordSerializer(record).data,
                            cls=DjangoJSONEncoder)
@@ -247,12 +389,23 @@ class RecordViewSet(ModelViewSet):
         return Response(RecordSerializer(record).data, status=status.HTTP_200_OK)
 
 
-class PaymentViewSet(ModelViewSet):
+BULK_PAYMENT_LIMIT = 1000
+
+
+class PaymentViewSet(ConditionalGetMixin, FastListMixin, CsvExportMixin, ModelViewSet):
     serializer_class = PaymentSerializer
     permission_classes = [IsAuthenticated, IsOwner, PaymentSaftyNet]
     filter_backends = [DjangoFilterBackend]
     filterset_class = PaymentFilter
-    pagination_class = NormalPagination
+    pagination_class = LedgerPagination
+    count_mode = COUNT_CACHED
+    list_serializer = PaymentSerializer
+    export_name = 'payments'
+    export_fields = ('id', 'payment_date', 'amount')
+    export_joins = {
+        'first_name': F('party__first_name'),
+        'last_name': F('party__last_name'),
+    }
 
     def get_queryset(self):
         if self.request.user.parent:
@@ -277,8 +430,28 @@ class PaymentViewSet(ModelViewSet):
 
         with transaction.atomic():
             payment = PaymentService.create_payment(serializer)
+            LedgerService.after_write(payment.party)
             return Response(self.get_serializer(payment).data, status=status.HTTP_201_CREATED)
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        if request.user.parent:
+            raise PermissionDenied('Only main account can record payments.')
+
+        entries = request.data.get('payments')
+        if not isinstance(entries, list) or not entries:
+            return Response(
+                {'payments': ['Expected a non-empty list of payments.']},
+                status=status.HTTP_400_BAD_REQUEST)
+        if len(entries) > BULK_PAYMENT_LIMIT:
+            return Response(
+                {'payments': [f'At most {BULK_PAYMENT_LIMIT} payments per request.']},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        report = PaymentService.bulk_create(request.user, entries)
+        code = status.HTTP_201_CREATED if report['created'] else status.HTTP_400_BAD_REQUEST
+        return Response(report, status=code)
+
     def destroy(self, request, *args, **kwargs):
         payment = self.get_object()
 
@@ -305,6 +478,7 @@ class PaymentViewSet(ModelViewSet):
             )
 
             payment.delete()
+            LedgerService.after_write(payment.party)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -330,6 +504,7 @@ class PaymentViewSet(ModelViewSet):
 
         with transaction.atomic():
             payment = PaymentService.update_payment(serializer)
+            LedgerService.after_write(payment.party)
 
             after_state = json.loads(
                 json.dumps(
@@ -352,35 +527,67 @@ class PaymentViewSet(ModelViewSet):
             return Response(self.get_serializer(payment).data, status=status.HTTP_200_OK)
 
 
-class AdvanceLedgerViewSet(ReadOnlyModelViewSet):
+class AdvanceLedgerViewSet(ConditionalGetMixin, FastListMixin, CsvExportMixin, ReadOnlyModelViewSet):
     serializer_class = AdvanceLedgerSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
     filterset_class = AdvanceLedgerFilter
-    pagination_class = NormalPagination
+    pagination_class = LedgerPagination
+    count_mode = COUNT_CACHED
+    list_serializer = AdvanceLedgerSerializer
+    export_name = 'advance-ledger'
+    export_fields = ('id', 'created_at', 'direction', 'amount',
+                     'remaining_amount', 'payment_id', 'record_id')
+    export_joins = {
+        'first_name': F('party__first_name'),
+        'last_name': F('party__last_name'),
+        'payment_date': F('payment__payment_date'),
+        'payment_amount': F('payment__amount'),
+        'record_date': F('record__record_date'),
+        'record_pcs': F('record__pcs'),
+        'record_type_of_work': F('record__service_type__type_of_work'),
+    }
 
     def get_queryset(self):
         if self.request.user.parent:
             raise PermissionDenied('Unauthorized access.')
-        return AdvanceLedger.objects.filter(party__user=self.request.user)
+        # every nested path the serializer reads, so retrieve and any
+        # serializer-rendered page stay at one query
+        return AdvanceLedger.objects.filter(
+            party__user=self.request.user
+        ).select_related(
+            'party', 'payment__party', 'record__party', 'record__service_type')
 
 
-class AuditLogViewSet(ReadOnlyModelViewSet):
+class AuditLogViewSet(CsvExportMixin, ReadOnlyModelViewSet):
     serializer_class = AuditLogSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
     filterset_class = AuditLogFilter
-    pagination_class = NormalPagination
+    pagination_class = LedgerPagination
+    count_mode = COUNT_ESTIMATE
+    export_name = 'audit-log'
+    export_fields = ('id', 'object_id', 'model_name', 'action', 'reason',
+                     'created_at', 'before', 'after')
+    export_joins = {
+        'first_name': F('party__first_name'),
+        'last_name': F('party__last_name'),
+    }
 
     def get_queryset(self):
         if self.request.user.parent:
             raise PermissionDenied('Unauthorized access.')
-        return AuditLog.objects.filter(user=self.request.user)\
-            .select_related('party').order_by('-created_at', '-pk')
+        # AuditLogSerializer reads no relations, so nothing to join here
+        return AuditLog.objects.filter(
+            user=self.request.user).order_by('-created_at', '-pk')
+
+
+SUMMARY_CACHE_TIMEOUT = 60 * 5
 
 
 class SummaryView(APIView):
     permission_classes = [IsAuthenticated]
+    count_mode = COUNT_CACHED
 
     def spine(self, qs, party, party_id, date_field, date_from, date_to):
         if party == "single":
@@ -394,7 +601,195 @@ class SummaryView(APIView):
 
         return qs
 
+    def paginate(self, rows, ordering, pagination):
+        # ?cursor= switches any summary type to keyset paging
+        params = self.request.query_params
+        page_size = pagination['page_size']
+
+        if 'cursor' in params:
+            data, pagination['next_cursor'] = keyset_page(
+                rows, ordering, params['cursor'], page_size)
+            return data
+
+        offset = (pagination['page'] - 1) * page_size
+        return list(rows.order_by(*ordering)[offset:offset + page_size])
+
+    def month_span(self, date_from, date_to):
+        # the whole months inside [date_from, date_to] as (first, stop);
+        # either end is None when the range is open on that side
+        try:
+            start = parse_date(date_from) if date_from else None
+            end = parse_date(date_to) if date_to else None
+        except ValueError:
+            return None
+        if (date_from and start is None) or (date_to and end is None):
+            return None
+
+        first = None
+        if start:
+            first = start if start.day == 1 else month_after(start)
+        stop = None
+        if end:
+            stop = month_after(end)
+            if end + timedelta(days=1) != stop:
+                stop = end.replace(day=1)
+
+        if first and stop and first >= stop:
+            return None
+        return first, stop
+
+    def record_totals(self, qs, rollup=None):
+        # count, totals and per-service breakdown from one grouped query
+        # over the raw records, plus one over the monthly rollup when the
+        # caller has moved the whole months out of qs
+        groups = [qs.order_by().values('service_type__type_of_work').annotate(
+            record_count=Count('pk'),
+            total_amount=Sum('gross_amount'),
+            unpaid_amount=Sum('outstanding'),
+            total_pcs=Sum('pcs'),
+        )]
+        if rollup is not None:
+            groups.append(rollup.order_by().values(
+                'service_type__type_of_work'
+            ).annotate(
+                record_count=Sum('record_count'),
+                total_amount=Sum('amount'),
+                unpaid_amount=Sum(F('amount') - F('discount') - F('paid')),
+                total_pcs=Sum('pcs'),
+            ))
+
+        keys = ['record_count', 'total_amount', 'unpaid_amount', 'total_pcs']
+        merged = {}
+        for rows in groups:
+            for row in rows:
+                service = row['service_type__type_of_work']
+                totals = merged.setdefault(service, dict.fromkeys(keys, 0))
+                for key in keys:
+                    totals[key] += row[key] or 0
+
+        summary = {
+            'total_record': sum(t['record_count'] for t in merged.values()),
+            'total_amount': sum(t['total_amount'] for t in merged.values()),
+            'unpaid_amount': sum(t['unpaid_amount'] for t in merged.values()),
+            'total_pcs': sum(t['total_pcs'] for t in merged.values()),
+        }
+        service_type_summary = [
+            {
+                'service_type__type_of_work': service,
+                'total_amount': totals['total_amount'],
+                'unpaid_amount': totals['unpaid_amount'],
+                'total_pcs': totals['total_pcs'],
+            }
+            for service, totals in sorted(
+                merged.items(), key=lambda item: item[0] or '')
+        ]
+        return summary, service_type_summary
+
+    def payment_service_totals(self, qs):
+        # per-service totals for the money these payments put on records.
+        # pcs only count once a record is fully paid, and a payment's
+        # unused advance is credited to its service when it maps to one.
+        payments_sql, params = qs.order_by().values('pk').query.sql_with_params()
+        tables = {
+            'allocation': Allocation._meta.db_table,
+            'ledger': AdvanceLedger._meta.db_table,
+            'record': Record._meta.db_table,
+            'service_type': Service_Type._meta.db_table,
+        }
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                WITH payments (id) AS ({payments_sql}),
+                money_rows AS (
+                    SELECT payment_id, record_id, amount
+                    FROM {tables['allocation']}
+                    WHERE payment_id IN (SELECT id FROM payments)
+                    UNION ALL
+                    SELECT payment_id, record_id, amount
+                    FROM {tables['ledger']}
+                    WHERE direction = 'OUT'
+                      AND record_id IS NOT NULL
+                      AND payment_id IN (SELECT id FROM payments)
+                ),
+                tagged AS (
+                    SELECT m.payment_id, m.record_id, m.amount, r.pcs,
+                           COALESCE(NULLIF(s.type_of_work, ''), 'Unknown') AS service,
+                           CASE WHEN ROUND(r.outstanding, 2) <= 0
+                                THEN 1 ELSE 0 END AS fully_paid
+                    FROM money_rows m
+                    JOIN {tables['record']} r ON r.id = m.record_id
+                    JOIN {tables['service_type']} s ON s.id = r.service_type_id
+                ),
+                single_service AS (
+                    SELECT payment_id, MIN(service) AS service
+                    FROM tagged
+                    GROUP BY payment_id
+                    HAVING COUNT(DISTINCT service) = 1
+                ),
+                leftover AS (
+                    SELECT payment_id, SUM(remaining_amount) AS amount
+                    FROM {tables['ledger']}
+                    WHERE direction = 'IN'
+                      AND remaining_amount > 0
+                      AND payment_id IN (SELECT id FROM payments)
+                    GROUP BY payment_id
+                )
+                SELECT service, SUM(amount), SUM(pcs)
+                FROM (
+                    SELECT service, amount, 0 AS pcs FROM tagged
+                    UNION ALL
+                    SELECT service, 0, pcs
+                    FROM (
+                        SELECT DISTINCT service, record_id, pcs
+                        FROM tagged WHERE fully_paid = 1
+                    ) AS paid_records
+                    UNION ALL
+                    SELECT ss.service, l.amount, 0
+                    FROM leftover l
+                    JOIN single_service ss ON ss.payment_id = l.payment_id
+                ) AS buckets
+                GROUP BY service
+            ''', params)
+            rows = cursor.fetchall()
+
+        service_type_summary = [
+            {
+                'service_type__type_of_work': service,
+                # SQLite hands back floats for decimal sums
+                'total_amount': Decimal(str(amount)).quantize(Decimal('0.01')),
+                'total_pcs': int(pcs),
+            }
+            for service, amount, pcs in rows
+        ]
+        service_type_summary.sort(
+            key=lambda item: (
+                -(item['total_amount'] or 0),
+                item['service_type__type_of_work'] or '',
+            )
+        )
+        return service_type_summary
+
     def get(self, request):
+        # dashboards poll with the same params; answer from cache (or with a
+        # 304) until a write moves the owner's ledger version
+        key = ledger_cache_key('summary', request)
+        etag = f'"{hashlib.md5(key.encode()).hexdigest()}"'
+
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+        data = cache.get(key)
+        if data is None:
+            response = self.summarize(request)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            data = response.data
+            cache.set(key, data, SUMMARY_CACHE_TIMEOUT)
+
+        return Response(data, headers={'ETag': etag})
+
+    def summarize(self, request):
         user = request.user
         params = request.query_params
 
@@ -406,8 +801,7 @@ class SummaryView(APIView):
 
         page = int(params.get("page", 1))
         page_size = int(params.get("page_size", 20))
-        offset = (page - 1) * page_size
-        limit = offset + page_size
+        with_count = wants_count(request)
 
         if data_type == "record":
             if user.parent:
@@ -418,59 +812,65 @@ class SummaryView(APIView):
             qs = self.spine(qs, party, party_id,
                             "record_date", date_from, date_to)
 
-            qs = qs.annotate(
-                amount=ExpressionWrapper(
-                    F("rate") * F("pcs"),
-                    output_field=DecimalField()
-                ),
-                remaining_amount=ExpressionWrapper(
-                    (F("rate") * F("pcs") - F("discount")) - F("paid_amount"),
-                    output_field=DecimalField()
-                )
-            )
-
             status = params.get("status", "").lower()
 
             if status == "paid":
-                qs = qs.filter(remaining_amount=0)
+                qs = qs.filter(outstanding=0)
             elif status == "unpaid":
-                qs = qs.filter(remaining_amount__gt=0)
-
-            total_count = qs.count()
-
-            summary = qs.aggregate(
-                total_amount=Sum('amount'),
-                unpaid_amount=Sum('remaining_amount'),
-                total_pcs=Sum('pcs')
-            )
+                qs = qs.filter(outstanding__gt=0)
 
-            service_type_summary = qs.values('service_type__type_of_work').annotate(
-                total_amount=Sum('amount'),
-                unpaid_amount=Sum('remaining_amount'),
-                total_pcs=Sum('pcs')
-            )
-
-            data = list(qs.order_by("record_date")[offset:limit].values(
-                "id", "record_date", 'pcs', 'rate', "amount", 'discount', 'paid_amount', 'remaining_amount',
+            # whole months come from MonthlyRollup, only the partial months
+            # at either edge are summed from raw records
+            span = None if status else self.month_span(date_from, date_to)
+            if span is None:
+                summary, service_type_summary = self.record_totals(qs)
+            else:
+                first, stop = span
+                if user.parent:
+                    rollup = MonthlyRollup.objects.filter(
+                        party__assigned_to=user)
+                else:
+                    rollup = MonthlyRollup.objects.filter(owner=user)
+                if party == "single":
+                    rollup = rollup.filter(party_id=party_id)
+
+                inside = Q()
+                if first:
+                    inside &= Q(record_date__gte=first)
+                    rollup = rollup.filter(month__gte=first)
+                if stop:
+                    inside &= Q(record_date__lt=stop)
+                    rollup = rollup.filter(month__lt=stop)
+                edges = qs.exclude(inside) if inside else qs.none()
+
+                summary, service_type_summary = self.record_totals(
+                    edges, rollup)
+            total_count = summary['total_record']
+
+            rows = qs.values(
+                "id", "record_date", 'pcs', 'rate', 'discount', 'paid_amount',
+                amount=F('gross_amount'),
+                remaining_amount=F('outstanding'),
                 first_name=F('party__first_name'),
                 last_name=F('party__last_name'),
-            ))
+            )
+            pagination = {
+                'page': page,
+                'page_size': page_size,
+                'total': total_count,
+                'count_mode': COUNT_EXACT,
+            }
+            data = self.paginate(rows, ['record_date', 'id'], pagination)
 
             return Response(
                 {
                     "type": "Record",
                     "summary": {
-                        "total_record": total_count,
-                        'total_amount': summary['total_amount'] or 0,
-                        "unpaid_amount": summary['unpaid_amount'] or 0,
-                        'total_pcs': summary['total_pcs'] or 0,
-                        'service_type_summary': list(service_type_summary)
+                        **summary,
+                        'service_type_summary': service_type_summary
                     },
-                    "pagination": {
-                        'page': page,
-                        'page_size': page_size,
-                        'total': total_count
-                    }, "result": data,
+                    "pagination": pagination,
+                    "result": data,
                 }
             )
 
@@ -484,115 +884,22 @@ class SummaryView(APIView):
             qs = self.spine(qs, party, party_id,
                             'payment_date', date_from, date_to)
 
-            total_payments = qs.count()
+            total_payments, count_mode = count_rows(qs, request, self.count_mode)
             total_paid = qs.aggregate(total=Sum('amount'))['total'] or 0
 
-            allocation_rows = Allocation.objects.filter(
-                payment__in=qs,
-                record__isnull=False
-            ).annotate(
-                record_total_amount=ExpressionWrapper(
-                    F('record__pcs') * F('record__rate') - F('record__discount'),
-                    output_field=DecimalField()
-                )
-            ).values(
-                'payment_id',
-                'record_id',
-                'record__pcs',
-                'record__paid_amount',
-                'record_total_amount',
-                'record__service_type__type_of_work',
-                'amount',
-            )
-
-            advance_rows = AdvanceLedger.objects.filter(
-                payment__in=qs,
-                record__isnull=False,
-                direction='OUT'
-            ).annotate(
-                record_total_amount=ExpressionWrapper(
-                    F('record__pcs') * F('record__rate') - F('record__discount'),
-                    output_field=DecimalField()
-                )
-            ).values(
-                'payment_id',
-                'record_id',
-                'record__pcs',
-                'record__paid_amount',
-                'record_total_amount',
-                'record__service_type__type_of_work',
-                'amount',
-            )
+            service_type_summary = self.payment_service_totals(qs)
 
-            payment_remaining_advances = {
-                row['payment_id']: row['remaining_amount'] or 0
-                for row in AdvanceLedger.objects.filter(
-                    payment__in=qs,
-                    direction='IN',
-                    remaining_amount__gt=0
-                ).values('payment_id').annotate(
-                    remaining_amount=Sum('remaining_amount')
-                )
+            pagination = {
+                'page': page,
+                'page_size': page_size,
+                'total': total_payments,
+                'count_mode': count_mode,
             }
-
-            service_totals = defaultdict(
-                lambda: {
-                    'service_type__type_of_work': 'Unknown',
-                    'total_amount': 0,
-                    'total_pcs': 0,
-                    '_record_ids': set(),
-                }
-            )
-            payment_services = defaultdict(set)
-
-            for row in list(allocation_rows) + list(advance_rows):
-                service_name = row['record__service_type__type_of_work'] or 'Unknown'
-                bucket = service_totals[service_name]
-                bucket['service_type__type_of_work'] = service_name
-                bucket['total_amount'] += row['amount'] or 0
-                payment_services[row['payment_id']].add(service_name)
-
-                record_id = row['record_id']
-                record_is_fully_paid = (
-                    record_id
-                    and (row['record__paid_amount'] or 0) >= (row['record_total_amount'] or 0)
-                )
-                if record_is_fully_paid and record_id not in bucket['_record_ids']:
-                    bucket['_record_ids'].add(record_id)
-                    bucket['total_pcs'] += row['record__pcs'] or 0
-
-            for payment_id, remaining_amount in payment_remaining_advances.items():
-                services = payment_services.get(payment_id, set())
-
-                # Only roll leftover advance into the breakdown when this payment
-                # maps cleanly to a single service bucket.
-                if remaining_amount and len(services) == 1:
-                    service_name = next(iter(services))
-                    bucket = service_totals[service_name]
-                    bucket['service_type__type_of_work'] = service_name
-                    bucket['total_amount'] += remaining_amount
-
-            service_type_summary = [
-                {
-                    'service_type__type_of_work': item['service_type__type_of_work'],
-                    'total_amount': item['total_amount'],
-                    'total_pcs': item['total_pcs'],
-                }
-                for item in service_totals.values()
-            ]
-
-            service_type_summary.sort(
-                key=lambda item: (
-                    -(item['total_amount'] or 0),
-                    item['service_type__type_of_work'] or '',
-                )
-            )
-
-            data = list(qs.order_by('payment_date')[offset:limit].values(
+            data = self.paginate(qs.values(
                 "id", 'payment_date', 'amount',
                 first_name=F('party__first_name'),
                 last_name=F('party__last_name'),
-            ))
+            ), ['payment_date', 'id'], pagination)
 
             return Response({
                 'type': 'payment',
@@ -601,11 +908,7 @@ class SummaryView(APIView):
                     'total_paid': total_paid,
                     'service_type_summary': service_type_summary,
                 },
-                'pagination': {
-                    'page': page,
-                    'page_size': page_size,
-                    'total': total_payments,
-                },
+                'pagination': pagination,
                 'result': data
             })
 
@@ -630,9 +933,17 @@ class SummaryView(APIView):
             if direction in ['IN', 'OUT']:
                 qs = qs.filter(direction=direction)
 
-            total_ledger = qs.count()
+            total_ledger = count_mode = None
+            if with_count:
+                total_ledger, count_mode = count_rows(qs, request, self.count_mode)
 
-            data = list(qs.order_by('created_at')[offset:limit].values(
+            pagination = {
+                "page": page,
+                "page_size": page_size,
+                "total": total_ledger,
+                "count_mode": count_mode,
+            }
+            data = self.paginate(qs.values(
                 "id", "created_at", "direction", "amount", 'remaining_amount', 'payment_id', 'record_id',
                 first_name=F('party__first_name'),
                 last_name=F('party__last_name'),
@@ -641,7 +952,7 @@ class SummaryView(APIView):
                 record_date=F('record__record_date'),
                 record_pcs=F('record__pcs'),
                 record_type_of_work=F('record__service_type__type_of_work')
-            ))
+            ), ['created_at', 'id'], pagination)
 
             return Response({
                 "type": "advance_ledger",
@@ -650,11 +961,7 @@ class SummaryView(APIView):
                     "total_out": total_out,
                     "net_balance": total_in - total_out,
                 },
-                "pagination": {
-                    "page": page,
-                    "page_size": page_size,
-                    "total": total_ledger,
-                },
+                "pagination": pagination,
                 "results": data,
             })
 
@@ -676,24 +983,28 @@ class SummaryView(APIView):
             if action:
                 qs = qs.filter(action__iexact=action)
 
-            total_count = qs.count()
+            total_count = count_mode = None
+            if with_count:
+                total_count, count_mode = count_rows(qs, request, self.count_mode)
 
-            data = list(qs.order_by("-created_at")[offset:limit].values(
+            pagination = {
+                "page": page,
+                "page_size": page_size,
+                "total": total_count,
+                "count_mode": count_mode,
+            }
+            data = self.paginate(qs.values(
                 "id", 'object_id', "model_name", "action", "created_at", 'before', 'after',
                 first_name=F('party__first_name'),
                 last_name=F('party__last_name'),
-            ))
+            ), ['-created_at', '-id'], pagination)
 
             return Response({
                 "type": "audit",
                 "summary": {
                     "total_logs": total_count
                 },
-                "pagination": {
-                    "page": page,
-                    "page_size": page_size,
-                    "total": total_count,
-                },
+                "pagination": pagination,
                 "results": data,
             })
 
@@ -716,7 +1027,8 @@ class PaymentRequestviewset(ModelViewSet):
             qs = qs.filter(status=status)
 
         return qs.select_related('created_by').prefetch_related(  # 👈 remove 'party'
-            'record__party', 'record__service_type'
+            Prefetch('record__party', queryset=ranked_parties()),
+            'record__service_type'
         )
 
     def get_serializer_class(self):
@@ -766,13 +1078,9 @@ class PaymentRequestviewset(ModelViewSet):
         owner = user.parent
 
         base_qs = Record.objects.filter(
-            party__assigned_to=user
-        ).annotate(
-            not_paid=ExpressionWrapper(
-                (F('rate') * F('pcs')) - F('discount') - F('paid_amount'),
-                output_field=DecimalField()
-            )
-        ).filter(not_paid__gt=0)
+            party__assigned_to=user,
+            outstanding__gt=0
+        )
 
         pending_ids = Payment_Request.objects.filter(
             status='P',
@@ -819,6 +1127,7 @@ class PaymentRequestviewset(ModelViewSet):
                 payment = Payment.objects.create(party=party, amount=amount)
                 PaymentService.allocate_payment_to_records(payment, records)
                 PaymentService.sync_pending_request_amounts_for_party(party)
+                LedgerService.after_write(party)
 
             pr.status = 'A'
             pr.save()
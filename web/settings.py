@@ -88,6 +88,11 @@ DATABASES = {
     }
 }
 
+# locmem unless CACHE_URL points at a shared backend (redis://, memcache://...)
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators